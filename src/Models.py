@@ -337,6 +337,10 @@ class TaskRsp(TaskReq):
     status: Literal["Pending", "Running", "Finished", "Failed"]
     createdAt: datetime
     updatedAt: datetime
+    stage: Optional[str] = None  # current processing stage
+    done: Optional[int] = None  # units of work done in stage
+    total: Optional[int] = None  # units of work in stage, if known
+    eta: Optional[int] = None  # estimated seconds until the stage ends
 
 
 class ProcessRsp(BaseModel):
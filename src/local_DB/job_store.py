@@ -0,0 +1,133 @@
+"""
+Durable storage of background jobs in the local database.
+"""
+
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import func
+
+from .models import PersistedJob, get_session_maker
+
+
+class JobStore:
+    """
+    Keeps a copy of each job's description and status in the local SQLite database.
+
+    Attributes:
+        SessionMaker (sqlalchemy.orm.sessionmaker): The SQLAlchemy session maker.
+        lock (threading.Lock): Serializes writes, SQLite does not like concurrent writers.
+    """
+
+    def __init__(self, session_maker=None):
+        """
+        Initialize the store.
+
+        Args:
+            session_maker (sqlalchemy.orm.sessionmaker, optional): The session maker to use.
+                If None, one on the default database is created. Defaults to None.
+        """
+        if session_maker is None:
+            session_maker = get_session_maker()
+        self.SessionMaker = session_maker
+        self.lock = threading.Lock()
+
+    def save(
+        self,
+        job_id: int,
+        job_class: str,
+        params_key: str,
+        params: Dict[str, Any],
+        state: str,
+        created_at: datetime,
+        updated_at: datetime,
+        last_log_line: Optional[str],
+        owner: Optional[str] = None,
+        priority: Optional[int] = None,
+    ) -> None:
+        """
+        Insert or update the job with given ID.
+        """
+        self.save_all(
+            [
+                dict(
+                    id=job_id,
+                    job_class=job_class,
+                    params_key=params_key,
+                    params=params,
+                    state=state,
+                    created_at=created_at,
+                    updated_at=updated_at,
+                    last_log_line=last_log_line,
+                    owner=owner,
+                    priority=priority,
+                )
+            ]
+        )
+
+    def save_all(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Insert or update several jobs in a single transaction, each given as its columns values.
+        """
+        with self.lock:
+            with self.SessionMaker() as session:
+                for a_row in rows:
+                    session.merge(PersistedJob(**a_row))
+                session.commit()
+
+    def set_state(
+        self, job_id: int, state: str, last_log_line: Optional[str] = None
+    ) -> None:
+        """
+        Update the state of the job with given ID, and optionally its last log line.
+        """
+        with self.lock:
+            with self.SessionMaker() as session:
+                row = session.get(PersistedJob, job_id)
+                if row is None:
+                    return
+                row.state = state
+                row.updated_at = datetime.now()
+                if last_log_line is not None:
+                    row.last_log_line = last_log_line
+                session.commit()
+
+    def get(self, job_id: int) -> Optional[PersistedJob]:
+        """
+        Get the job with given ID, or None if not found.
+        """
+        with self.SessionMaker() as session:
+            return session.get(PersistedJob, job_id)
+
+    def in_states(self, states: List[str]) -> List[PersistedJob]:
+        """
+        Get all jobs in any of given states, oldest first.
+        """
+        with self.SessionMaker() as session:
+            return (
+                session.query(PersistedJob)
+                .filter(PersistedJob.state.in_(states))
+                .order_by(PersistedJob.id)
+                .all()
+            )
+
+    def with_params_key(self, params_key: str) -> List[PersistedJob]:
+        """
+        Get all jobs having given params key, oldest first.
+        """
+        with self.SessionMaker() as session:
+            return (
+                session.query(PersistedJob)
+                .filter(PersistedJob.params_key == params_key)
+                .order_by(PersistedJob.id)
+                .all()
+            )
+
+    def max_id(self) -> int:
+        """
+        Get the highest job ID ever stored, 0 if none.
+        """
+        with self.SessionMaker() as session:
+            ret = session.query(func.max(PersistedJob.id)).scalar()
+            return ret if ret is not None else 0
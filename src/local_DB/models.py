@@ -1,7 +1,7 @@
 import os
 from typing import Optional, Dict, Any
 
-from sqlalchemy import Integer, String, create_engine, JSON, DateTime
+from sqlalchemy import Integer, String, create_engine, JSON, DateTime, inspect, text
 from sqlalchemy.orm import DeclarativeBase, sessionmaker, mapped_column, Mapped
 
 from config_rdr import config
@@ -102,6 +102,32 @@ class BlacklistedToken(Base):
         return f"<BlacklistedToken(token='{self.token[:10]}...', expires_at='{self.expires_at}')>"
 
 
+# Define the PersistedJob model
+class PersistedJob(Base):
+    """
+    SQLAlchemy model for the jobs table.
+
+    This table keeps a durable copy of background jobs, so that a server restart
+    does not lose the ones which were queued.
+    """
+
+    __tablename__ = "jobs"
+
+    id = mapped_column(Integer, primary_key=True)
+    job_class = mapped_column(String, nullable=False)
+    params_key = mapped_column(String, nullable=False, index=True)
+    params: Mapped[Dict[str, Any]] = mapped_column(JSON, nullable=False)
+    state = mapped_column(String(1), nullable=False, index=True)
+    created_at = mapped_column(DateTime, nullable=False)
+    updated_at = mapped_column(DateTime, nullable=False)
+    last_log_line = mapped_column(String)
+    owner = mapped_column(String)
+    priority = mapped_column(Integer)
+
+    def __repr__(self):
+        return f"<PersistedJob(id={self.id}, job_class='{self.job_class}', state='{self.state}')>"
+
+
 # Database connection and session management
 def get_engine(db_name=None):
     """
@@ -168,4 +194,36 @@ def init_db():
     """
     engine = get_engine()
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
     return os.path.join(config.WORKING_DIR, config.DB_NAME)
+
+
+def add_missing_columns(engine):
+    """
+    Add the nullable columns, and the indexes, declared in models but absent from existing tables,
+    as create_all() only creates missing tables.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The SQLAlchemy engine.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for a_table in Base.metadata.sorted_tables:
+            if not inspector.has_table(a_table.name):
+                continue
+            existing = {a_col["name"] for a_col in inspector.get_columns(a_table.name)}
+            for a_column in a_table.columns:
+                if a_column.name in existing or not a_column.nullable:
+                    continue
+                col_type = a_column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {a_table.name} ADD COLUMN {a_column.name} {col_type}"
+                    )
+                )
+            existing = {
+                an_idx["name"] for an_idx in inspector.get_indexes(a_table.name)
+            }
+            for an_index in a_table.indexes:
+                if an_index.name not in existing:
+                    an_index.create(connection)
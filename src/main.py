@@ -39,6 +39,7 @@ from legacy.backgrounds import LegacyBackgroundDir
 from legacy.drives import validate_drives
 from legacy.writers.background import file_name_for_raw_background
 from local_DB.db_dependencies import get_db
+from local_DB.job_store import JobStore
 from local_DB.models import init_db
 from helpers.logger import logger
 from modern.app_urls import is_download_url, extract_file_id_from_download_url
@@ -62,8 +63,6 @@ from routers.vignettes import router as vignettes_router
 from routers.ecotaxa import router as ecotaxa_router
 from static.favicon import create_plankton_favicon
 
-JOB_INTERVAL = 2
-
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
@@ -74,7 +73,10 @@ async def lifespan(_app: FastAPI):
     # Initialize database tables if they don't exist
     logger.info("Initializing database tables")
     init_db()
-    JobScheduler.launch_at_interval(JOB_INTERVAL)
+    # Keep jobs across restarts
+    JobScheduler.use_store(JobStore())
+    JobScheduler.restore_from_store()
+    JobScheduler.launch()
 
     yield
     # Cleanup code
@@ -0,0 +1,120 @@
+# Computation of EcoTaxa features of ROIs, by shards in worker processes
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed, Future
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from ZooProcess_lib.Processor import Processor
+from ZooProcess_lib.ROI import ROI
+from modern.tasks import JobProgress
+
+# Worker processes for features, 0 for computing them in the job itself, and ROIs per worker call
+# (configurable through env)
+FEATURES_WORKERS: int = int(os.getenv("FEATURES_WORKERS", "0"))
+FEATURES_SHARD_SIZE: int = int(os.getenv("FEATURES_SHARD_SIZE", "500"))
+
+# State of a worker process, set once by _init_worker
+_worker_processor: Optional[Processor] = None
+_worker_image: Optional[np.ndarray] = None
+_worker_resolution = 0
+
+
+def compute_features(
+    processor: Processor,
+    project_params: Dict[str, Any],
+    work_dir: Path,
+    image: np.ndarray,
+    resolution: int,
+    rois: List[ROI],
+    progress: JobProgress,
+    image_file: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Compute features of the ROIs in the image, in worker processes if configured and worth it.
+    Workers memory-map the image from a file, so its pages are shared whatever their number, and
+    results are concatenated in ROIs order, i.e. identical to the ones of a single call.
+
+    Args:
+        processor: For computing in the current process.
+        project_params: Storable reference to the project, for workers to build their processor.
+        work_dir: Where to write the image for workers.
+        image_file: A .npy file known to hold the image as it is, e.g. its stage cache one,
+            which workers then map instead of a written copy.
+    """
+    if FEATURES_WORKERS <= 1 or len(rois) <= FEATURES_SHARD_SIZE:
+        ret = processor.calculator.ecotaxa_measures_list_from_roi_list(
+            image, resolution, rois
+        )
+        progress.advance(len(rois))
+        return ret
+    shards = [
+        rois[start : start + FEATURES_SHARD_SIZE]
+        for start in range(0, len(rois), FEATURES_SHARD_SIZE)
+    ]
+    os.makedirs(work_dir, exist_ok=True)
+    image_path = work_dir / f"features_image.{os.getpid()}.npy"
+    try:
+        _link_or_save(image, image_path, image_file)
+        results: Dict[int, List[Dict[str, Any]]] = {}
+        with ProcessPoolExecutor(
+            max_workers=min(FEATURES_WORKERS, len(shards)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(project_params, image_path, resolution),
+        ) as executor:
+            futures: Dict[Future, int] = {
+                executor.submit(_features_of, a_shard): idx
+                for idx, a_shard in enumerate(shards)
+            }
+            for a_future in as_completed(futures):
+                idx = futures[a_future]
+                results[idx] = a_future.result()
+                progress.advance(len(shards[idx]))
+    finally:
+        image_path.unlink(missing_ok=True)
+    return [a_row for idx in range(len(shards)) for a_row in results[idx]]
+
+
+def _link_or_save(
+    image: np.ndarray, image_path: Path, image_file: Optional[Path]
+) -> None:
+    """
+    Make the image readable by workers at given path, without writing it if the caller has it in a file.
+    """
+    if image_file is not None:
+        try:
+            # Another name for the same file, in case the cache replaces it meanwhile
+            os.link(image_file, image_path)
+            return
+        except OSError:
+            pass
+    np.save(image_path, image)
+
+
+def _init_worker(
+    project_params: Dict[str, Any], image_path: Path, resolution: int
+) -> None:
+    """
+    Entry point of feature worker processes.
+    Current process: a spawned one, all state is fresh
+    """
+    global _worker_processor, _worker_image, _worker_resolution
+    from modern.jobs.VignettesToAutoSep import project_from_persisted
+
+    zoo_project = project_from_persisted(project_params)
+    _worker_processor = Processor.from_legacy_config(
+        zoo_project.zooscan_config.read(),
+        zoo_project.zooscan_config.read_lut(),
+    )
+    _worker_image = np.load(image_path, mmap_mode="c")
+    _worker_resolution = resolution
+
+
+def _features_of(rois: List[ROI]) -> List[Dict[str, Any]]:
+    assert _worker_processor is not None and _worker_image is not None
+    return _worker_processor.calculator.ecotaxa_measures_list_from_roi_list(
+        _worker_image, _worker_resolution, rois
+    )
@@ -17,16 +17,27 @@ V10_THUMBS_TO_CHECK_SUBDIR = "cuts_multiples"  # Where and how ML (or user) dete
 V10_THUMBS_AFTER_SUBDIR = (
     "cuts_after_sep"  # Output of full image segmented, after applying separation
 )
+V10_CACHE_SUBDIR = "cache"  # Intermediate images, reused while their inputs don't change
+V10_BACKGROUNDS_SUBDIR = "_backgrounds"  # Combined backgrounds, shared by all scans of a project
+V10_RGB_THUMBS_SUBDIR = "cuts_rgb"  # In cache, RGB conversions of thumbnails sent to ML services
 
 ML_SEPARATION_DONE_TXT = "ML_separation_done.txt"
 SEPARATION_VALIDATED_TXT = "separation_validated.txt"
 SCORE_PER_IMAGE = "score_per_image.json"
+CLASSIFIER_SCORES = "classifier_scores.json"  # In cache, scores by image content
 ML_MSK_OK_TXT = "MSK_validated.txt"
 ECOTAXA_ZIP = "ecotaxa_upload.zip"
 UPLOAD_DONE_TXT = "upload_done.txt"
 ECOTAXA_PROJECT_CONFIG = "ecotaxa_project.txt"
 
 
+def combined_backgrounds_dir(zoo_project: ZooscanProjectFolder) -> Path:
+    """
+    Get the directory of combined backgrounds for the whole project.
+    """
+    return zoo_project.zooscan_scan.path / TOP_V10_DIR / V10_BACKGROUNDS_SUBDIR
+
+
 class ModernScanFileSystem:
     """
     A class to manage the modern file system structure based on a legacy work directory.
@@ -83,6 +94,36 @@ class ModernScanFileSystem:
         """
         return self.work_dir / V10_THUMBS_TO_CHECK_SUBDIR
 
+    @property
+    def cache_dir(self) -> Path:
+        """
+        Get the directory of cached intermediate images.
+
+        Returns:
+            Path to the cache directory
+        """
+        return self.work_dir / V10_CACHE_SUBDIR
+
+    @property
+    def rgb_cut_dir(self) -> Path:
+        """
+        Get the directory of RGB conversions of the cut/thumbnails, as sent to ML services.
+
+        Returns:
+            Path to the RGB cut/thumbnails cache directory
+        """
+        return self.cache_dir / V10_RGB_THUMBS_SUBDIR
+
+    @property
+    def classifier_scores_path(self) -> Path:
+        """
+        Get the file of classifier scores by thumbnail content, kept between runs.
+
+        Returns:
+            Path to the scores cache file
+        """
+        return self.cache_dir / CLASSIFIER_SCORES
+
     def fresh_empty_cut_dir(self) -> Path:
         """
         Get the cut/thumbnails directory path, ensuring it's new and empty.
@@ -94,6 +135,9 @@ class ModernScanFileSystem:
         thumbs_dir = self.cut_dir
         if thumbs_dir.exists():
             shutil.rmtree(thumbs_dir)
+        # Conversions of previous thumbnails are useless
+        if self.rgb_cut_dir.exists():
+            shutil.rmtree(self.rgb_cut_dir)
         os.makedirs(thumbs_dir, exist_ok=True)
         return thumbs_dir
 
@@ -158,6 +202,18 @@ class ModernScanFileSystem:
 
         return files_before_separation
 
+    def remove_work_files(self, *paths: Path) -> None:
+        """
+        Remove the given files or directories, which must be inside the work directory.
+        Missing ones are ignored.
+        """
+        for a_path in paths:
+            assert a_path.is_relative_to(self.work_dir), f"{a_path} is not in work dir"
+            if a_path.is_dir():
+                shutil.rmtree(a_path, ignore_errors=True)
+            elif a_path.exists():
+                a_path.unlink()
+
     def ensure_meta_dir(self) -> Path:
         meta_dir = self.meta_dir
         if not meta_dir.exists():
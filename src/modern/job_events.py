@@ -0,0 +1,93 @@
+# Push of job changes to asynchronous consumers, e.g. server-sent events connections
+import asyncio
+import threading
+from typing import Callable, Dict, List, Set
+
+from helpers.logger import logger
+from modern.tasks import Job, JobIDT
+
+JobFilter = Callable[[Job], bool]
+
+
+class JobEventsSubscription:
+    """
+    Changes of the jobs accepted by a filter, as seen from an asyncio event loop.
+    Several changes of the same job between two reads are coalesced into its latest state.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, accept: JobFilter):
+        self.loop = loop
+        self.accept = accept
+        self.changed: Dict[JobIDT, Job] = {}
+        self.lock = threading.Lock()
+        self.has_changes = asyncio.Event()
+
+    def notify(self, job: Job) -> None:
+        """
+        Record a change of the job.
+        Current thread: any
+        """
+        if not self.accept(job):
+            return
+        with self.lock:
+            self.changed[job.job_id] = job
+        try:
+            self.loop.call_soon_threadsafe(self.has_changes.set)
+        except RuntimeError:
+            pass  # Loop closed, the subscription is about to be closed as well
+
+    async def next_changes(self, timeout: float) -> List[Job]:
+        """
+        Wait for changes, at most timeout seconds, and return the changed jobs.
+        Current thread: the event loop one
+        """
+        try:
+            await asyncio.wait_for(self.has_changes.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.has_changes.clear()
+        with self.lock:
+            ret = list(self.changed.values())
+            self.changed.clear()
+        return ret
+
+
+class JobEvents:
+    """
+    Fan-out of job changes, fed by a Job listener, to all subscriptions.
+    """
+
+    subscriptions: Set[JobEventsSubscription] = set()
+    lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def publish(cls, job: Job) -> None:
+        """
+        The Job listener.
+        Current thread: any, where the job changed
+        """
+        if job.job_id <= 0:
+            return
+        with cls.lock:
+            subscriptions = list(cls.subscriptions)
+        for a_subscription in subscriptions:
+            a_subscription.notify(job)
+
+    @classmethod
+    def subscribe(cls, accept: JobFilter) -> JobEventsSubscription:
+        """
+        Start receiving changes of jobs accepted by the filter.
+        Current thread: the event loop one
+        """
+        if cls.publish not in Job.listeners:
+            Job.listeners.append(cls.publish)
+        ret = JobEventsSubscription(asyncio.get_running_loop(), accept)
+        with cls.lock:
+            cls.subscriptions.add(ret)
+            logger.info(f"Job events subscriptions: {len(cls.subscriptions)}")
+        return ret
+
+    @classmethod
+    def unsubscribe(cls, subscription: JobEventsSubscription) -> None:
+        with cls.lock:
+            cls.subscriptions.discard(subscription)
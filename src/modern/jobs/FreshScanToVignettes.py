@@ -1,22 +1,40 @@
 # Process a scan from its physical acquisition to operator check
 from pathlib import Path
-from typing import List
+from typing import List, Dict, Any, Optional
 
 from ZooProcess_lib.Processor import Processor
 from ZooProcess_lib.ZooscanFolder import ZooscanProjectFolder
+from legacy.ids import measure_file_name
 from modern.filesystem import ModernScanFileSystem
 from modern.ids import scan_name_from_subsample_name
 from modern.jobs.VignettesToAutoSep import (
     convert_scan_and_backgrounds,
     get_scan_and_backgrounds,
     produce_cuts_and_index,
+    persisted_subsample_params,
+    estimated_scan_memory_mb,
+    project_from_persisted,
+    scan_caches,
+    scores_run_id,
+    FIRST_PASS_ROIS_STAGE,
 )
-from modern.tasks import Job
+from modern.tasks import Job, ExecutionModeEnum, ResourceClassEnum, JobPriorityEnum
+from modern.tiling import find_ROIs
 from modern.to_legacy import save_mask_image
-from providers.ML_multiple_classifier import classify_all_images_from
+from providers.ML_multiple_classifier import (
+    classify_all_images_from,
+    classifier_scores_cache,
+    content_keys_path,
+)
 
 
 class FreshScanToVignettes(Job):
+    # Image conversion and segmentation are CPU-bound
+    execution_mode = ExecutionModeEnum.Process
+    resource_class = ResourceClassEnum.CPUHeavy
+    stages = ["convert", "bg-remove", "mask", "segment", "extract", "classify"]
+    # An operator checks the produced mask right after
+    priority = JobPriorityEnum.Interactive
 
     def __init__(
         self,
@@ -40,6 +58,23 @@ class FreshScanToVignettes(Job):
         self.msk_file_path = self.modern_fs.MSK_file_path
         self.scores_file: Path = self.modern_fs.scores_file_path
 
+    def estimated_memory_mb(self) -> int:
+        return estimated_scan_memory_mb(self.zoo_project, self.subsample_name)
+
+    def project_id(self) -> Optional[str]:
+        return str(self.zoo_project.path)
+
+    def persisted_params(self) -> Dict[str, Any]:
+        return persisted_subsample_params(
+            self.zoo_project, self.sample_name, self.subsample_name
+        )
+
+    @classmethod
+    def from_persisted(cls, params: Dict[str, Any]) -> "FreshScanToVignettes":
+        return cls(
+            project_from_persisted(params), params["sample"], params["subsample"]
+        )
+
     def prepare(self):
         """
         Start the job execution.
@@ -69,20 +104,35 @@ class FreshScanToVignettes(Job):
             self.zoo_project.zooscan_config.read_lut(),
         )
         self.logger.info(f"Converting scan and backgrounds")
+        caches = scan_caches(self.zoo_project, self.modern_fs)
         scan_resolution, scan_without_background = convert_scan_and_backgrounds(
-            self.logger, processor, self.raw_scan, self.bg_scans
+            self.logger,
+            processor,
+            self.raw_scan,
+            self.bg_scans,
+            self.progress,
+            caches,
         )
         # Mask generation
         self.logger.info(f"Generating MSK")
+        self.progress.start_stage("mask")
         mask = processor.segmenter.get_mask_from_image(scan_without_background)
+        self.check_cancelled()
         save_mask_image(self.logger, mask, self.msk_file_path)
         # Segmentation
         self.logger.info(f"Segmenting")
-        rois, stats = processor.segmenter.find_ROIs_in_image(
-            scan_without_background,
-            scan_resolution,
+        self.progress.start_stage("segment")
+        rois, stats = find_ROIs(
+            processor.segmenter, scan_without_background, scan_resolution
         )
         self.logger.info(f"Segmentation stats: {stats}")
+        # Kept for the post-separation job, which can reuse them where the scan was not separated
+        self.check_cancelled()
+        caches.scan.save_object(
+            FIRST_PASS_ROIS_STAGE,
+            caches.scan_key(self.raw_scan, self.bg_scans),
+            rois,
+        )
         modern_fs = ModernScanFileSystem(
             self.zoo_project, self.sample_name, self.subsample_name
         )
@@ -98,13 +148,32 @@ class FreshScanToVignettes(Job):
             scan_resolution,
             rois,
             self.scan_name,
+            self.progress,
         )
         # Multiples classification
         self.logger.info(f"Classifying thumbnails")
+        self.progress.start_stage("classify", len(rois))
         maybe_multiples, error = classify_all_images_from(
-            self.logger, cut_dir, self.scores_file, 0.4
+            self.logger,
+            cut_dir,
+            self.scores_file,
+            0.4,
+            rgb_cache_dir=modern_fs.rgb_cut_dir,
+            scores_cache=classifier_scores_cache(
+                self.logger, modern_fs.classifier_scores_path
+            ),
+            progress=self.progress.advance,
+            checkpoint=self.check_cancelled,
+            run_id=scores_run_id(self),
         )
         assert error is None, error
 
     def _cleanup_work(self):
         """Clean up the files that the present process is going to (re) create"""
+        self.modern_fs.remove_work_files(
+            self.msk_file_path,
+            self.modern_fs.cut_dir,
+            self.modern_fs.meta_dir / measure_file_name(self.scan_name),
+            self.scores_file,
+            content_keys_path(self.scores_file),
+        )
@@ -4,7 +4,7 @@ import shutil
 import zipfile
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import List, Dict, Any, Optional
 
 import cv2
 
@@ -22,14 +22,30 @@ from legacy.ids import (
     ecotaxa_tsv_file_name,
 )
 from legacy.scans import read_scans_metadata_table, find_scan_metadata
+from modern.features import compute_features
 from modern.filesystem import ModernScanFileSystem
 from modern.ids import scan_name_from_subsample_name, THE_SCAN_PER_SUBSAMPLE
 from modern.jobs.VignettesToAutoSep import (
     get_scan_and_backgrounds,
     convert_scan_and_backgrounds,
     produce_cuts_and_index,
+    persisted_subsample_params,
+    estimated_scan_memory_mb,
+    project_from_persisted,
+    scan_caches,
+    reuse_cuts,
+    FIRST_PASS_ROIS_STAGE,
+    BG_REMOVED_STAGE,
+    MEMMAP_SCAN,
 )
-from modern.tasks import Job
+from modern.regions import (
+    boxes_from_measures,
+    boxes_to_resegment,
+    resegment_regions,
+    roi_box,
+)
+from modern.tasks import Job, ExecutionModeEnum, ResourceClassEnum
+from modern.tiling import find_ROIs
 from providers.EcoTaxa.ecotaxa_model import AcquisitionModel
 from providers.ImageList import ImageList
 from providers.ecotaxa_client import EcoTaxaApiClient
@@ -37,6 +53,18 @@ from providers.ecotaxa_tsv import EcoTaxaTSV
 
 
 class VerifiedSeparationToEcoTaxa(Job):
+    # Re-segmentation and features computation are CPU-bound
+    execution_mode = ExecutionModeEnum.Process
+    resource_class = ResourceClassEnum.CPUHeavy
+    stages = [
+        "convert",
+        "bg-remove",
+        "segment",
+        "extract",
+        "features",
+        "zip",
+        "upload",
+    ]
 
     def __init__(
         self,
@@ -56,6 +84,36 @@ class VerifiedSeparationToEcoTaxa(Job):
         # Modern side
         self.modern_fs = ModernScanFileSystem(zoo_project, sample_name, subsample_name)
 
+    def estimated_memory_mb(self) -> int:
+        return estimated_scan_memory_mb(self.zoo_project, self.subsample_name)
+
+    def project_id(self) -> Optional[str]:
+        return str(self.zoo_project.path)
+
+    def persisted_params(self) -> Dict[str, Any]:
+        # The EcoTaxa token is not stored, so the job cannot be re-created from storage
+        return persisted_subsample_params(
+            self.zoo_project, self.sample_name, self.subsample_name
+        )
+
+    def worker_params(self) -> Dict[str, Any]:
+        ret = self.persisted_params()
+        ret["token"] = self.token
+        return ret
+
+    @classmethod
+    def from_persisted(
+        cls, params: Dict[str, Any]
+    ) -> Optional["VerifiedSeparationToEcoTaxa"]:
+        if params.get("token") is None:
+            return None
+        return cls(
+            project_from_persisted(params),
+            params["sample"],
+            params["subsample"],
+            params["token"],
+        )
+
     def prepare(self):
         """
         Start the job execution.
@@ -103,6 +161,7 @@ class VerifiedSeparationToEcoTaxa(Job):
         msk_file_name = mask_file_name(self.subsample_name)
         msk_file_path = meta_dir / msk_file_name
         measures = Measurements().read(meta_dir / measure_file_name(self.scan_name))
+        self.check_cancelled()
         generate_separator_gif(
             self.logger,
             measures,
@@ -121,34 +180,99 @@ class VerifiedSeparationToEcoTaxa(Job):
         raw_scan, bg_scans = get_scan_and_backgrounds(
             self.logger, self.zoo_project, self.subsample_name
         )
+        caches = scan_caches(self.zoo_project, modern_fs)
         scan_resolution, scan_without_background = convert_scan_and_backgrounds(
-            self.logger, processor, raw_scan, bg_scans
+            self.logger,
+            processor,
+            raw_scan,
+            bg_scans,
+            self.progress,
+            caches,
         )
         sep_image = load_image(sep_file_path, imread_mode=cv2.IMREAD_GRAYSCALE)
-        processed_scan_image = add_separated_mask(scan_without_background, sep_image)
-        self.logger.info(f"Segmenting")
-        rois, stats = processor.segmenter.find_ROIs_in_image(
-            processed_scan_image,
-            scan_resolution,
+        first_pass_rois = caches.scan.load_object(
+            FIRST_PASS_ROIS_STAGE, caches.scan_key(raw_scan, bg_scans)
         )
-        self.logger.info(f"Segmentation stats: {stats}")
+        boxes = boxes_from_measures(measures)
+        if first_pass_rois is not None and boxes != [
+            roi_box(a_roi) for a_roi in first_pass_rois
+        ]:
+            self.logger.info(f"Box measures do not match first segmentation")
+            first_pass_rois = None
+        touched: Optional[List[int]] = None
+        processed_scan_file: Optional[Path] = None
+        if first_pass_rois is not None:
+            touched = boxes_to_resegment(boxes, sep_image)
+            if touched is not None:
+                self.logger.info(
+                    f"Separators touch {len(touched)} of {len(first_pass_rois)} objects"
+                )
+        self.progress.start_stage("segment")
+        cut_after_dir = modern_fs.fresh_empty_cut_after_dir()
+        if first_pass_rois is not None and touched is not None:
+            # Objects and thumbnails outside separated ones stay the same
+            if touched:
+                processed_scan_image = add_separated_mask(
+                    scan_without_background, sep_image
+                )
+                self.logger.info(f"Segmenting around {len(touched)} objects")
+                rois, new_rois, stats = resegment_regions(
+                    processor.segmenter,
+                    processed_scan_image,
+                    scan_resolution,
+                    first_pass_rois,
+                    touched,
+                )
+                self.logger.info(f"Segmentation stats: {stats}")
+            else:
+                self.logger.info(f"No separation, reusing first segmentation")
+                processed_scan_image = scan_without_background
+                if MEMMAP_SCAN:
+                    # Unchanged, so the cached one is the same image
+                    processed_scan_file = caches.scan.file_of(
+                        BG_REMOVED_STAGE, caches.scan_key(raw_scan, bg_scans)
+                    )
+                rois, new_rois = first_pass_rois, []
+            self.check_cancelled()
+            to_extract = reuse_cuts(
+                self.logger, modern_fs.cut_dir, cut_after_dir, rois, new_rois
+            )
+        else:
+            processed_scan_image = add_separated_mask(
+                scan_without_background, sep_image
+            )
+            self.logger.info(f"Segmenting")
+            rois, stats = find_ROIs(
+                processor.segmenter, processed_scan_image, scan_resolution
+            )
+            self.logger.info(f"Segmentation stats: {stats}")
+            to_extract = rois
         produce_cuts_and_index(
             self.logger,
             processor,
-            modern_fs.fresh_empty_cut_after_dir(),
+            cut_after_dir,
             None,  # No meta needed
             processed_scan_image,
             scan_resolution,
-            rois,
+            to_extract,
             self.scan_name,
+            self.progress,
         )
         before_cuts = modern_fs.images_in_cut_dir()
         after_cuts = modern_fs.images_in_cut_after_dir()
         self.log_image_diffs(before_cuts, after_cuts)
         # Generate features
         self.logger.info(f"Generating features")
-        features = processor.calculator.ecotaxa_measures_list_from_roi_list(
-            processed_scan_image, scan_resolution, rois
+        self.progress.start_stage("features", len(rois))
+        features = compute_features(
+            processor,
+            self.persisted_params(),
+            modern_fs.cache_dir,
+            processed_scan_image,
+            scan_resolution,
+            rois,
+            self.progress,
+            processed_scan_file,
         )
         # Generate EcoTaxa data
         tsv_file_name = ecotaxa_tsv_file_name(self.subsample_name)
@@ -166,10 +290,12 @@ class VerifiedSeparationToEcoTaxa(Job):
             processor.segmenter,
             bg_scans,
         )
+        self.check_cancelled()
         tsv_gen.generate_into(tsv_file_path)
         # Build images zip
         zip_path = self.modern_fs.zip_for_upload
         self.logger.info(f"Building zip for EcoTaxa import into {zip_path}")
+        self.progress.start_stage("zip")
         images_zip = ImageList(modern_fs.cut_dir_after)
         zip_file = images_zip.zipped(self.logger, force_RGB=False, zip_path=zip_path)
         # Add the TSV file to the zip
@@ -178,6 +304,7 @@ class VerifiedSeparationToEcoTaxa(Job):
 
         # Upload the zip file into a directory, it automatically uncompresses there
         self.logger.info(f"Uploading zip to EcoTaxa")
+        self.progress.start_stage("upload")
         dest_user_dir = f"/{self.subsample_name}/"
         remote_ref = client.put_file(zip_file, dest_user_dir)
         self.logger.info(f"Zip file uploaded into {dest_user_dir} as {remote_ref}")
@@ -190,6 +317,7 @@ class VerifiedSeparationToEcoTaxa(Job):
             assert final_job_state.errors is not None
             assert False, "Job failed:" + "\n".join(final_job_state.errors)
 
+        self.check_cancelled()
         self.modern_fs.mark_upload_done(datetime.now())
 
     def adaptative_upload(
@@ -294,6 +422,13 @@ class VerifiedSeparationToEcoTaxa(Job):
 
     def _cleanup_work(self):
         """Clean up the files that the present process is going to (re) create"""
+        meta_dir = self.modern_fs.meta_dir
+        self.modern_fs.remove_work_files(
+            meta_dir / separator_file_name(self.subsample_name),
+            self.modern_fs.cut_dir_after,
+            meta_dir / ecotaxa_tsv_file_name(self.subsample_name),
+            self.modern_fs.zip_for_upload,
+        )
 
 
 def copy_to_legacy_work(
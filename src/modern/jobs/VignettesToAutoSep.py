@@ -1,26 +1,51 @@
 # Process a scan from its vignettes until auto separation
+import copy
 import os
+import queue
+import shutil
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from logging import Logger
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Any, NamedTuple, Deque
 
 import numpy as np
 
 from ZooProcess_lib.LegacyMeta import Measurements
 from ZooProcess_lib.Processor import Processor
 from ZooProcess_lib.ROI import ROI, unique_visible_key
-from ZooProcess_lib.ZooscanFolder import ZooscanProjectFolder
+from ZooProcess_lib.ZooscanFolder import ZooscanProjectFolder, ZooscanDrive
 from ZooProcess_lib.img_tools import get_creation_date
 from helpers.paths import count_files_in_dir
 from legacy.ids import measure_file_name
-from modern.filesystem import ModernScanFileSystem
+from modern.filesystem import ModernScanFileSystem, combined_backgrounds_dir
 from modern.ids import THE_SCAN_PER_SUBSAMPLE, scan_name_from_subsample_name
-from modern.tasks import Job
+from modern.stage_cache import (
+    StageCache,
+    files_fingerprint,
+    CombinedBackgroundCache,
+)
+from modern.parallel import map_concurrently
+from modern.tasks import (
+    Job,
+    ResourceClassEnum,
+    JobProgress,
+    eta_seconds,
+    JobCancelledError,
+)
 from providers.ImageList import ImageList
 from providers.ML_multiple_classifier import (
-    classify_all_images_from,
+    CLASSIFY_CHUNK_SIZE,
+    CLASSIFY_RETRIES,
+    checkpointed_scores,
+    content_keys,
+    classify_images_with_retries,
+    classifier_scores_cache,
+    likely_multiples,
     ping_classify_server,
+    save_scores,
 )
 from providers.ML_multiple_separator import (
     separate_all_images_from,
@@ -28,8 +53,19 @@ from providers.ML_multiple_separator import (
     ping_separator_server,
 )
 
+# Images per separator request
+SEPARATE_CHUNK_SIZE = 12
+# Separator requests running at the same time, and retries of each (configurable through env)
+SEPARATOR_IN_FLIGHT: int = int(os.getenv("SEPARATOR_IN_FLIGHT", "1"))
+SEPARATOR_RETRIES: int = int(os.getenv("SEPARATOR_RETRIES", "2"))
+# Classifier score above which an image is a likely multiple
+MIN_MULTIPLE_SCORE = 0.4
+
 
 class VignettesToAutoSeparated(Job):
+    # Most time is spent waiting for ML servers
+    resource_class = ResourceClassEnum.MLIO
+    stages = ["classify", "separate"]
 
     def __init__(
         self, zoo_project: ZooscanProjectFolder, sample_name: str, subsample_name: str
@@ -49,6 +85,20 @@ class VignettesToAutoSeparated(Job):
         self.multiples_dir: Path = self.modern_fs.multiples_vis_dir
         self.scores_file: Path = self.modern_fs.scores_file_path
 
+    def project_id(self) -> Optional[str]:
+        return str(self.zoo_project.path)
+
+    def persisted_params(self) -> Dict[str, Any]:
+        return persisted_subsample_params(
+            self.zoo_project, self.sample_name, self.subsample_name
+        )
+
+    @classmethod
+    def from_persisted(cls, params: Dict[str, Any]) -> "VignettesToAutoSeparated":
+        return cls(
+            project_from_persisted(params), params["sample"], params["subsample"]
+        )
+
     def prepare(self):
         """
         Start the job execution.
@@ -69,55 +119,241 @@ class VignettesToAutoSeparated(Job):
         ], f"Separator server is not responding"
 
     def run(self):
-        self.logger.info(f"Determining multiples")
-        # First ML step, send all images to the multiple classifier
-        maybe_multiples, error = classify_all_images_from(
-            self.logger, self.cut_dir, self.scores_file, 0.4
-        )
-        assert error is None, error
-
-        self.logger.info(f"Separating multiples (auto)")
-        # Second ML step, send potential multiples to the separator
+        self.logger.info(f"Determining and separating multiples")
         multiples_vis_dir = self.modern_fs.fresh_empty_multiples_vis_dir()
-        image_list = ImageList(self.cut_dir, [m.name for m in maybe_multiples])
-        # Send files by chunks to avoid the operator waiting too long with no feedback
+        # RGB conversions are kept, for this job's separator calls and next runs
+        rgb_cache_dir = self.modern_fs.rgb_cut_dir
+        image_list = ImageList(self.cut_dir, rgb_cache_dir=rgb_cache_dir)
+        self.progress.start_stage("classify", image_list.count())
+        # First ML step, send images by chunks to the multiple classifier, in the background
+        classified: queue.Queue = queue.Queue()
+        stop_classifying = threading.Event()
+        classifier = threading.Thread(
+            target=self.classify_by_chunks,
+            args=(image_list, classified, stop_classifying),
+            name=f"Job #{self.job_id} classifier",
+            daemon=True,
+        )
+        classifier.start()
+        # Second ML step, send potential multiples to the separator as soon as known.
+        # Files are sent by chunks to avoid the operator waiting too long with no feedback.
+        all_scores: Dict[str, float] = {}
+        all_keys: Dict[str, str] = {}
+        to_separate: List[str] = []
+        # Separator requests sent and not used yet, oldest first
+        in_flight: Deque[Tuple[ImageList, Future]] = deque()
+        separator = ThreadPoolExecutor(
+            max_workers=SEPARATOR_IN_FLIGHT,
+            thread_name_prefix=f"Job #{self.job_id} separator",
+        )
+        classifying = True
         processed = 0
-        to_process = len(image_list.get_images())
+        to_process = 0
         start_time = time.time()
-        for a_chunk in image_list.split(12):
-            results, error = separate_all_images_from(self.logger, a_chunk)
-            assert error is None, error
-            assert results is not None  # mypy
-            show_separations_in_images(self.cut_dir, results, multiples_vis_dir)
-            processed += len(a_chunk.get_images())
-            eta_str = self.compute_ETA(start_time, processed, to_process)
-            self.logger.info(
-                f"Processed {processed}/{to_process} images - ETA: {eta_str}"
-            )
+        try:
+            while classifying or len(to_separate) > 0 or len(in_flight) > 0:
+                # Send full chunks, or the last one, if the window allows
+                if len(in_flight) < SEPARATOR_IN_FLIGHT and (
+                    len(to_separate) >= SEPARATE_CHUNK_SIZE
+                    or (not classifying and len(to_separate) > 0)
+                ):
+                    a_chunk = ImageList(
+                        self.cut_dir,
+                        to_separate[:SEPARATE_CHUNK_SIZE],
+                        rgb_cache_dir=rgb_cache_dir,
+                    )
+                    del to_separate[:SEPARATE_CHUNK_SIZE]
+                    self.check_cancelled()
+                    a_request = separator.submit(
+                        separate_all_images_from,
+                        self.logger,
+                        a_chunk,
+                        SEPARATOR_RETRIES,
+                        self.check_cancelled,
+                    )
+                    in_flight.append((a_chunk, a_request))
+                    continue
+                # Use separations in sending order, for consistent progress and ETA
+                if len(in_flight) > 0 and (
+                    not classifying
+                    or len(in_flight) >= SEPARATOR_IN_FLIGHT
+                    or in_flight[0][1].done()
+                ):
+                    a_chunk, a_request = in_flight.popleft()
+                    # Stop waiting for the response if cancelled meanwhile
+                    while len(wait([a_request], timeout=1).done) == 0:
+                        self.check_cancelled()
+                    results, error = a_request.result()
+                    # The call might be long, don't write anything if cancelled meanwhile
+                    self.check_cancelled()
+                    assert error is None, error
+                    assert results is not None  # mypy
+                    show_separations_in_images(self.cut_dir, results, multiples_vis_dir)
+                    processed += len(a_chunk.get_images())
+                    if not classifying:
+                        self.progress.advance(len(a_chunk.get_images()))
+                    eta_str = self.compute_ETA(start_time, processed, to_process)
+                    self.logger.info(
+                        f"Processed {processed}/{to_process} images - ETA: {eta_str}"
+                    )
+                    continue
+                # Nothing to do but waiting for classifications
+                try:
+                    a_result = classified.get(timeout=0.1 if len(in_flight) > 0 else 1)
+                except queue.Empty:
+                    self.check_cancelled()
+                    continue
+                if a_result is None:
+                    classifying = False
+                    self.logger.info(f"Separating multiples (auto)")
+                    self.progress.start_stage("separate", to_process)
+                    self.progress.advance(processed)
+                    continue
+                chunk_scores, chunk_multiples, error = a_result
+                assert chunk_scores is not None, error
+                all_scores.update(chunk_scores)
+                all_keys.update(content_keys(image_list, chunk_scores))
+                # Checkpoint, for a next run to resume from there if this one fails
+                self.check_cancelled()
+                save_scores(self.scores_file, all_scores, all_keys, scores_run_id(self))
+                to_separate.extend(a_multiple.name for a_multiple in chunk_multiples)
+                to_process += len(chunk_multiples)
+                self.progress.advance(len(chunk_scores))
+        finally:
+            stop_classifying.set()
+            separator.shutdown(wait=False, cancel_futures=True)
+            # Nothing must be written by the classifier once the job is over
+            classifier.join()
 
         # Add some marker that all went fine
+        self.check_cancelled()
         self.modern_fs.mark_ML_separation_done()
 
+    def classify_by_chunks(
+        self,
+        image_list: ImageList,
+        classified: queue.Queue,
+        stop: threading.Event,
+    ) -> None:
+        """
+        Score the images by chunks, and queue each chunk's scores, likely multiples and error.
+        Scores checkpointed by a previous run are queued first, as a chunk.
+        A final None is queued when all chunks were successfully scored.
+        Once stop is set, nothing is queued anymore, and no request is sent.
+        Current thread: a dedicated one, so the separator can work meanwhile
+        """
+        try:
+            scores_cache = classifier_scores_cache(
+                self.logger, self.modern_fs.classifier_scores_path
+            )
+            resumed = checkpointed_scores(
+                self.scores_file, image_list, scores_cache, scores_run_id(self)
+            )
+            if len(resumed) > 0:
+                self.logger.info(
+                    f"Resuming classification, {len(resumed)} images already scored"
+                )
+                multiples = likely_multiples(resumed, image_list, MIN_MULTIPLE_SCORE)
+                classified.put((resumed, multiples, None))
+            to_classify = ImageList(
+                image_list.directory_path,
+                [a_name for a_name in image_list.get_images() if a_name not in resumed],
+                rgb_cache_dir=image_list.rgb_cache_dir,
+            )
+
+            def checkpoint() -> None:
+                if stop.is_set():
+                    raise JobCancelledError()
+                self.check_cancelled()
+
+            for a_chunk in to_classify.split(CLASSIFY_CHUNK_SIZE):
+                if stop.is_set() or self.cancel_token.is_cancelled():
+                    return
+                scores, error = classify_images_with_retries(
+                    self.logger,
+                    a_chunk,
+                    scores_cache,
+                    CLASSIFY_RETRIES,
+                    checkpoint,
+                )
+                if scores is None:
+                    classified.put((None, [], error))
+                    return
+                multiples = likely_multiples(scores, a_chunk, MIN_MULTIPLE_SCORE)
+                classified.put((scores, multiples, None))
+        except JobCancelledError:
+            return
+        except Exception as e:
+            classified.put((None, [], f"Classification failed: {str(e)}"))
+            return
+        classified.put(None)
+
     @staticmethod
     def compute_ETA(start_time: float, processed: int, to_process: int) -> str:
         # Calculate ETA
-        if processed > 0 and to_process > 0:
-            elapsed_time = time.time() - start_time
-            images_per_second = processed / elapsed_time
-            remaining_images = to_process - processed
-            eta_seconds = (
-                remaining_images / images_per_second if images_per_second > 0 else 0
-            )
+        eta_secs = eta_seconds(start_time, processed, to_process)
+        if eta_secs is not None:
             # Format ETA as minutes and seconds
-            eta_minutes = int(eta_seconds // 60)
-            eta_seconds_remainder = int(eta_seconds % 60)
+            eta_minutes = int(eta_secs // 60)
+            eta_seconds_remainder = int(eta_secs % 60)
             eta_str = f"{eta_minutes}m {eta_seconds_remainder}s"
         else:
             eta_str = "unknown"
         return eta_str
 
     def _cleanup_work(self):
-        """Cleanup the files that the present process is going to (re) create"""
+        """
+        Cleanup the files that the present process is going to (re) create.
+        Scores are kept, for a next run to resume from them.
+        """
+        self.modern_fs.remove_work_files(
+            self.multiples_dir,
+            self.modern_fs.SEP_generated_file_path,
+        )
+
+
+def scores_run_id(job: Job) -> str:
+    """
+    Identifies the classification done by the job, for resuming it when the classifier model is unknown.
+    Another job with the same params does the same classification, e.g. after a failure.
+    """
+    return f"{type(job).__name__} {job.params_key()}"
+
+
+def persisted_subsample_params(
+    zoo_project: ZooscanProjectFolder, sample_name: str, subsample_name: str
+) -> Dict[str, Any]:
+    """Storable form of the parameters shared by subsample jobs"""
+    return {
+        "drive": str(zoo_project.path.parent),
+        "project": zoo_project.path.name,
+        "sample": sample_name,
+        "subsample": subsample_name,
+    }
+
+
+def project_from_persisted(params: Dict[str, Any]) -> ZooscanProjectFolder:
+    """Reverse of persisted_subsample_params, for the project part"""
+    return ZooscanDrive(Path(params["drive"])).get_project_folder(params["project"])
+
+
+# Peak RAM per byte of RAW scan file, during conversion and background removal:
+# 16-bit RAW, 8-bit scan, combined background and background-removed image, plus some margin
+MEMORY_PER_RAW_BYTE = 3
+
+
+def estimated_scan_memory_mb(
+    zoo_project: ZooscanProjectFolder, subsample_name: str
+) -> int:
+    """Estimate RAM needed for processing the full scan of a subsample, from its RAW file size"""
+    raw_scan = zoo_project.zooscan_scan.raw.get_file(
+        subsample_name, THE_SCAN_PER_SUBSAMPLE
+    )
+    try:
+        raw_size = raw_scan.stat().st_size
+    except OSError:
+        return 0
+    return raw_size * MEMORY_PER_RAW_BYTE // (1024 * 1024)
 
 
 def generate_box_measures(rois: List[ROI], scan_name: str, meta_file: Path) -> None:
@@ -172,31 +408,201 @@ def get_scan_and_backgrounds(
     return raw_scan, bg_scans
 
 
-def convert_scan_and_backgrounds(
-    logger: Logger, processor: Processor, raw_scan: Path, bg_scans: List[Path]
-):
-    logger.info(f"Converting backgrounds")
-    bg_converted_files = [
-        processor.converter.do_file_to_image(a_raw_bg_file, True)
-        for a_raw_bg_file in bg_scans
-    ]
-    logger.info(f"Combining backgrounds")
-    combined_bg_image, bg_resolution = processor.bg_combiner.do_from_images(
-        bg_converted_files
+# Cached stage outputs
+BG_REMOVED_STAGE = "bg_removed_scan"
+FIRST_PASS_ROIS_STAGE = "first_pass_rois"
+# Concurrent RAW conversions inside a job, and their memory cap, 0 for none (configurable through env)
+CONVERSION_WORKERS: int = int(os.getenv("CONVERSION_WORKERS", "3"))
+CONVERSION_MEMORY_MB: int = int(os.getenv("CONVERSION_MEMORY_MB", "0"))
+# Keep the scan with background removed as a memory-mapped file in work dir (configurable through env)
+MEMMAP_SCAN: bool = os.getenv("MEMMAP_SCAN", "1") == "1"
+# Concurrent thumbnail extractions inside a job, and ROIs per extraction (configurable through env)
+# The PNG compression level of thumbnails is not configurable: the extractor does not expose it
+EXTRACTION_WORKERS: int = int(os.getenv("EXTRACTION_WORKERS", "4"))
+EXTRACTION_SHARD_SIZE: int = int(os.getenv("EXTRACTION_SHARD_SIZE", "250"))
+
+
+def config_fingerprint(zoo_project: ZooscanProjectFolder) -> str:
+    """Identify the processing configuration, incl. LUT, of the project"""
+    config_files = sorted(a_path for a_path in zoo_project.zooscan_config.list())
+    return files_fingerprint([a_path for a_path in config_files if a_path.is_file()])
+
+
+class ScanCaches(NamedTuple):
+    scan: StageCache  # The subsample's intermediate images
+    backgrounds: CombinedBackgroundCache  # Shared by all subsamples of the project
+
+    def scan_key(self, raw_scan: Path, bg_scans: List[Path]) -> str:
+        """Key of the stages computed from the scan and its backgrounds"""
+        return self.scan.key_for(bg_scans + [raw_scan])
+
+
+def scan_caches(
+    zoo_project: ZooscanProjectFolder, modern_fs: ModernScanFileSystem
+) -> ScanCaches:
+    """Caches of intermediate images, valid while the project config is unchanged"""
+    return ScanCaches(
+        StageCache(modern_fs.cache_dir, config_fingerprint(zoo_project)),
+        CombinedBackgroundCache.for_dir(combined_backgrounds_dir(zoo_project)),
     )
-    # Scan pre-processing
-    logger.info(f"Converting scan")
-    eight_bit_scan_image, scan_resolution = processor.converter.do_file_to_image(
-        raw_scan, False
+
+
+def convert_raw_files(
+    processor: Processor,
+    raw_files: List[Tuple[Path, bool]],
+    progress: JobProgress,
+) -> List[Tuple[np.ndarray, int]]:
+    """
+    Convert RAW files, each one flagged if it's a background, concurrently within configured limits.
+    """
+
+    def convert(a_raw_file: Tuple[Path, bool]) -> Tuple[np.ndarray, int]:
+        return processor.converter.do_file_to_image(*a_raw_file)
+
+    def memory_mb_of(a_raw_file: Tuple[Path, bool]) -> int:
+        # 16-bit decoded image and its 8-bit conversion
+        return a_raw_file[0].stat().st_size * 3 // 2 // (1024 * 1024)
+
+    return map_concurrently(
+        convert,
+        raw_files,
+        CONVERSION_WORKERS,
+        memory_mb_of,
+        CONVERSION_MEMORY_MB,
+        on_done=lambda _: progress.advance(),
     )
+
+
+def convert_scan_and_backgrounds(
+    logger: Logger,
+    processor: Processor,
+    raw_scan: Path,
+    bg_scans: List[Path],
+    progress: JobProgress,
+    caches: Optional[ScanCaches] = None,
+):
+    scan_key = bg_key = ""
+    cached_bg = None
+    if caches is not None:
+        if MEMMAP_SCAN:
+            scan_key = caches.scan_key(raw_scan, bg_scans)
+            cached_scan = caches.scan.load(BG_REMOVED_STAGE, scan_key)
+            if cached_scan is not None:
+                logger.info(f"Reusing scan with background removed, unchanged inputs")
+                progress.start_stage("bg-remove")
+                image, meta = cached_scan
+                return meta["resolution"], image
+        # Same key scheme as for the scan stages
+        bg_key = caches.scan.key_for(bg_scans)
+        cached_bg = caches.backgrounds.get(bg_key)
+    progress.start_stage("convert", len(bg_scans) + 1)
+    # Scan and backgrounds conversions are independent
+    to_convert = [(raw_scan, False)]
+    if cached_bg is not None:
+        logger.info(f"Reusing combined background, inputs did not change")
+        progress.advance(len(bg_scans))
+        logger.info(f"Converting scan")
+    else:
+        logger.info(f"Converting scan and backgrounds")
+        to_convert += [(a_raw_bg_file, True) for a_raw_bg_file in bg_scans]
+    converted = convert_raw_files(processor, to_convert, progress)
+    eight_bit_scan_image, scan_resolution = converted[0]
+    if cached_bg is not None:
+        combined_bg_image, bg_resolution = cached_bg
+    else:
+        logger.info(f"Combining backgrounds")
+        combined_bg_image, bg_resolution = processor.bg_combiner.do_from_images(
+            converted[1:]
+        )
+        if caches is not None:
+            caches.backgrounds.put(bg_key, combined_bg_image, bg_resolution)
+    # Backgrounds are not needed anymore
+    del converted
     # Background removal
     logger.info(f"Removing background")
+    progress.start_stage("bg-remove")
     scan_without_background = processor.bg_remover.do_from_images(
         combined_bg_image, bg_resolution, eight_bit_scan_image, scan_resolution
     )
+    if caches is not None and MEMMAP_SCAN:
+        caches.scan.save(
+            BG_REMOVED_STAGE,
+            scan_key,
+            scan_without_background,
+            {"resolution": scan_resolution},
+        )
+        # Continue from the file, so the heap copy is released and pages are shared with other readers
+        mapped = caches.scan.load(BG_REMOVED_STAGE, scan_key)
+        if mapped is not None:
+            scan_without_background = mapped[0]
     return scan_resolution, scan_without_background
 
 
+def reuse_cuts(
+    logger: Logger,
+    from_dir: Path,
+    thumbs_dir: Path,
+    rois: List[ROI],
+    changed_rois: List[ROI],
+) -> List[ROI]:
+    """
+    Populate thumbs_dir with the thumbnails extracted before for unchanged ROIs, hard-linked if possible.
+    Returns the ROIs which need extraction, i.e. changed ones and the ones without previous thumbnail.
+    """
+    changed = set(id(a_roi) for a_roi in changed_rois)
+    ret = []
+    for a_roi in rois:
+        if id(a_roi) in changed:
+            ret.append(a_roi)
+            continue
+        thumb_name = unique_visible_key(a_roi) + ".png"
+        try:
+            os.link(from_dir / thumb_name, thumbs_dir / thumb_name)
+        except FileNotFoundError:
+            ret.append(a_roi)
+        except OSError:
+            shutil.copy2(from_dir / thumb_name, thumbs_dir / thumb_name)
+    logger.info(f"Reused {len(rois) - len(ret)} thumbnails")
+    return ret
+
+
+def extract_cuts(
+    processor: Processor,
+    thumbs_dir: Path,
+    image: np.ndarray,
+    image_resolution: int,
+    rois: List[ROI],
+    scan_name: str,
+    progress: JobProgress,
+) -> None:
+    """
+    Write the thumbnails of the ROIs, by shards extracted concurrently, as PNG encoding dominates.
+    Thumbnail names depend only on their ROI, as reuse_cuts expects, so shards can write into the same
+    directory. Each shard gets its own copy of the extractor, which is not known to be thread-safe.
+    """
+    shards = [
+        rois[start : start + EXTRACTION_SHARD_SIZE]
+        for start in range(0, len(rois), max(EXTRACTION_SHARD_SIZE, 1))
+    ]
+
+    def extract(a_shard: List[ROI]) -> None:
+        progress.check_cancelled()
+        copy.deepcopy(processor.extractor).extract_all_with_border_to_dir(
+            image,
+            image_resolution,
+            a_shard,
+            thumbs_dir,
+            scan_name,
+        )
+
+    map_concurrently(
+        extract,
+        shards,
+        EXTRACTION_WORKERS,
+        on_done=lambda a_shard: progress.advance(len(a_shard)),
+    )
+
+
 def produce_cuts_and_index(
     logger: Logger,
     processor: Processor,
@@ -206,18 +612,17 @@ def produce_cuts_and_index(
     image_resolution: int,
     rois: List[ROI],
     scan_name: str,
+    progress: JobProgress,
 ) -> None:
     # Thumbnail generation
     logger.info(f"Extracting")
     logger.debug(f"Extracting to {thumbs_dir}")
-    processor.extractor.extract_all_with_border_to_dir(
-        image,
-        image_resolution,
-        rois,
-        thumbs_dir,
-        scan_name,
+    progress.start_stage("extract", len(rois))
+    extract_cuts(
+        processor, thumbs_dir, image, image_resolution, rois, scan_name, progress
     )
     # Index generation
     if meta_dir is not None:
+        progress.check_cancelled()
         os.makedirs(meta_dir, exist_ok=True)
         generate_box_measures(rois, scan_name, meta_dir / measure_file_name(scan_name))
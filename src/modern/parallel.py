@@ -0,0 +1,91 @@
+# Concurrent execution of independent parts of a job
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, TypeVar, Dict
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MemoryGate:
+    """
+    Limit the total estimated memory of concurrent tasks to a budget, 0 meaning no limit.
+    A task is always let in when nothing else runs, even if above the budget.
+    """
+
+    def __init__(self, budget_mb: int):
+        self.budget_mb = budget_mb
+        self.used_mb = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, memory_mb: int) -> Iterator[None]:
+        if self.budget_mb <= 0:
+            yield
+            return
+        with self.condition:
+            while self.used_mb > 0 and self.used_mb + memory_mb > self.budget_mb:
+                self.condition.wait()
+            self.used_mb += memory_mb
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used_mb -= memory_mb
+                self.condition.notify_all()
+
+
+def map_concurrently(
+    fn: Callable[[T], R],
+    items: List[T],
+    workers: int,
+    memory_mb_of: Optional[Callable[[T], int]] = None,
+    budget_mb: int = 0,
+    on_done: Optional[Callable[[T], None]] = None,
+) -> List[R]:
+    """
+    Apply fn to all items using up to workers threads, and return the results in items order.
+    Suitable for work which releases the GIL, e.g. image decoding or numpy operations.
+
+    Args:
+        fn: The function to apply.
+        items: Its arguments.
+        workers: Maximum number of concurrent calls, 1 means sequential in the current thread.
+        memory_mb_of: Estimated peak memory of a call, for keeping concurrent ones under budget_mb.
+        budget_mb: Memory budget of concurrent calls, 0 for no limit.
+        on_done: Called in the current thread after each call completed.
+
+    Raises:
+        The first exception raised by a call, after the ones already started are done.
+    """
+    if workers <= 1 or len(items) <= 1:
+        ret = []
+        for an_item in items:
+            ret.append(fn(an_item))
+            if on_done is not None:
+                on_done(an_item)
+        return ret
+    gate = MemoryGate(budget_mb if memory_mb_of is not None else 0)
+
+    def gated(an_item: T) -> R:
+        memory_mb = memory_mb_of(an_item) if memory_mb_of is not None else 0
+        with gate.reserve(memory_mb):
+            return fn(an_item)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures: Dict[Future, int] = {
+            executor.submit(gated, an_item): idx for idx, an_item in enumerate(items)
+        }
+        results: Dict[int, R] = {}
+        try:
+            for a_future in as_completed(futures):
+                idx = futures[a_future]
+                results[idx] = a_future.result()
+                if on_done is not None:
+                    on_done(items[idx])
+        except BaseException:
+            for a_future in futures:
+                a_future.cancel()
+            raise
+    return [results[idx] for idx in range(len(items))]
@@ -0,0 +1,176 @@
+# Processing limited to the parts of a scan changed by manual separation
+import copy
+import os
+from typing import List, Tuple, Any, Optional
+
+import numpy as np
+
+from ZooProcess_lib.LegacyMeta import Measurements
+from ZooProcess_lib.ROI import ROI
+from ZooProcess_lib.Segmenter import Segmenter
+
+# Re-segment only around separated objects, instead of the whole scan (configurable through env)
+RESEGMENT_REGIONS: bool = os.getenv("RESEGMENT_REGIONS", "0") == "1"
+# Pixels added around separated objects when re-segmenting them
+REGION_MARGIN_PX = 32
+
+# Top, left, bottom and right (both excluded) coordinates in an image
+Box = Tuple[int, int, int, int]
+
+
+def roi_box(roi: ROI) -> Box:
+    """Bounding box of the ROI in its image"""
+    height, width = roi.mask.shape
+    return roi.y, roi.x, roi.y + height, roi.x + width
+
+
+def boxes_from_measures(measures: Measurements) -> List[Box]:
+    """Bounding boxes of the objects in box measures, in their order"""
+    ret = []
+    for a_row in measures.data_rows:
+        left, top = int(a_row["BX"]), int(a_row["BY"])
+        width, height = int(a_row["Width"]), int(a_row["Height"])
+        ret.append((top, left, top + height, left + width))
+    return ret
+
+
+def contains(outer: Box, inner: Box) -> bool:
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and inner[2] <= outer[2]
+        and inner[3] <= outer[3]
+    )
+
+
+def overlap(box1: Box, box2: Box) -> bool:
+    return (
+        box1[0] < box2[2]
+        and box2[0] < box1[2]
+        and box1[1] < box2[3]
+        and box2[1] < box1[3]
+    )
+
+
+def has_separators(sep_image: np.ndarray) -> bool:
+    """The separator image has at least one drawn pixel, i.e. it changes the scan"""
+    return bool(sep_image.any())
+
+
+def boxes_touched_by_separators(boxes: List[Box], sep_image: np.ndarray) -> List[int]:
+    """
+    Indexes of the boxes containing at least one separator pixel.
+    Separator pixels are the non-zero ones of the separator image.
+    """
+    ret = []
+    for idx, (top, left, bottom, right) in enumerate(boxes):
+        if sep_image[top:bottom, left:right].any():
+            ret.append(idx)
+    return ret
+
+
+def rois_touched_by_separators(rois: List[ROI], sep_image: np.ndarray) -> List[int]:
+    """Indexes of the ROIs whose bounding box contains at least one separator pixel"""
+    return boxes_touched_by_separators([roi_box(a_roi) for a_roi in rois], sep_image)
+
+
+def boxes_to_resegment(boxes: List[Box], sep_image: np.ndarray) -> Optional[List[int]]:
+    """
+    Indexes of the first segmentation boxes to segment again after separation, None if the whole
+    scan has to be. Unless RESEGMENT_REGIONS, the first segmentation is reused only without any separator.
+    """
+    if RESEGMENT_REGIONS:
+        return boxes_touched_by_separators(boxes, sep_image)
+    return None if has_separators(sep_image) else []
+
+
+def windows_around(
+    boxes: List[Box], margin: int, shape: Tuple[int, ...]
+) -> List[Tuple[Box, List[Box]]]:
+    """
+    Image windows containing the boxes with a margin around, each with the boxes inside it.
+    Overlapping windows are merged, so no image area is segmented twice.
+    """
+    height, width = shape[:2]
+    windows = [
+        (
+            (
+                max(top - margin, 0),
+                max(left - margin, 0),
+                min(bottom + margin, height),
+                min(right + margin, width),
+            ),
+            [(top, left, bottom, right)],
+        )
+        for top, left, bottom, right in boxes
+    ]
+    merged = True
+    while merged:
+        merged = False
+        ret: List[Tuple[Box, List[Box]]] = []
+        for a_window, its_boxes in windows:
+            for idx, (other_window, other_boxes) in enumerate(ret):
+                if overlap(a_window, other_window):
+                    ret[idx] = (
+                        (
+                            min(a_window[0], other_window[0]),
+                            min(a_window[1], other_window[1]),
+                            max(a_window[2], other_window[2]),
+                            max(a_window[3], other_window[3]),
+                        ),
+                        other_boxes + its_boxes,
+                    )
+                    merged = True
+                    break
+            else:
+                ret.append((a_window, its_boxes))
+        windows = ret
+    return windows
+
+
+def shifted_roi(roi: ROI, rows: int, cols: int) -> ROI:
+    """The ROI moved down and right by given rows and columns"""
+    ret = copy.copy(roi)
+    ret.y = roi.y + rows
+    ret.x = roi.x + cols
+    return ret
+
+
+def resegment_regions(
+    segmenter: Segmenter,
+    image: np.ndarray,
+    resolution: int,
+    rois: List[ROI],
+    touched: List[int],
+) -> Tuple[List[ROI], List[ROI], List[Any]]:
+    """
+    Segment again only the windows around touched ROIs, and merge the result with the other ROIs.
+    Separators only clear pixels, so the objects they produce lie inside the box of the separated one.
+    Windows are segmented as cropped images, objects found inside a touched box replace the ROIs
+    inside it, and ROIs elsewhere are kept as they are.
+
+    Returns:
+        All ROIs ordered by position, the ones re-segmented, and segmentation stats of each window.
+    """
+    touched_boxes = [roi_box(rois[idx]) for idx in touched]
+    kept = [
+        a_roi
+        for a_roi in rois
+        if not any(contains(a_box, roi_box(a_roi)) for a_box in touched_boxes)
+    ]
+    new_rois: List[ROI] = []
+    stats = []
+    for (top, left, bottom, right), its_boxes in windows_around(
+        touched_boxes, REGION_MARGIN_PX, image.shape
+    ):
+        window_rois, window_stats = segmenter.find_ROIs_in_cropped_image(
+            image[top:bottom, left:right], resolution
+        )
+        for a_roi in window_rois:
+            a_roi = shifted_roi(a_roi, top, left)
+            if any(contains(a_box, roi_box(a_roi)) for a_box in its_boxes):
+                new_rois.append(a_roi)
+        stats.append(window_stats)
+    ret = kept + new_rois
+    ret.sort(key=lambda a_roi: (a_roi.y, a_roi.x))
+    return ret, new_rois, stats
@@ -0,0 +1,259 @@
+# Persistence of intermediate images between runs of image processing stages
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple, Dict, Any
+
+import numpy as np
+
+from helpers.logger import logger
+
+# Content sampled when fingerprinting files: count and size of the read blocks
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+# Combined backgrounds kept in memory per process, and on disk per project (configurable through env).
+# Jobs running in their own process, the default for image processing, only share the disk ones.
+BG_CACHE_IN_MEMORY: int = int(os.getenv("BG_CACHE_IN_MEMORY", "2"))
+BG_CACHE_ON_DISK: int = int(os.getenv("BG_CACHE_ON_DISK", "20"))
+
+
+def file_fingerprint(path: Path) -> str:
+    """
+    Identify the content of a file from its status and evenly spaced samples of its content.
+    Status change time is part of it, as it follows any write, even when the modification time is
+    restored. So a touched file is a new one, and big RAW scans are not read in full by each job process.
+    """
+    stat = path.stat()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        f"{path.name}|{stat.st_ino}|{stat.st_size}|{stat.st_mtime_ns}|{stat.st_ctime_ns}".encode()
+    )
+    with open(path, "rb") as f:
+        if stat.st_size <= FINGERPRINT_SAMPLES * FINGERPRINT_SAMPLE_SIZE:
+            digest.update(f.read())
+        else:
+            step = (stat.st_size - FINGERPRINT_SAMPLE_SIZE) // (FINGERPRINT_SAMPLES - 1)
+            for i in range(FINGERPRINT_SAMPLES):
+                f.seek(i * step)
+                digest.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def files_fingerprint(paths: List[Path]) -> str:
+    """
+    Identify the content of several files, in given order.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for a_path in paths:
+        digest.update(file_fingerprint(a_path).encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Output images of processing stages, stored as .npy files in a directory, each with a JSON
+    sidecar holding the key it was computed for and some metadata.
+    Keys combine the fingerprints of input files and of the processing configuration, so a
+    cached image is valid as long as its key is the one computed from current inputs.
+    """
+
+    def __init__(self, cache_dir: Path, config_fingerprint: str):
+        self.cache_dir = cache_dir
+        self.config_fingerprint = config_fingerprint
+
+    def key_for(self, inputs: List[Path]) -> str:
+        """
+        Key of a stage output computed from given input files.
+        """
+        return f"{self.config_fingerprint}-{files_fingerprint(inputs)}"
+
+    def _paths(self, stage: str) -> Tuple[Path, Path]:
+        return self.cache_dir / f"{stage}.npy", self.cache_dir / f"{stage}.json"
+
+    def load(self, stage: str, key: str) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+        """
+        Get the stage output and its metadata, if computed for this key.
+        The image is memory-mapped copy-on-write, so it's read lazily and changes stay in memory.
+        """
+        image_path, meta_path = self._paths(stage)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("key") != key:
+                return None
+            image = np.load(image_path, mmap_mode="c")
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f"Unreadable cache for {stage} in {self.cache_dir}: {e}")
+            return None
+        return image, meta
+
+    def file_of(self, stage: str, key: str) -> Optional[Path]:
+        """
+        The .npy file of the stage output, if computed for this key, e.g. for other processes to map it.
+        """
+        image_path, meta_path = self._paths(stage)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return image_path if meta.get("key") == key else None
+
+    def save(
+        self, stage: str, key: str, image: np.ndarray, meta: Dict[str, Any]
+    ) -> None:
+        """
+        Store the stage output for this key, replacing any previous one.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        image_path, meta_path = self._paths(stage)
+        # The sidecar goes last and is removed first, so a present one always matches its image
+        meta_path.unlink(missing_ok=True)
+        tmp_path = image_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp_path, image_path)
+        with open(meta_path, "w") as f:
+            json.dump(dict(meta, key=key), f)
+
+    def load_object(self, stage: str, key: str) -> Optional[Any]:
+        """
+        Get the stage output, if computed for this key, for non-image outputs.
+        """
+        object_path = self.cache_dir / f"{stage}.pkl"
+        try:
+            with open(object_path, "rb") as f:
+                stored_key, ret = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, ValueError, EOFError) as e:
+            logger.warning(f"Unreadable cache for {stage} in {self.cache_dir}: {e}")
+            return None
+        return ret if stored_key == key else None
+
+    def save_object(self, stage: str, key: str, value: Any) -> None:
+        """
+        Store the stage output for this key, for non-image outputs.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        object_path = self.cache_dir / f"{stage}.pkl"
+        tmp_path = object_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, object_path)
+
+
+def compact(image: np.ndarray) -> np.ndarray:
+    """
+    The image as uint8 if it can be without loss, otherwise unchanged.
+    """
+    if image.dtype == np.uint8 or image.size == 0:
+        return image
+    if image.min() < 0 or image.max() > 255:
+        return image
+    ret = image.astype(np.uint8)
+    if not np.array_equal(ret, image):
+        return image
+    return ret
+
+
+class CombinedBackgroundCache:
+    """
+    Combined backgrounds of a project, keyed by their background files and processing configuration.
+    Scans of the same day share their backgrounds, so the combination is done once for all of them.
+    Most recently used entries are kept on disk as compact .npy files, which is what job processes share.
+    They are also kept in memory, which only helps jobs running in threads of the same process.
+    Images given out are read-only views, as they are shared between jobs. Images put in are not
+    copied, so callers must not change them afterwards.
+    """
+
+    # One cache per directory in a process
+    instances: Dict[Path, "CombinedBackgroundCache"] = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self.in_memory: OrderedDict[str, Tuple[np.ndarray, int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_dir(cls, cache_dir: Path) -> "CombinedBackgroundCache":
+        with cls.instances_lock:
+            ret = cls.instances.get(cache_dir)
+            if ret is None:
+                ret = cls.instances[cache_dir] = CombinedBackgroundCache(cache_dir)
+            return ret
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.cache_dir / f"{key}.npy", self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, int]]:
+        """
+        Get the combined background and its resolution, if present for this key.
+        """
+        with self.lock:
+            ret = self.in_memory.get(key)
+            if ret is not None:
+                self.in_memory.move_to_end(key)
+                return ret
+        image_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            image = np.load(image_path).astype(meta["dtype"], copy=False)
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f"Unreadable combined background {image_path}: {e}")
+            return None
+        # Keep track of usage for eviction from disk
+        os.utime(meta_path)
+        ret = (image, meta["resolution"])
+        self._remember(key, ret)
+        return ret
+
+    def put(self, key: str, image: np.ndarray, resolution: int) -> None:
+        """
+        Store the combined background for this key.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        image_path, meta_path = self._paths(key)
+        # Several processes might compute the same background at the same time
+        tmp_path = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, compact(image))
+        os.replace(tmp_path, image_path)
+        with open(meta_path, "w") as f:
+            json.dump({"resolution": resolution, "dtype": str(image.dtype)}, f)
+        self._remember(key, (image, resolution))
+        self._prune_disk()
+
+    def _remember(self, key: str, entry: Tuple[np.ndarray, int]) -> None:
+        # A read-only view, the caller keeps its array as it was
+        image = entry[0].view()
+        image.setflags(write=False)
+        entry = (image, entry[1])
+        with self.lock:
+            self.in_memory[key] = entry
+            self.in_memory.move_to_end(key)
+            while len(self.in_memory) > BG_CACHE_IN_MEMORY:
+                self.in_memory.popitem(last=False)
+
+    def _prune_disk(self) -> None:
+        """Remove least recently used entries above the limit."""
+        try:
+            metas = sorted(
+                self.cache_dir.glob("*.json"),
+                key=lambda a_path: a_path.stat().st_mtime,
+                reverse=True,
+            )
+            for a_meta in metas[BG_CACHE_ON_DISK:]:
+                a_meta.unlink(missing_ok=True)
+                a_meta.with_suffix(".npy").unlink(missing_ok=True)
+        except OSError as e:
+            # Another process pruning at the same time
+            logger.warning(f"Could not prune {self.cache_dir}: {e}")
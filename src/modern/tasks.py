@@ -2,25 +2,38 @@
 # This file is part of Ecotaxa, see license.md in the application root directory for license informations.
 # Copyright (C) 2015-2021  Picheral, Colin, Irisson (UPMC-CNRS)
 #
+import importlib
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import threading
 import time
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 from logging import Logger
 from pathlib import Path
 from threading import Thread, Event
-from typing import Any, Optional, Tuple, List, Callable
+from typing import Any, Optional, Tuple, List, Callable, Dict, Type
 
 from helpers.logger import logger, logs_dir, NullLogger
+from local_DB.job_store import JobStore
+from local_DB.models import PersistedJob
 
 # Typings, to be clear that these are not e.g. task IDs
 JobIDT = int
 
 # Concurrency cap (configurable through env)
 MAX_CONCURRENCY: int = int(os.getenv("JOB_MAX_CONCURRENCY", "4"))
+# Allow CPU-bound jobs to run in their own process (configurable through env)
+USE_PROCESSES: bool = os.getenv("JOB_USE_PROCESSES", "1") == "1"
+# Estimated RAM available to all running jobs, 0 for no limit (configurable through env)
+MEMORY_BUDGET_MB: int = int(os.getenv("JOB_MEMORY_BUDGET_MB", "0"))
+# Done jobs are forgotten from memory after this delay, or when more than this count (configurable through env)
+RETENTION_HOURS: float = float(os.getenv("JOB_RETENTION_HOURS", "24"))
+RETENTION_COUNT: int = int(os.getenv("JOB_RETENTION_COUNT", "500"))
 
 
 class JobStateEnum(str, Enum):
@@ -30,16 +43,319 @@ class JobStateEnum(str, Enum):
     Finished = "F"  # Done
 
 
+class ExecutionModeEnum(str, Enum):
+    Thread = "thread"  # In a thread of the server process, for I/O-bound jobs
+    Process = "process"  # In a dedicated process, for CPU-bound jobs
+
+
+class ResourceClassEnum(str, Enum):
+    CPUHeavy = "cpu_heavy"  # Full-scan image processing, needs cores and lots of RAM
+    MLIO = "ml_io"  # Mostly waiting for ML servers
+    Other = "other"
+
+
+class JobPriorityEnum(int, Enum):
+    Interactive = 0  # An operator is waiting for the result
+    Normal = 1
+    Batch = 2  # Bulk (re-)processing, can wait
+
+
+# Slots per resource class, all within MAX_CONCURRENCY (configurable through env)
+RESOURCE_SLOTS: Dict[ResourceClassEnum, int] = {
+    ResourceClassEnum.CPUHeavy: int(
+        os.getenv("JOB_SLOTS_CPU_HEAVY", str(max(MAX_CONCURRENCY // 2, 1)))
+    ),
+    ResourceClassEnum.MLIO: int(os.getenv("JOB_SLOTS_ML_IO", str(MAX_CONCURRENCY))),
+    ResourceClassEnum.Other: MAX_CONCURRENCY,
+}
+
+JobListener = Callable[["Job"], None]
+
+# Last log line of cancelled jobs
+CANCELLED_MSG = "Cancelled by user"
+
+
+class JobCancelledError(Exception):
+    """
+    Raised inside a job, at a cancellation point, when its cancellation was requested.
+    """
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag, set from the outside and checked by the job at safe points.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise JobCancelledError()
+
+
+def eta_seconds(start_time: float, processed: int, to_process: int) -> Optional[float]:
+    """
+    Estimated remaining time for processing to_process units, if processed ones took since start_time.
+    None if there is not enough information.
+    """
+    if processed > 0 and to_process > 0:
+        elapsed_time = time.time() - start_time
+        units_per_second = processed / elapsed_time if elapsed_time > 0 else 0
+        remaining_units = max(to_process - processed, 0)
+        return remaining_units / units_per_second if units_per_second > 0 else 0
+    return None
+
+
+class JobProgress:
+    """
+    Where a job is in its sequence of stages, and how far inside the current one.
+    """
+
+    def __init__(
+        self,
+        stages: List[str],
+        on_change: Callable[[], None],
+        checkpoint: Optional[Callable[[], None]] = None,
+    ):
+        self.stages = stages
+        self.on_change = on_change
+        # Called before entering each stage, which is a cancellation point
+        self.checkpoint = checkpoint
+        self.stage: Optional[str] = None
+        self.done = 0
+        self.total = 0
+        self.stage_start = 0.0
+        # Duration of each finished stage, in seconds
+        self.durations: Dict[str, float] = {}
+
+    def start_stage(self, stage: str, total: int = 0) -> None:
+        """
+        Enter a new stage, with its total units of work if known.
+        """
+        self.check_cancelled()
+        now = time.time()
+        if self.stage is not None:
+            self.durations[self.stage] = now - self.stage_start
+        self.stage = stage
+        self.done = 0
+        self.total = total
+        self.stage_start = now
+        self.on_change()
+
+    def check_cancelled(self) -> None:
+        """
+        Cancellation point, for code which only gets the progress of the job, e.g. before writing.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint()
+
+    def set_total(self, total: int) -> None:
+        """
+        Set the units of work of current stage, when only known after it started.
+        """
+        self.total = total
+        self.on_change()
+
+    def advance(self, done: int = 1) -> None:
+        """
+        Account for done units of work in current stage.
+        """
+        self.done += done
+        self.on_change()
+
+    def finish(self) -> None:
+        """
+        Record duration of the last stage, without notifying.
+        """
+        if self.stage is not None and self.stage not in self.durations:
+            self.durations[self.stage] = time.time() - self.stage_start
+
+    def eta_seconds(self) -> Optional[float]:
+        """
+        Estimated remaining time in current stage, if computable.
+        """
+        return eta_seconds(self.stage_start, self.done, self.total)
+
+    def percent(self) -> int:
+        """
+        Overall progress, each stage weighting the same.
+        """
+        if self.stage is None or self.stage not in self.stages:
+            return 0
+        in_stage = min(self.done / self.total, 1) if self.total > 0 else 0
+        ret = (self.stages.index(self.stage) + in_stage) / len(self.stages)
+        return int(ret * 100)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "stage_start": self.stage_start,
+            "durations": dict(self.durations),
+        }
+
+    def load(self, values: Dict[str, Any]) -> None:
+        """
+        Set from as_dict() output, without notifying.
+        """
+        self.stage = values["stage"]
+        self.done = values["done"]
+        self.total = values["total"]
+        self.stage_start = values["stage_start"]
+        self.durations = values["durations"]
+
+
 class Job(ABC):
+    # All concrete job classes, by name, for re-creating them from storage
+    classes: Dict[str, Type["Job"]] = {}
+    # Called after each externally visible change of any job
+    listeners: List[JobListener] = []
+    # Where the job runs, subclasses doing heavy computations should use a process
+    execution_mode: ExecutionModeEnum = ExecutionModeEnum.Thread
+    # Which pool of slots the job takes from
+    resource_class: ResourceClassEnum = ResourceClassEnum.Other
+    # Sequence of progress stages of the job
+    stages: List[str] = []
+    # Scheduling lane, can be changed per job at submission
+    priority: JobPriorityEnum = JobPriorityEnum.Normal
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Job.classes[cls.__name__] = cls
+
     # Common Job traits
     def __init__(self, params: Tuple):
         self.params = params
         self.job_id = 0
-        self.state: JobStateEnum = JobStateEnum.Pending
+        self._state: JobStateEnum = JobStateEnum.Pending
         self.created_at = datetime.now()
         self.updated_at = self.created_at
-        self.last_log_line = None
+        self.queued_at = self.created_at
+        # Who submitted the job, for sharing slots fairly
+        self.owner: Optional[str] = None
+        self._last_log_line: Optional[str] = None
         self.logger: Logger = NullLogger()
+        self.cancel_token = CancellationToken()
+        # Held by state changes which must not happen to a cancelled job, and by its cancellation
+        self.state_lock = threading.RLock()
+        self.progress = JobProgress(
+            type(self).stages, self._changed, self.cancel_token.raise_if_cancelled
+        )
+
+    @property
+    def state(self) -> JobStateEnum:
+        return self._state
+
+    @state.setter
+    def state(self, value: JobStateEnum) -> None:
+        self._state = value
+        self._changed()
+
+    @property
+    def last_log_line(self) -> Optional[str]:
+        return self._last_log_line
+
+    @last_log_line.setter
+    def last_log_line(self, value: Optional[str]) -> None:
+        self._last_log_line = value
+        self._changed()
+
+    def _changed(self) -> None:
+        for a_listener in Job.listeners:
+            try:
+                a_listener(self)
+            except Exception as e:
+                logger.error(f"Job {self.job_id} listener failed: {str(e)}")
+
+    def persisted_params(self) -> Dict[str, Any]:
+        """
+        JSON-compatible form of the job parameters, enough for re-creating the job.
+        Subclasses with non-trivial params have to override this.
+        """
+        return {"params": list(self.params)}
+
+    def params_key(self) -> str:
+        """
+        Stable string identifying the job parameters, for comparing jobs.
+        """
+        return json.dumps(self.persisted_params(), sort_keys=True, default=str)
+
+    def project_id(self) -> Optional[str]:
+        """
+        Identifier of the project the job works on, if any.
+        """
+        return None
+
+    def estimated_memory_mb(self) -> int:
+        """
+        Estimation of peak RAM needed by the job, for scheduling under a memory budget.
+        0 means negligible, which is the default.
+        """
+        return 0
+
+    def worker_params(self) -> Dict[str, Any]:
+        """
+        Parameters for re-creating the job in a worker process. They are not stored.
+        """
+        return self.persisted_params()
+
+    @classmethod
+    def from_persisted(cls, params: Dict[str, Any]) -> Optional["Job"]:
+        """
+        Re-create a job from its persisted_params() or worker_params(). Returns None if the job cannot be
+        re-created, which is the default.
+        """
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Externally visible status of the job, for mirroring it from a worker process.
+        """
+        return {
+            "state": self._state,
+            "updated_at": self.updated_at,
+            "last_log_line": self._last_log_line,
+            "progress": self.progress.as_dict(),
+        }
+
+    def apply_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        """
+        Copy a snapshot() taken from the same job running elsewhere.
+        Snapshots arriving after a cancellation are ignored, the job is over for the outside.
+        """
+        with self.state_lock:
+            if self.cancel_token.is_cancelled():
+                return
+            self._state = snapshot["state"]
+            self.updated_at = snapshot["updated_at"]
+            self._last_log_line = snapshot["last_log_line"]
+            self.progress.load(snapshot["progress"])
+            self._changed()
+
+    def restore(
+        self,
+        job_id: int,
+        state: JobStateEnum,
+        created_at: datetime,
+        updated_at: datetime,
+        last_log_line: Optional[str],
+    ) -> None:
+        """
+        Set the job status from its stored copy, without notifying listeners.
+        """
+        self.job_id = job_id
+        self._state = state
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self._last_log_line = last_log_line
 
     def _setup_job_logger(self, log_file: Optional[Path] = None) -> Logger:
         """
@@ -70,6 +386,9 @@ class Job(ABC):
                 self.job = job
 
             def emit(self, record):
+                # The final status line of a done or cancelled job must stay
+                if self.job.is_done() or self.job.cancel_token.is_cancelled():
+                    return
                 self.job.last_log_line = self.format(record)
 
         # Create eye formatter, users will see this output
@@ -86,6 +405,39 @@ class Job(ABC):
 
         return job_logger
 
+    def _close_job_logger(self) -> None:
+        """
+        Release the file handles of the logger set up by _setup_job_logger, and the logger itself.
+        """
+        logger_name = f"job_{self.job_id}"
+        if logger_name not in logging.Logger.manager.loggerDict:
+            return
+        job_logger = logging.getLogger(logger_name)
+        for a_handler in list(job_logger.handlers):
+            job_logger.removeHandler(a_handler)
+            a_handler.close()
+        # Loggers are cached forever by the logging module
+        logging.Logger.manager.loggerDict.pop(logger_name, None)
+        self.logger = NullLogger()
+
+    def check_cancelled(self) -> None:
+        """
+        Cancellation point, to call between units of work which can take long.
+        Raises JobCancelledError if the job was cancelled. Stage starts are implicit ones.
+        """
+        self.cancel_token.raise_if_cancelled()
+
+    def cleanup_after_cancel(self) -> None:
+        """
+        Remove partial outputs of a cancelled job.
+        """
+        self._cleanup_work()
+
+    def _cleanup_work(self) -> None:
+        """
+        Remove the files that the job (re) creates. Nothing by default.
+        """
+
     @abstractmethod
     def prepare(self):
         """
@@ -99,11 +451,24 @@ class Job(ABC):
         Run the job execution. This method must be implemented by subclasses.
         """
 
+    def settle(self, state: JobStateEnum) -> bool:
+        """
+        Set the state, unless the job was cancelled, in which case the cancellation decided it.
+        Returns whether the state was set.
+        """
+        with self.state_lock:
+            if self.cancel_token.is_cancelled():
+                return False
+            self.state = state
+            return True
+
     def mark_started(self):
         """
         Utility for subclasses to mark job execution as started.
+        Raises JobCancelledError if the job was cancelled before it could start.
         """
-        self.state = JobStateEnum.Running
+        if not self.settle(JobStateEnum.Running):
+            raise JobCancelledError()
         self.updated_at = datetime.now()
         self.logger.info(f"Job {self.job_id} started")
 
@@ -121,6 +486,14 @@ class Job(ABC):
         self.updated_at = datetime.now()
         self.logger.debug(f"Job {self.job_id} finished at {self.updated_at}")
         logger.info(f"Job {self.job_id} finished at {self.updated_at}")
+        self.progress.finish()
+        if len(self.progress.durations) > 0:
+            timings = ", ".join(
+                f"{stage}: {secs:.1f}s"
+                for stage, secs in self.progress.durations.items()
+            )
+            self.logger.debug(f"Job {self.job_id} stage durations: {timings}")
+        self._changed()
 
     def is_done(self) -> bool:
         return self.state in (JobStateEnum.Finished, JobStateEnum.Error)
@@ -131,187 +504,645 @@ class Job(ABC):
     def is_in_error(self) -> bool:
         return self.state in (JobStateEnum.Error,)
 
+    def exec_name(self) -> str:
+        """
+        Name of the kind of job, for API responses.
+        """
+        return type(self).__name__
+
+
+class StoredJob(Job):
+    """
+    Read-only record of a job from a previous server run, which cannot be re-created for running.
+    """
+
+    def __init__(self, row: PersistedJob):
+        super().__init__(())
+        self.job_class: str = row.job_class
+        self.stored_params = row.params
+        self.owner = row.owner
+        self.restore(
+            row.id,
+            JobStateEnum(row.state),
+            row.created_at,
+            row.updated_at,
+            row.last_log_line,
+        )
+
+    def persisted_params(self) -> Dict[str, Any]:
+        return self.stored_params
+
+    def exec_name(self) -> str:
+        return self.job_class
+
+    def prepare(self):
+        raise RuntimeError(f"Job #{self.job_id} is only a stored record")
+
+    def run(self):
+        raise RuntimeError(f"Job #{self.job_id} is only a stored record")
+
+
+def execute_job(job: Job) -> None:
+    """
+    Prepare then run the job, tracking its state. Raises if the run itself failed.
+    """
+    try:
+        _prepare_and_run(job)
+    finally:
+        job._close_job_logger()
+
+
+def _prepare_and_run(job: Job) -> None:
+    try:
+        job.mark_started()
+        job.prepare()
+    except JobCancelledError:
+        # Cancelled before or while preparing, the scheduler did the bookkeeping
+        return
+    except Exception as te:
+        # Technical problem, which cannot be managed by the service
+        # as it was not possible to start it. Report here.
+        job.logger.error(f"Failed to start due to: {str(te)}")
+        if job.settle(JobStateEnum.Error):
+            job.mark_done(logger)
+        return
+    try:
+        job.run()
+        job.check_cancelled()
+        job.logger.info("Processing completed successfully")
+        if job.settle(JobStateEnum.Finished):
+            job.mark_done(logger)
+    except JobCancelledError:
+        # The scheduler already did the bookkeeping when cancelling
+        job.logger.info(CANCELLED_MSG)
+    except Exception as e:
+        if job.cancel_token.is_cancelled():
+            # Failure due to cancellation, e.g. outputs were removed meanwhile
+            job.logger.info(f"{CANCELLED_MSG}, stopped with: {str(e)}")
+            return
+        job.logger.error(f"Error during processing: {str(e)}")
+        logger.error(f"Job {job.job_id} encountered an error: {str(e)}", exc_info=True)
+        if job.settle(JobStateEnum.Error):
+            job.mark_done(logger)
+        raise
+
+
+class JobExecutor(ABC):
+    """
+    Strategy for executing a job, called from its runner thread.
+    """
+
+    @abstractmethod
+    def execute(self, job: Job) -> None:
+        """
+        Execute the job until it's done, in any way which keeps its state and log line up-to-date.
+        """
+
+    def cancel(self) -> None:
+        """
+        Stop the execution right away, if possible. Jobs in threads can only stop at cancellation points.
+        Current thread: any
+        """
+
+
+class InThreadExecutor(JobExecutor):
+    """
+    Run the job in the current thread.
+    """
+
+    def execute(self, job: Job) -> None:
+        execute_job(job)
+
+
+class SpawnedProcessExecutor(JobExecutor):
+    """
+    Run the job in a freshly spawned process, out of reach of the server's GIL.
+    The job is re-created there from its worker_params(), and its status changes
+    are sent back to be mirrored into the server-side job.
+    """
+
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self):
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+
+    def execute(self, job: Job) -> None:
+        events = self.context.Queue()
+        self.process = process = self.context.Process(
+            target=_execute_job_in_process,
+            args=(
+                type(job).__module__,
+                type(job).__name__,
+                job.worker_params(),
+                job.snapshot(),
+                job.job_id,
+                job.created_at,
+                events,
+            ),
+            name="Job #%d" % job.job_id,
+        )
+        process.start()
+        done = False
+        while not done:
+            if job.cancel_token.is_cancelled():
+                # Maybe cancelled before the process could be terminated by cancel()
+                self.cancel()
+                break
+            try:
+                a_snapshot = events.get(timeout=1)
+            except queue.Empty:
+                done = not process.is_alive()
+                continue
+            if a_snapshot is None:
+                break
+            job.apply_snapshot(a_snapshot)
+        process.join()
+        events.close()
+        if not job.is_done():
+            # Process died without telling, e.g. killed by OOM
+            job.last_log_line = f"Worker process exited with code {process.exitcode}"
+            if job.settle(JobStateEnum.Error):
+                job.mark_done(logger)
+
+    def cancel(self) -> None:
+        process = self.process
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+def _execute_job_in_process(
+    module_name: str,
+    class_name: str,
+    params: Dict[str, Any],
+    snapshot: Dict[str, Any],
+    job_id: JobIDT,
+    created_at: datetime,
+    events: Any,
+) -> None:
+    """
+    Entry point of job processes: re-create the job, run it, and report all changes.
+    Current process: a spawned one, all state is fresh
+    """
+    try:
+        importlib.import_module(module_name)
+        job = Job.classes[class_name].from_persisted(params)
+        assert job is not None, f"{class_name} cannot be re-created in a process"
+    except Exception as e:
+        snapshot["state"] = JobStateEnum.Error
+        snapshot["updated_at"] = datetime.now()
+        snapshot["last_log_line"] = f"Failed to start worker process: {str(e)}"
+        events.put(snapshot)
+        events.put(None)
+        return
+    job.restore(
+        job_id,
+        snapshot["state"],
+        created_at,
+        snapshot["updated_at"],
+        snapshot["last_log_line"],
+    )
+    Job.listeners.append(lambda a_job: events.put(a_job.snapshot()))
+    try:
+        execute_job(job)
+    except Exception:
+        pass  # Already logged and reported
+    finally:
+        events.put(None)
+
+
+def executor_for(job: Job) -> JobExecutor:
+    if USE_PROCESSES and job.execution_mode == ExecutionModeEnum.Process:
+        return SpawnedProcessExecutor()
+    return InThreadExecutor()
+
 
 class JobRunner(Thread):
     """
-    Run a job in a dedicated thread
+    Run a job from a dedicated thread, either directly or in a process which the thread supervises
     """
 
-    def __init__(self, a_job: Job):
+    def __init__(
+        self, a_job: Job, on_done: Optional[Callable[["JobRunner"], None]] = None
+    ):
         super().__init__(name="Job #%d" % a_job.job_id)
         self.job = a_job
+        self.executor = executor_for(a_job)
+        self.on_done = on_done
+        # RAM reserved for the job in the scheduler's budget
+        self.memory_mb = 0
 
     def run(self) -> None:
-        job = self.job
         try:
-            job.mark_started()
-            job.prepare()
-        except Exception as te:
-            self.tech_error(te)
-            return
-        try:
-            job.run()
-            job.logger.info("Processing completed successfully")
-            job.state = JobStateEnum.Finished
-            job.mark_done(logger)
-        except Exception as e:
-            job.logger.error(f"Error during processing: {str(e)}")
-            logger.error(
-                f"Job {job.job_id} encountered an error: {str(e)}", exc_info=True
-            )
-            job.state = JobStateEnum.Error
-            job.mark_done(logger)
-            raise
+            self.executor.execute(self.job)
+        finally:
+            if self.on_done is not None:
+                self.on_done(self)
 
-    def tech_error(self, te: Any) -> None:
-        """
-        Technical problem, which cannot be managed by the service
-        as it was not possible to start it. Report here.
-        """
-        self.job.state = JobStateEnum.Error
-        self.job.logger.error(f"Failed to start due to: {str(te)}")
-        self.job.mark_done(logger)
+
+class QueueWaitMetric:
+    """
+    Time spent by jobs between their submission and their start.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        mean = self.total / self.count if self.count > 0 else 0.0
+        return {
+            "count": self.count,
+            "mean_s": round(mean, 3),
+            "max_s": round(self.max, 3),
+            "last_s": round(self.last, 3),
+        }
 
 
 class JobScheduler:
     """
     In charge of launching/monitoring subprocesses i.e. keep sync b/w processes and their images in memory.
-    These are not really processes, just threads, so far.
+    Each job gets a runner thread, which either runs it or supervises the process running it.
+    A single dispatcher thread sleeps until a job is submitted or a runner completes, then fills all free slots.
     """
 
     # Track multiple concurrent runners
-    active_runners: set[JobRunner] = set()  # Only written by JobTimer_s_
+    active_runners: set[JobRunner] = set()
 
-    the_timer: Optional[threading.Timer] = (
-        None  # First creation by Main, replacements by JobTimer_s_
-    )
-    do_run: Event = Event()  # R/W by Main & JobTimer
+    the_dispatcher: Optional[Thread] = None  # Created by Main
+    do_run: Event = Event()  # R/W by Main & JobDispatcher
 
     # Counter for generating unique job IDs
     _next_id: int = 1
-    # In-memory storage for jobs
-    _jobs: list[Job] = []
+    # In-memory storage for jobs of this server run, by ID
+    _jobs: Dict[JobIDT, Job] = {}
+    # Same jobs, indexed by params key
+    _jobs_by_key: Dict[str, List[Job]] = {}
     # Mutex for _jobs access (also protects active_runners)
     jobs_lock: threading.RLock = threading.RLock()
+    # Signaled, under jobs_lock, when there might be something to dispatch
+    wake_up: threading.Condition = threading.Condition(jobs_lock)
+    # Durable copy of jobs, if any
+    store: Optional[JobStore] = None
+    # Last state written to the store, per job, as only state transitions are written
+    _stored_states: Dict[JobIDT, JobStateEnum] = {}
+    # Job rows waiting to be written, latest one per job, and the thread writing them.
+    # Transitions happen under jobs_lock, which must not wait for the database.
+    _unsaved: Dict[JobIDT, Dict[str, Any]] = {}
+    _unsaved_lock: threading.Lock = threading.Lock()
+    _flush_lock: threading.Lock = threading.Lock()
+    _store_writer: Optional[Thread] = None
+    _store_wake_up: Event = Event()
+    # How long jobs waited for a free slot
+    queue_wait: QueueWaitMetric = QueueWaitMetric()
+    # When a job of each owner, and of each project, was last started, for taking turns
+    _last_start_per_owner: Dict[Optional[str], datetime] = {}
+    _last_start_per_project: Dict[Optional[str], datetime] = {}
 
     @classmethod
-    def _prune_finished(cls) -> None:
-        """Remove completed/terminated runners from the active set."""
+    def _fill_slots(cls) -> None:
+        """
+        Fill all available concurrency slots with pending jobs.
+        Jobs are taken by priority, then from the owner and project having the fewest running jobs,
+        then round-robin between owners and projects, then in submission order.
+        So a bulk submission does not starve other operators.
+        Each resource class has its own slots, and a job not fitting in the memory budget
+        holds back its class until enough running jobs are done.
+        Current thread: JobDispatcher
+        """
         with cls.jobs_lock:
-            dead = {r for r in cls.active_runners if not r.is_alive()}
-            if dead:
-                for r in dead:
-                    try:
-                        r.join(timeout=0)
-                    except Exception:
-                        pass
-                cls.active_runners.difference_update(dead)
+            free_slots = MAX_CONCURRENCY - len(cls.active_runners)
+            if free_slots <= 0:
+                return
+            running_per_class: Dict[ResourceClassEnum, int] = {}
+            running_per_owner: Dict[Optional[str], int] = {}
+            running_per_project: Dict[Optional[str], int] = {}
+            used_memory = 0
+
+            def account(a_job: Job) -> None:
+                a_class = a_job.resource_class
+                running_per_class[a_class] = running_per_class.get(a_class, 0) + 1
+                owner, project = a_job.owner, a_job.project_id()
+                running_per_owner[owner] = running_per_owner.get(owner, 0) + 1
+                running_per_project[project] = running_per_project.get(project, 0) + 1
+
+            def turn(a_job: Job) -> Tuple[int, int, int, datetime, datetime, datetime]:
+                owner, project = a_job.owner, a_job.project_id()
+                return (
+                    a_job.priority,
+                    running_per_owner.get(owner, 0),
+                    running_per_project.get(project, 0),
+                    cls._last_start_per_owner.get(owner, datetime.min),
+                    cls._last_start_per_project.get(project, datetime.min),
+                    a_job.queued_at,
+                )
+
+            for a_runner in cls.active_runners:
+                account(a_runner.job)
+                used_memory += a_runner.memory_mb
+            pending = [
+                job for job in cls._jobs.values() if job.state == JobStateEnum.Pending
+            ]
+            held_back = set()
+            while free_slots > 0:
+                candidates = [
+                    job
+                    for job in pending
+                    if job.resource_class not in held_back
+                    and running_per_class.get(job.resource_class, 0)
+                    < RESOURCE_SLOTS[job.resource_class]
+                ]
+                if len(candidates) == 0:
+                    break
+                job = min(candidates, key=turn)
+                pending.remove(job)
+                memory = job.estimated_memory_mb() if MEMORY_BUDGET_MB > 0 else 0
+                if used_memory > 0 and used_memory + memory > MEMORY_BUDGET_MB:
+                    # Wait for RAM, but keep the order inside the class
+                    held_back.add(job.resource_class)
+                    continue
+                cls._start(job, memory)
+                account(job)
+                used_memory += memory
+                free_slots -= 1
+
+    @classmethod
+    def _start(cls, job: Job, memory_mb: int) -> None:
+        """Mark the job Running and start its runner. Caller must hold jobs_lock."""
+        job.state = JobStateEnum.Running
+        now = datetime.now()
+        cls._last_start_per_owner[job.owner] = now
+        cls._last_start_per_project[job.project_id()] = now
+        waited = (now - job.queued_at).total_seconds()
+        cls.queue_wait.record(waited)
+        logger.info("Found job to run: %s, waited %.1fs in queue", str(job), waited)
+        runner = JobRunner(job, on_done=cls._runner_done)
+        runner.memory_mb = memory_mb
+        cls.active_runners.add(runner)
+        runner.start()
 
     @classmethod
-    def _pick_a_pending(cls) -> Optional[Job]:
-        """Pick a single pending job and mark it Running under the lock.
-        Returns the job if found, otherwise None.
+    def _runner_done(cls, runner: JobRunner) -> None:
+        """
+        Free the slot of a completed runner and wake up the dispatcher.
+        A cancelled job gets its partial outputs removed here, once nothing can write them anymore.
+        Current thread: the runner's one
         """
         with cls.jobs_lock:
-            for job in cls._jobs:
-                if job.state == JobStateEnum.Pending:
-                    job.state = JobStateEnum.Running
-                    return job
-        return None
+            cls.active_runners.discard(runner)
+            cls.wake_up.notify_all()
+        job = runner.job
+        if job.cancel_token.is_cancelled():
+            try:
+                job.cleanup_after_cancel()
+            except Exception as e:
+                logger.error(f"Job #{job.job_id} cleanup failed: {str(e)}")
 
     @classmethod
-    def _run_one(cls) -> None:
+    def launch(cls) -> None:
         """
-        Fill available concurrency slots with pending jobs.
-        Current thread: JobTimer
+        Start the dispatcher thread.
+        Current thread: Main
         """
-        # 1) Remove completed runners
-        cls._prune_finished()
+        cls.do_run.set()
+        cls.the_dispatcher = Thread(target=cls._dispatch, name="JobDispatcher")
+        cls.the_dispatcher.start()
+        if cls.store is not None:
+            cls._store_writer = Thread(target=cls._write_store, name="JobStoreWriter")
+            cls._store_writer.start()
 
-        # 2) How many new jobs can we start?
+    @classmethod
+    def _dispatch(cls) -> None:
+        # Current thread: JobDispatcher
         with cls.jobs_lock:
-            running_count = len(cls.active_runners)
-            free_slots = max(MAX_CONCURRENCY - running_count, 0)
-
-        if free_slots <= 0:
-            return
+            while cls.do_run.is_set():
+                try:
+                    cls._fill_slots()
+                    cls._evict_done_jobs()
+                except Exception as e:
+                    logger.exception("Job dispatch exception: %s", e)
+                # Releases the lock until notified
+                cls.wake_up.wait()
+            # Join all active runners before stopping
+            runners = list(cls.active_runners)
+        for r in runners:
+            try:
+                r.join()
+            except Exception:
+                pass
+        with cls.jobs_lock:
+            cls.active_runners.clear()
 
-        # 3) Start at most one pending job per tick (queue will fill others)
-        job = cls._pick_a_pending()
-        if job is not None:
-            logger.info("Found job to run: %s", str(job))
-            runner = JobRunner(job)
-            runner.start()
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Clean close of multi-threading resources: Runners, Dispatcher and Event
+        Restore class-loading time state.
+        Current thread: Main
+        """
+        if cls.do_run.is_set():
+            # Signal the dispatcher to stop
             with cls.jobs_lock:
-                cls.active_runners.add(runner)
+                cls.do_run.clear()
+                cls.wake_up.notify_all()
+            # Wait for it gone
+            if cls.the_dispatcher is not None:
+                cls.the_dispatcher.join()
+                cls.the_dispatcher = None
+            if cls._store_writer is not None:
+                cls._store_wake_up.set()
+                cls._store_writer.join()
+                cls._store_writer = None
+            cls.flush_store()
 
     @classmethod
-    def launch_at_interval(cls, interval: int) -> None:
+    def use_store(cls, store: JobStore) -> None:
         """
-        Launch a job if possible, then wait a bit before accessing the next one.
-        Current thread: Main for the first launch, JobTimer (_different ones_) for others
+        Keep a durable copy of all jobs into the given store, and continue its IDs sequence.
+        Current thread: Main
         """
-        cls.do_run.set()
-        cls._create_and_launch_timer(interval)
+        cls.store = store
+        cls._stored_states.clear()
+        with cls.jobs_lock:
+            cls._next_id = max(cls._next_id, store.max_id() + 1)
+        if cls._persist not in Job.listeners:
+            Job.listeners.append(cls._persist)
 
     @classmethod
-    def _create_and_launch_timer(cls, interval: int) -> None:
-        cls.the_timer = threading.Timer(
-            interval=interval, function=cls.launch, args=[interval]
+    def _persist(cls, job: Job) -> None:
+        """
+        Write the job into the store, if it's a submitted one and its state changed.
+        Other changes, e.g. progress or log lines, are only written with next state change,
+        or right away once the job is done, so its final log line is kept.
+        A cancelled job is written only once, its thread might still be stopping.
+        Writing is done by the store writer thread when running, otherwise right away.
+        """
+        if cls.store is None or job.job_id <= 0:
+            return
+        state = job.state
+        if cls._stored_states.get(job.job_id) == state and (
+            not job.is_done() or job.cancel_token.is_cancelled()
+        ):
+            return
+        cls._stored_states[job.job_id] = state
+        row = dict(
+            id=job.job_id,
+            job_class=type(job).__name__,
+            params_key=job.params_key(),
+            params=job.persisted_params(),
+            state=state.value,
+            created_at=job.created_at,
+            updated_at=job.updated_at,
+            last_log_line=job.last_log_line,
+            owner=job.owner,
+            priority=int(job.priority),
         )
-        cls.the_timer.name = "JobTimer"
-        cls.the_timer.start()
+        with cls._unsaved_lock:
+            cls._unsaved[job.job_id] = row
+        if cls._store_writer is not None:
+            cls._store_wake_up.set()
+        else:
+            cls.flush_store()
+
+    @classmethod
+    def flush_store(cls) -> None:
+        """
+        Write all pending job rows into the store, in one transaction.
+        Current thread: any, but better not holding jobs_lock
+        """
+        with cls._flush_lock:
+            with cls._unsaved_lock:
+                rows = list(cls._unsaved.values())
+                cls._unsaved.clear()
+            if len(rows) == 0 or cls.store is None:
+                return
+            try:
+                cls.store.save_all(rows)
+            except Exception as e:
+                logger.error(f"Could not store {len(rows)} jobs: {str(e)}")
+
+    @classmethod
+    def _write_store(cls) -> None:
+        # Current thread: JobStoreWriter
+        while cls.do_run.is_set():
+            cls._store_wake_up.wait()
+            cls._store_wake_up.clear()
+            cls.flush_store()
 
     @classmethod
-    def launch(cls, interval: int) -> None:
-        # Current thread: JobTimer_s_
+    def restore_from_store(cls) -> None:
+        """
+        Re-queue the jobs which were Pending when the previous server run stopped.
+        The ones which were Running are marked in error, as they were interrupted.
+        Current thread: Main
+        """
+        if cls.store is None:
+            return
+        unfinished = cls.store.in_states(
+            [JobStateEnum.Pending.value, JobStateEnum.Running.value]
+        )
+        for a_row in unfinished:
+            if a_row.state == JobStateEnum.Running.value:
+                cls.store.set_state(
+                    a_row.id, JobStateEnum.Error.value, "Interrupted by server restart"
+                )
+                logger.info(f"Job #{a_row.id} was interrupted by server restart")
+                continue
+            job = cls._job_from_row(a_row)
+            if job is None:
+                cls.store.set_state(
+                    a_row.id, JobStateEnum.Error.value, "Could not be re-queued"
+                )
+                logger.info(f"Job #{a_row.id} could not be re-queued")
+                continue
+            with cls.jobs_lock:
+                cls._add(job)
+                cls.wake_up.notify_all()
+            logger.info(f"Job #{job.job_id} re-queued")
+
+    @staticmethod
+    def _job_from_row(row: PersistedJob) -> Optional[Job]:
+        """Re-create a job from its stored copy, if possible."""
+        job_class = Job.classes.get(row.job_class)
+        if job_class is None:
+            return None
         try:
-            # noinspection PyProtectedMember
-            cls._run_one()
+            job = job_class.from_persisted(row.params)
         except Exception as e:
-            logger.exception("Job run() exception: %s", e)
-        if not cls.do_run.is_set():
-            # Join all active runners before stopping
-            with cls.jobs_lock:
-                runners = list(cls.active_runners)
-            for r in runners:
-                try:
-                    r.join()
-                except Exception:
-                    pass
-            with cls.jobs_lock:
-                cls.active_runners.clear()
-            cls.the_timer = None
-        else:
-            cls._create_and_launch_timer(interval)
+            logger.error(f"Cannot re-create job #{row.id}: {str(e)}")
+            return None
+        if job is None:
+            return None
+        job.restore(
+            row.id,
+            JobStateEnum(row.state),
+            row.created_at,
+            row.updated_at,
+            row.last_log_line,
+        )
+        job.owner = row.owner
+        if row.priority is not None:
+            job.priority = JobPriorityEnum(row.priority)
+        return job
 
     @classmethod
-    def shutdown(cls) -> None:
+    def _add(cls, job: Job) -> None:
+        """Add the job to in-memory storage. Caller must hold jobs_lock."""
+        cls._jobs[job.job_id] = job
+        cls._jobs_by_key.setdefault(job.params_key(), []).append(job)
+
+    @classmethod
+    def _remove(cls, job: Job) -> None:
+        """Remove the job from in-memory storage. Caller must hold jobs_lock."""
+        del cls._jobs[job.job_id]
+        cls._stored_states.pop(job.job_id, None)
+        key = job.params_key()
+        same_key = cls._jobs_by_key[key]
+        same_key.remove(job)
+        if len(same_key) == 0:
+            del cls._jobs_by_key[key]
+
+    @classmethod
+    def _evict_done_jobs(cls) -> None:
         """
-        Clean close of multi-threading resources: Runner, Timer and Event
-        Restore class-loading time state.
-        Current thread: Main
+        Forget done jobs older than the retention delay, and the oldest ones above the retention count.
+        They remain readable from the store, if any.
+        Caller must hold jobs_lock.
         """
-        if cls.do_run.is_set():
-            # Signal the timer to stop and cancel itself
-            cls.do_run.clear()
-            # Wait for it gone
-            while cls.the_timer is not None:
-                time.sleep(1)
+        done_jobs = [job for job in cls._jobs.values() if job.is_done()]
+        to_evict = len(done_jobs) - RETENTION_COUNT
+        oldest_kept = datetime.now() - timedelta(hours=RETENTION_HOURS)
+        for job in done_jobs:
+            if to_evict > 0 or job.updated_at < oldest_kept:
+                cls._remove(job)
+                to_evict -= 1
 
     @classmethod
     def get_new_id(cls) -> int:
         """
         Returns a unique incremented ID using a class variable.
         """
-        job_id = cls._next_id
-        cls._next_id += 1
+        with cls.jobs_lock:
+            job_id = cls._next_id
+            cls._next_id += 1
         return job_id
 
     @classmethod
     def get_job(cls, job_id: int) -> Optional[Job]:
         """
-        Get a job by its ID.
+        Get a job by its ID. Jobs from previous server runs are read from the store, as
+        read-only records if they cannot be re-created.
 
         Args:
             job_id: The ID of the job to retrieve.
@@ -320,33 +1151,109 @@ class JobScheduler:
             The job with the specified ID, or None if no job with that ID is found.
         """
         with cls.jobs_lock:
-            for job in cls._jobs:
-                if job.job_id == job_id:
-                    return job
-        return None
+            job = cls._jobs.get(job_id)
+        if job is None and cls.store is not None:
+            row = cls.store.get(job_id)
+            if row is not None:
+                job = cls._job_from_row(row)
+                if job is None:
+                    job = StoredJob(row)
+        return job
 
     @classmethod
-    def submit(cls, task: Job):
+    def submit(
+        cls,
+        task: Job,
+        priority: Optional[JobPriorityEnum] = None,
+        owner: Optional[str] = None,
+    ):
         """
         Submit a job to be executed by the scheduler.
-        The job will be added to the in-memory storage and executed when
+        The job will be added to the in-memory storage, persisted if there is a store, and executed when
         a runner is available.
+
+        Args:
+            task: The job to run.
+            priority: Lane of the job, if not the default one of its class.
+            owner: Who submitted the job, jobs from different owners share slots fairly.
         """
+        if priority is not None:
+            task.priority = priority
+        if owner is not None:
+            task.owner = owner
         # Ensure the job has a unique ID
         if task.job_id <= 0:
             task.job_id = cls.get_new_id()
-        # Ensure the job state is Pending
-        task.state = JobStateEnum.Pending
-        # Add the job to the in-memory storage
         with cls.jobs_lock:
-            cls._jobs.append(task)
+            # Add the job to the in-memory storage
+            cls._add(task)
+            # Ensure the job state is Pending, which also persists it
+            task.queued_at = datetime.now()
+            task.state = JobStateEnum.Pending
+            # Let the dispatcher start it right away if there is room
+            cls.wake_up.notify_all()
         logger.info(f"Job #{task.job_id} submitted")
 
+    @classmethod
+    def cancel(cls, job_id: JobIDT) -> Optional[Job]:
+        """
+        Cancel a job. A pending one is just removed from the queue.
+        A running one is done at once for the outside, and its process killed if it has one.
+        Its thread, if any, stops at next cancellation point. Its slot is freed and its partial
+        outputs are removed when its runner is over, i.e. the thread stopped or the process is gone.
+        A job only known from the store cannot be running, it's returned as stored, marked as
+        cancelled if it was left unfinished.
+
+        Returns:
+            The job, in its final state, or None if no job with that ID is known.
+        """
+        with cls.jobs_lock:
+            job = cls._jobs.get(job_id)
+            if job is not None and job.is_done():
+                return job
+            if job is not None:
+                with job.state_lock:
+                    job.cancel_token.cancel()
+                    job.last_log_line = CANCELLED_MSG
+                    job.state = JobStateEnum.Error
+                    job.mark_done(logger)
+                runner = next((r for r in cls.active_runners if r.job is job), None)
+        if job is None:
+            return cls._cancel_stored(job_id)
+        logger.info(f"Job #{job_id} cancelled")
+        if runner is not None:
+            runner.executor.cancel()
+        return job
+
+    @classmethod
+    def _cancel_stored(cls, job_id: JobIDT) -> Optional[Job]:
+        """
+        Cancel a job known only from the store, i.e. not in this server run.
+        """
+        if cls.store is None:
+            return None
+        row = cls.store.get(job_id)
+        if row is None:
+            return None
+        if row.state in (JobStateEnum.Pending.value, JobStateEnum.Running.value):
+            cls.store.set_state(job_id, JobStateEnum.Error.value, CANCELLED_MSG)
+            logger.info(f"Stored job #{job_id} cancelled")
+        return cls.get_job(job_id)
+
+    @classmethod
+    def find_jobs(cls, accept: Callable[[Job], bool]) -> List[Job]:
+        """
+        Find jobs of this server run accepted by the filter, oldest first.
+        """
+        with cls.jobs_lock:
+            return [job for job in cls._jobs.values() if accept(job)]
+
     @classmethod
     def find_jobs_like(cls, task: Job, state_def: Callable[[Job], bool]) -> List[Job]:
         """
-        Find jobs matching exactly the class and params of the provided job, and able
-        to complete the task.
+        Find jobs matching the class, or a subclass, and exactly the params of the
+        provided job, and able to complete the task.
+        Jobs not in memory anymore, e.g. from previous server runs, are read from the store, if any.
 
         Args:
             task: The job to match.
@@ -355,13 +1262,19 @@ class JobScheduler:
         Returns:
             All jobs matching the class and parameters of the provided job.
         """
+        params_key = task.params_key()
         with cls.jobs_lock:
-            ret = []
-            for job in cls._jobs:
-                # Check if the job is of the same class type
-                if not isinstance(job, type(task)):
+            ret = [
+                job
+                for job in cls._jobs_by_key.get(params_key, [])
+                if isinstance(job, type(task)) and state_def(job)
+            ]
+            in_memory = set(cls._jobs)
+        if cls.store is not None:
+            for a_row in cls.store.with_params_key(params_key):
+                if a_row.id in in_memory:
                     continue
-                if job.params == task.params:
-                    if state_def(job):
-                        ret.append(job)
-            return sorted(ret, key=lambda a_job: a_job.created_at, reverse=True)
+                job = cls._job_from_row(a_row)
+                if job is not None and isinstance(job, type(task)) and state_def(job):
+                    ret.append(job)
+        return sorted(ret, key=lambda a_job: a_job.created_at, reverse=True)
@@ -0,0 +1,101 @@
+# Segmentation of huge images by horizontal strips
+import copy
+import os
+from typing import List, Tuple, Any
+
+import numpy as np
+
+from ZooProcess_lib.ROI import ROI
+from ZooProcess_lib.Segmenter import Segmenter
+
+# Height of segmentation strips in pixels, 0 for segmenting the whole image at once (configurable through env).
+# Only segmentation is done by strips, image conversion and background removal still work on the whole frame.
+SEGMENT_STRIP_ROWS: int = int(os.getenv("SEGMENT_STRIP_ROWS", "0"))
+# Rows added above and below each strip, for local operations around objects and the image edges
+STRIP_MARGIN_ROWS = 64
+
+
+def roi_rows(roi: ROI) -> Tuple[int, int]:
+    """First and after-last rows of the ROI"""
+    return roi.y, roi.y + roi.mask.shape[0]
+
+
+def shifted_roi(roi: ROI, rows: int) -> ROI:
+    """The ROI moved down by given rows"""
+    ret = copy.copy(roi)
+    ret.y = roi.y + rows
+    return ret
+
+
+def row_has_objects(segmenter: Segmenter, image: np.ndarray, row: int) -> bool:
+    """Whether some pixels of the row are dark enough to be part of an object"""
+    return bool(np.any(image[row] < segmenter.threshold))
+
+
+def find_ROIs_in_strips(
+    segmenter: Segmenter,
+    image: np.ndarray,
+    resolution: int,
+    strip_rows: int,
+) -> Tuple[List[ROI], List[Any]]:
+    """
+    Segment the image strip by strip, so that temporary images of the segmenter have the size of a strip.
+    The image itself is still needed whole, so memory used by the steps producing it is not reduced.
+    Each strip is segmented as a full image, so it gets the processing specific to image edges, which has
+    to reach less than STRIP_MARGIN_ROWS inside. Each object belongs to the strip containing its top row.
+    A strip is extended downwards until its last row is free of objects, as the segmenter might drop
+    objects touching image edges, and until none of its objects comes within STRIP_MARGIN_ROWS of the cut.
+    So all objects are segmented whole and away from cuts, and the result is the one of
+    find_ROIs_in_image on the full image.
+
+    Returns:
+        ROIs in full image coordinates, ordered by position, and segmentation stats of each strip.
+    """
+    height = image.shape[0]
+    rois: List[ROI] = []
+    stats = []
+    core_start = 0
+    while core_start < height:
+        core_end = min(core_start + strip_rows, height)
+        strip_start = max(core_start - STRIP_MARGIN_ROWS, 0)
+        extra_rows = STRIP_MARGIN_ROWS
+        while True:
+            strip_end = min(core_end + extra_rows, height)
+            # Objects touching the cut might be dropped by the segmenter, so move it below them
+            while strip_end < height and row_has_objects(
+                segmenter, image, strip_end - 1
+            ):
+                strip_end += 1
+            strip_rois, strip_stats = segmenter.find_ROIs_in_image(
+                image[strip_start:strip_end], resolution
+            )
+            strip_rois = [shifted_roi(a_roi, strip_start) for a_roi in strip_rois]
+            core_rois = [
+                a_roi for a_roi in strip_rois if core_start <= a_roi.y < core_end
+            ]
+            cut = strip_end < height and any(
+                roi_rows(a_roi)[1] > strip_end - STRIP_MARGIN_ROWS
+                for a_roi in core_rois
+            )
+            if not cut:
+                break
+            # Some object comes close to the cut, retry with a taller strip
+            extra_rows = 2 * (strip_end - core_end)
+        rois.extend(core_rois)
+        stats.append(strip_stats)
+        core_start = core_end
+    rois.sort(key=lambda a_roi: (a_roi.y, a_roi.x))
+    return rois, stats
+
+
+def find_ROIs(
+    segmenter: Segmenter, image: np.ndarray, resolution: int
+) -> Tuple[List[ROI], Any]:
+    """
+    Segment the image, by strips if configured and the image is tall enough for it to matter.
+    The image itself is not split, it's better memory-mapped when segmented by strips.
+    Segmenting by strips only reduces the memory used by the segmenter, not by the steps before it.
+    """
+    if 0 < SEGMENT_STRIP_ROWS and 2 * SEGMENT_STRIP_ROWS < image.shape[0]:
+        return find_ROIs_in_strips(segmenter, image, resolution, SEGMENT_STRIP_ROWS)
+    return segmenter.find_ROIs_in_image(image, resolution)
@@ -223,15 +223,17 @@ def job_to_task_rsp(job: Optional[Job]) -> Optional[TaskRsp]:
         JobStateEnum.Finished: "Finished",
     }
 
-    # Calculate progress percentage based on job state
+    # Calculate progress percentage based on job state and stages
+    progress = job.progress
     percent = 0
     if job.state == JobStateEnum.Running:
-        percent = 50  # Default to 50% for running jobs
+        percent = min(progress.percent(), 99)
     elif job.state == JobStateEnum.Finished:
         percent = 100
+    eta = progress.eta_seconds() if job.state == JobStateEnum.Running else None
 
     # Determine exec and params based on job type
-    exec_name = job.__class__.__name__
+    exec_name = job.exec_name()
     params: Dict[str, str] = {}  # I guess it's unused in a response
 
     # Create log URL if available
@@ -252,4 +254,8 @@ def job_to_task_rsp(job: Optional[Job]) -> Optional[TaskRsp]:
         log=log_line,
         createdAt=job.created_at,
         updatedAt=job.updated_at,
+        stage=progress.stage,
+        done=progress.done if progress.stage is not None else None,
+        total=progress.total if progress.total > 0 else None,
+        eta=int(eta) if eta is not None else None,
     )
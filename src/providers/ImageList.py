@@ -1,14 +1,65 @@
 import io
 import os
+import struct
 import tempfile
+import threading
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from logging import Logger
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Iterator, Tuple, Deque
 from zipfile import ZipInfo
 
 from PIL import Image
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG color type of 8-bit RGB images
+PNG_RGB_COLOR_TYPE = 2
+# Concurrent conversions to RGB when zipping (configurable through env)
+RGB_CONVERSION_WORKERS: int = int(os.getenv("RGB_CONVERSION_WORKERS", "4"))
+
+
+def png_header(image_path: Path) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Width, height, bit depth and color type of a PNG image, read from its header.
+    None if the file is not a PNG.
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(26)
+    if len(head) < 26 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", head[16:26])
+    return width, height, bit_depth, color_type
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable destination of a zip file, keeping written bytes until they are taken.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore[override]
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        """Bytes written since last call"""
+        ret = b"".join(self.chunks)
+        self.chunks.clear()
+        return ret
+
 
 class ImageList:
     """
@@ -19,15 +70,22 @@ class ImageList:
         images (List[Path]): List of paths to PNG or JPG images in the directory
     """
 
-    def __init__(self, directory_path: Path, images: Optional[List[str]] = None):
+    def __init__(
+        self,
+        directory_path: Path,
+        images: Optional[List[str]] = None,
+        rgb_cache_dir: Optional[Path] = None,
+    ):
         """
         Initialize the ImageList with a directory path and list all PNG images.
 
         Args:
             directory_path (Path): Path to the directory containing images
             images (List[Path], optional): List of image paths to use instead of loading from directory
+            rgb_cache_dir (Path, optional): Where to keep RGB conversions of images, for zipping them again
         """
         self.directory_path = directory_path
+        self.rgb_cache_dir = rgb_cache_dir
         self.images: List[str] = []
         if images is not None:
             self.images = images
@@ -100,10 +158,16 @@ class ImageList:
         for i in range(0, len(self.images), size):
             sublist = self.images[i : i + size]
             # Create a new ImageList instance with the same directory_path but with only the images from the sublist
-            yield ImageList(self.directory_path, images=sublist)
+            yield ImageList(
+                self.directory_path, images=sublist, rgb_cache_dir=self.rgb_cache_dir
+            )
 
     def zipped(
-        self, logger: Logger, force_RGB=True, zip_path: Optional[Path] = None
+        self,
+        logger: Logger,
+        force_RGB=True,
+        zip_path: Optional[Path] = None,
+        compression: int = zipfile.ZIP_STORED,
     ) -> Path:
         """
         Zips flat all images from this ImageList to a temporary zip file.
@@ -114,6 +178,7 @@ class ImageList:
             logger: for messages
             force_RGB: ensure gray-level images are converted to RGB before zipping
             zip_path: destination zip, default to temporary space if not provided
+            compression: zipfile compression method, PNGs are already compressed so default is none
 
         Returns:
             Path to the temporary zip file
@@ -131,25 +196,14 @@ class ImageList:
             image_names = self.get_images()
 
             # Create the zip file (valid even if there are no images)
-            with zipfile.ZipFile(zip_path, "w") as zip_file:
+            with zipfile.ZipFile(zip_path, "w", compression) as zip_file:
                 if not image_names:
                     logger.warning(
                         "No images found in the ImageList; creating empty zip"
                     )
                 # Add each image to the zip file
-                for image_name in image_names:
-                    image_path = self.directory_path / image_name
-                    pil_img = Image.open(image_path)
-                    if force_RGB and pil_img.mode != "RGB":
-                        cvt_pil_img = pil_img.convert("RGB")
-                        img_buffer = io.BytesIO()
-                        cvt_pil_img.save(img_buffer, format="PNG")
-                        img_buffer.seek(0)
-                        # Add the image from the buffer to the zip file
-                        zip_file.writestr(ZipInfo(image_name), img_buffer.getvalue())
-                    else:
-                        zip_file.write(image_path, arcname=image_name)
-                    self.size_by_name[image_name] = pil_img.size[0] * pil_img.size[1]
+                for image_name, prepared in self._prepared_images(force_RGB):
+                    self._add_to_zip(zip_file, image_name, prepared)
 
             logger.debug(
                 f"Successfully created zip file with {len(image_names)} images from ImageList at {zip_path}"
@@ -160,3 +214,159 @@ class ImageList:
             logger.error(f"Error creating zip file: {str(e)}")
             # If an error occurs, return the path anyway so the caller can handle it
             return zip_path
+
+    def zip_chunks(
+        self,
+        logger: Logger,
+        force_RGB=True,
+        compression: int = zipfile.ZIP_STORED,
+    ) -> Iterator[bytes]:
+        """
+        Zips flat all images from this ImageList, producing the zip while it's consumed,
+        with no temporary file. Same content as zipped().
+
+        Args:
+            logger: for messages
+            force_RGB: ensure gray-level images are converted to RGB before zipping
+            compression: zipfile compression method, PNGs are already compressed so default is none
+
+        Yields:
+            Successive non-empty parts of the zip file
+        """
+        logger.debug(f"Streaming zip of images from directory: {self.directory_path}")
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, "w", compression) as zip_file:
+            for image_name, prepared in self._prepared_images(force_RGB):
+                self._add_to_zip(zip_file, image_name, prepared)
+                a_chunk = stream.take()
+                if a_chunk:
+                    yield a_chunk
+        a_chunk = stream.take()
+        if a_chunk:
+            yield a_chunk
+
+    def _prepared_images(
+        self, force_RGB: bool
+    ) -> Iterator[Tuple[str, Tuple[int, Optional[bytes]]]]:
+        """
+        The images in list order, each with its size and its RGB conversion if needed.
+        Conversions are pure CPU, so they run ahead of the consumer in a bounded thread pool.
+        """
+        image_names = self.get_images()
+        if not force_RGB or RGB_CONVERSION_WORKERS <= 1 or len(image_names) <= 1:
+            for image_name in image_names:
+                yield image_name, self._prepare(image_name, force_RGB)
+            return
+        with ThreadPoolExecutor(max_workers=RGB_CONVERSION_WORKERS) as executor:
+            pending: Deque[Tuple[str, Future]] = deque()
+            for image_name in image_names:
+                pending.append(
+                    (image_name, executor.submit(self._prepare, image_name, True))
+                )
+                if len(pending) >= 2 * RGB_CONVERSION_WORKERS:
+                    done_name, a_future = pending.popleft()
+                    yield done_name, a_future.result()
+            while pending:
+                done_name, a_future = pending.popleft()
+                yield done_name, a_future.result()
+
+    def size_of(self, image_name: str) -> int:
+        """
+        Number of pixels in the image, as found when zipping or read from header for PNGs.
+        """
+        ret = self.size_by_name.get(image_name)
+        if ret is not None:
+            return ret
+        image_path = self.directory_path / image_name
+        header = png_header(image_path)
+        if header is not None:
+            ret = header[0] * header[1]
+        else:
+            with Image.open(image_path) as pil_img:
+                ret = pil_img.size[0] * pil_img.size[1]
+        self.size_by_name[image_name] = ret
+        return ret
+
+    def _prepare(
+        self, image_name: str, force_RGB: bool
+    ) -> Tuple[int, Optional[bytes]]:
+        """
+        Size of the image, and its content as RGB PNG if it needs conversion, None otherwise.
+        PNG images are only decoded if they need conversion.
+        """
+        image_path = self.directory_path / image_name
+        header = png_header(image_path)
+        if header is not None:
+            width, height, _, color_type = header
+            to_convert = force_RGB and color_type != PNG_RGB_COLOR_TYPE
+        else:
+            with Image.open(image_path) as pil_img:
+                width, height = pil_img.size
+                to_convert = force_RGB and pil_img.mode != "RGB"
+        if not to_convert:
+            return width * height, None
+        converted = self._cached_conversion(image_name)
+        if converted is None:
+            with Image.open(image_path) as pil_img:
+                cvt_pil_img = pil_img.convert("RGB")
+            img_buffer = io.BytesIO()
+            cvt_pil_img.save(img_buffer, format="PNG")
+            converted = img_buffer.getvalue()
+            self._cache_conversion(image_name, converted)
+        return width * height, converted
+
+    def _cached_conversion(self, image_name: str) -> Optional[bytes]:
+        """
+        RGB conversion of the image from the cache, if any and done from the current image.
+        Cached conversions carry the modification time of their source image.
+        """
+        if self.rgb_cache_dir is None:
+            return None
+        try:
+            source_mtime = (self.directory_path / image_name).stat().st_mtime_ns
+            cached_path = self.rgb_cache_dir / image_name
+            if cached_path.stat().st_mtime_ns != source_mtime:
+                return None
+            return cached_path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _cache_conversion(self, image_name: str, converted: bytes) -> None:
+        """
+        Keep the RGB conversion of the image for next zips. Failures are harmless, the
+        conversion is just done again next time.
+        """
+        if self.rgb_cache_dir is None:
+            return
+        try:
+            source_stat = (self.directory_path / image_name).stat()
+            os.makedirs(self.rgb_cache_dir, exist_ok=True)
+            # Several threads or processes might convert the same image at the same time
+            tmp_path = (
+                self.rgb_cache_dir
+                / f".{image_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            tmp_path.write_bytes(converted)
+            os.utime(tmp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            os.replace(tmp_path, self.rgb_cache_dir / image_name)
+        except OSError:
+            pass
+
+    def _add_to_zip(
+        self,
+        zip_file: zipfile.ZipFile,
+        image_name: str,
+        prepared: Tuple[int, Optional[bytes]],
+    ) -> None:
+        """
+        Add a prepared image to the zip, and keep track of its size.
+        """
+        size, converted = prepared
+        if converted is not None:
+            # Add the converted image to the zip file
+            zip_file.writestr(
+                ZipInfo(image_name), converted, compress_type=zip_file.compression
+            )
+        else:
+            zip_file.write(self.directory_path / image_name, arcname=image_name)
+        self.size_by_name[image_name] = size
@@ -1,18 +1,29 @@
+import hashlib
 import json
 import os
 import shutil
+import threading
+import time
 from logging import Logger
 from pathlib import Path
-from typing import Tuple, Optional, List, NamedTuple
+from typing import Tuple, Optional, List, NamedTuple, Dict, Callable, Any, Iterable
 
 import requests
 
 from Models import MultiplesClassifierRsp
 from config_rdr import config
 from providers.ImageList import ImageList
-from providers.server import ping_DeepAAS_server
+from providers.server import ping_DeepAAS_server, post_zipped_images
 
-BASE_URI = "v2/models/zooprocess_multiple_classifier/predict/"
+MODEL_URI = "v2/models/zooprocess_multiple_classifier/"
+BASE_URI = MODEL_URI + "predict/"
+# Images per classifier request, and times a failed request is sent again (configurable through env)
+CLASSIFY_CHUNK_SIZE: int = int(os.getenv("CLASSIFY_CHUNK_SIZE", "500"))
+CLASSIFY_RETRIES: int = int(os.getenv("CLASSIFY_RETRIES", "2"))
+# Wait before retrying a failed request, multiplied by the attempt number
+RETRY_DELAY_SEC = 5
+# Most scores kept in the scores cache, least recently used ones are dropped (configurable through env)
+CLASSIFIER_SCORES_CACHED: int = int(os.getenv("CLASSIFIER_SCORES_CACHED", "200000"))
 
 
 class NameAndScore(NamedTuple):
@@ -20,15 +31,72 @@ class NameAndScore(NamedTuple):
     score: float
 
 
+class ScoresCache:
+    """
+    Classifier scores by image content, for a given model version, persisted in a JSON file.
+    Scores of another model version are dropped when the file is read, and least recently used
+    ones above CLASSIFIER_SCORES_CACHED when it's written.
+    """
+
+    def __init__(self, path: Path, model_version: str):
+        self.path = path
+        self.model_version = model_version
+        self.scores: Dict[str, float] = {}
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            if stored.get("model_version") == model_version:
+                self.scores = stored["scores"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    @staticmethod
+    def content_key(image_path: Path) -> str:
+        """Key of the image in cache, from its bytes only, so a renamed image is still known"""
+        return hashlib.blake2b(image_path.read_bytes(), digest_size=16).hexdigest()
+
+    def used(self, key: str) -> float:
+        """The score for this key, which becomes the most recently used one"""
+        ret = self.scores[key] = self.scores.pop(key)
+        return ret
+
+    def save(self) -> None:
+        excess = len(self.scores) - CLASSIFIER_SCORES_CACHED
+        for a_key in list(self.scores)[: max(excess, 0)]:
+            del self.scores[a_key]
+        os.makedirs(self.path.parent, exist_ok=True)
+        write_json(
+            self.path, {"model_version": self.model_version, "scores": self.scores}
+        )
+
+
+def write_json(path: Path, value: Any) -> None:
+    """
+    Replace the file with the value as JSON, only when complete.
+    The temporary file is unique per process and thread, so concurrent writers don't mix contents.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
 def classify_all_images_from(
     logger: Logger,
     img_path: Path,
     scores_path: Path,
     min_score: float,
     image_names: Optional[List[str]] = None,
+    rgb_cache_dir: Optional[Path] = None,
+    scores_cache: Optional[ScoresCache] = None,
+    progress: Optional[Callable[[int], None]] = None,
+    checkpoint: Optional[Callable[[], None]] = None,
+    run_id: Optional[str] = None,
 ) -> Tuple[List[NameAndScore], Optional[str]]:
     """
-    Process multiple images using the classifier service, parsing its JSON response.
+    Process multiple images using the classifier service, by chunks, parsing its JSON responses.
+    Scores are saved to scores_path after each chunk, and a new call with the same file resumes
+    from there for images with the same content, see checkpointed_scores.
     Returns a list of NameAndScore objects, one for each image which:
     - Has a higher score than the min_score, i.e. is 'likely' to be a multiple.
     - Is not too big (work around ML Separator weakness on large images).
@@ -37,8 +105,13 @@ def classify_all_images_from(
         logger: Logger instance
         min_score: Minimum classification score, images above this score are discarded
         img_path: Directory containing the images
-        scores_path: Pickle file containing the score for each image
+        scores_path: JSON file containing the score for each image
         image_names: Only use specified images, by file name. If not provided, all PNGs in img_path are used
+        rgb_cache_dir: Where to keep RGB conversions of the images, for later ML calls
+        scores_cache: Scores of already classified images, only other ones are sent
+        progress: Called with the number of images scored, after each chunk
+        checkpoint: Called before each request and each write, can raise to stop
+        run_id: Identifies the run, for resuming it even without scores_cache
 
     Returns:
         A tuple with:
@@ -48,32 +121,223 @@ def classify_all_images_from(
     logger.info(f"Finding potential multiples")
     logger.debug(f"Classifying images for multiples in: {img_path}")
 
-    # Create a zip file of images in a directory
-    image_list = ImageList(img_path, images=image_names)
-    zip_path = image_list.zipped(logger)
+    image_list = ImageList(img_path, images=image_names, rgb_cache_dir=rgb_cache_dir)
+    all_scores = checkpointed_scores(scores_path, image_list, scores_cache, run_id)
+    all_keys = None if run_id is None else content_keys(image_list, all_scores)
+    if len(all_scores) > 0:
+        logger.info(f"Resuming classification, {len(all_scores)} images already scored")
+        if progress is not None:
+            progress(len(all_scores))
+    to_classify = ImageList(
+        img_path,
+        [a_name for a_name in image_list.get_images() if a_name not in all_scores],
+        rgb_cache_dir=rgb_cache_dir,
+    )
+    for a_chunk in to_classify.split(CLASSIFY_CHUNK_SIZE):
+        if checkpoint is not None:
+            checkpoint()
+        chunk_scores, error = classify_images_with_retries(
+            logger, a_chunk, scores_cache, CLASSIFY_RETRIES, checkpoint
+        )
+        if chunk_scores is None:
+            return [], error
+        all_scores.update(chunk_scores)
+        if all_keys is not None:
+            all_keys.update(content_keys(a_chunk, chunk_scores))
+        image_list.size_by_name.update(a_chunk.size_by_name)
+        if checkpoint is not None:
+            checkpoint()
+        save_scores(scores_path, all_scores, all_keys, run_id)
+        if progress is not None:
+            progress(len(chunk_scores))
+    if to_classify.is_empty():
+        save_scores(scores_path, all_scores, all_keys, run_id)
+
+    above_threshold = likely_multiples(all_scores, image_list, min_score)
+    return above_threshold, None
+
+
+def checkpointed_scores(
+    scores_path: Path,
+    image_list: ImageList,
+    scores_cache: Optional[ScoresCache],
+    run_id: Optional[str] = None,
+) -> Dict[str, float]:
+    """
+    Scores of the images from a previous, maybe partial, classification saved in scores_path.
+    Only the scores matching the ones in cache for the current content of images are part of the
+    result. Without a cache, i.e. without knowing the classifier model, only scores saved by the
+    same run are reused, for images with the content recorded along with them.
+    """
+    stored = read_json(scores_path)
+    if not isinstance(stored, dict):
+        return {}
+    recorded_keys: Dict[str, str] = {}
+    if scores_cache is None:
+        recorded = read_json(content_keys_path(scores_path))
+        if run_id is None or not isinstance(recorded, dict):
+            return {}
+        if recorded.get("run_id") != run_id:
+            return {}
+        recorded_keys = recorded.get("keys") or {}
+    ret = {}
+    for a_name in image_list.get_images():
+        if a_name not in stored:
+            continue
+        try:
+            a_key = ScoresCache.content_key(image_list.directory_path / a_name)
+        except OSError:
+            continue
+        if scores_cache is not None:
+            same = scores_cache.scores.get(a_key) == stored[a_name]
+        else:
+            same = recorded_keys.get(a_name) == a_key
+        if same:
+            ret[a_name] = stored[a_name]
+    return ret
+
+
+def content_keys(image_list: ImageList, names: Iterable[str]) -> Dict[str, str]:
+    """Content key of each named image of the list"""
+    return {
+        a_name: ScoresCache.content_key(image_list.directory_path / a_name)
+        for a_name in names
+    }
+
+
+def content_keys_path(scores_path: Path) -> Path:
+    """Where the content keys of images scored in scores_path are recorded"""
+    return scores_path.with_name(f"{scores_path.stem}_keys.json")
+
+
+def save_scores(
+    scores_path: Path,
+    scores: Dict[str, float],
+    keys: Optional[Dict[str, str]] = None,
+    run_id: Optional[str] = None,
+) -> None:
+    """
+    Write the scores in images order, i.e. by name, replacing previous file only when complete.
+    The content keys of scored images, if provided, are recorded with the run which scored them.
+    """
+    keys_path = content_keys_path(scores_path)
+    if keys is not None and run_id is not None:
+        write_json(keys_path, {"run_id": run_id, "keys": dict(sorted(keys.items()))})
+    else:
+        keys_path.unlink(missing_ok=True)
+    write_json(scores_path, dict(sorted(scores.items())))
+
+
+def read_json(path: Path) -> Any:
+    """Content of the JSON file, None if missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def classify_images_with_retries(
+    logger: Logger,
+    image_list: ImageList,
+    scores_cache: Optional[ScoresCache],
+    retries: int,
+    checkpoint: Optional[Callable[[], None]] = None,
+) -> Tuple[Optional[Dict[str, float]], Optional[str]]:
+    """
+    Same as classify_images, sending the images again after a failure, up to retries times.
+    checkpoint is called before each retry, and can raise to stop.
+    """
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            if checkpoint is not None:
+                checkpoint()
+            logger.info(
+                f"Retrying {image_list.count()} images, attempt {attempt + 1}/{retries + 1}"
+            )
+            time.sleep(RETRY_DELAY_SEC * attempt)
+        scores, error = classify_images(logger, image_list, scores_cache)
+        if scores is not None:
+            break
+    return scores, error
+
+
+def classify_images(
+    logger: Logger, image_list: ImageList, scores_cache: Optional[ScoresCache] = None
+) -> Tuple[Optional[Dict[str, float]], Optional[str]]:
+    """
+    Score the images of the list using the classifier service, the higher the more likely a multiple.
+    Images with a score in scores_cache are not sent, the cache gets the fresh scores.
 
-    # Get JSON response from classifier
-    separation_response, error = call_classify_server(logger, zip_path)
+    Returns:
+        A tuple with:
+        - score per image name, None if failed
+        - Error message if any, None otherwise
+    """
+    if scores_cache is None:
+        return classify_images_on_server(logger, image_list)
+
+    keys = {
+        a_name: scores_cache.content_key(image_list.directory_path / a_name)
+        for a_name in image_list.get_images()
+    }
+    misses = [
+        a_name for a_name, a_key in keys.items() if a_key not in scores_cache.scores
+    ]
+    nb_hits = image_list.count() - len(misses)
+    logger.info(f"{nb_hits} images scores in cache, {len(misses)} to classify")
+    if len(misses) > 0:
+        to_send = ImageList(
+            image_list.directory_path, misses, rgb_cache_dir=image_list.rgb_cache_dir
+        )
+        fresh_scores, error = classify_images_on_server(logger, to_send)
+        if fresh_scores is None:
+            return None, error
+        image_list.size_by_name.update(to_send.size_by_name)
+        scores_cache.scores.update(
+            (keys[a_name], a_score) for a_name, a_score in fresh_scores.items()
+        )
+    ret = {a_name: scores_cache.used(a_key) for a_name, a_key in keys.items()}
+    if len(misses) > 0:
+        scores_cache.save()
+    for a_name in image_list.get_images():
+        if a_name not in image_list.size_by_name:
+            image_list.size_by_name[a_name] = image_list.size_of(a_name)
+    return ret, None
+
+
+def classify_images_on_server(
+    logger: Logger, image_list: ImageList
+) -> Tuple[Optional[Dict[str, float]], Optional[str]]:
+    """
+    Score all the images of the list using the classifier service.
+    """
+    # Get JSON response from classifier, the images zip being sent while built
+    separation_response, error = call_classify_server_with_images(logger, image_list)
 
     if not separation_response:
-        logger.error(f"Failed to process {zip_path}: {error}")
-        return [], error
+        logger.error(f"Failed to process {image_list.count()} images: {error}")
+        return None, error
 
-    logger.info(f"Successfully processed {zip_path}")
+    logger.info(f"Successfully processed {image_list.count()} images")
     nb_predictions = len(separation_response.scores)
     logger.info(f"Found {nb_predictions} predictions")
-    all_scores = dict(zip(separation_response.names, separation_response.scores))
-    above_threshold = [
+    return dict(zip(separation_response.names, separation_response.scores)), None
+
+
+def likely_multiples(
+    scores: Dict[str, float], image_list: ImageList, min_score: float
+) -> List[NameAndScore]:
+    """
+    The scored images which are above min_score, and not too big (work around ML Separator
+    weakness on large images). Sizes are the ones found when zipping image_list, if zipped.
+    """
+    return [
         NameAndScore(name, score)
-        for name, score in all_scores.items()
-        if score > min_score and image_list.size_by_name[name] < 2_000_000
+        for name, score in scores.items()
+        if score > min_score and image_list.size_of(name) < 2_000_000
     ]
 
-    with open(scores_path, "w") as scores_file:
-        json.dump(all_scores, scores_file)
-    os.unlink(zip_path)
-    return above_threshold, error
-
 
 def use_classifications(
     base_dir: Path, multiples_dir: Path, selected_names: list[str]
@@ -89,6 +353,28 @@ def ping_classify_server(log_to: Logger):
     return ping_DeepAAS_server(log_to, config.CLASSIFIER_SERVER)
 
 
+def classifier_model_version(log_to: Logger) -> Optional[str]:
+    """
+    Version of the classifier model, from the server metadata. None if unknown.
+    """
+    url = f"{config.CLASSIFIER_SERVER}{MODEL_URI}"
+    ok, metadata, _ = ping_DeepAAS_server(log_to, url)
+    if not ok or not isinstance(metadata, dict) or not metadata.get("version"):
+        log_to.warning("No classifier model version, scores are not cached")
+        return None
+    return str(metadata["version"])
+
+
+def classifier_scores_cache(log_to: Logger, cache_path: Path) -> Optional[ScoresCache]:
+    """
+    Scores cache for the current classifier model, None if it cannot be identified.
+    """
+    model_version = classifier_model_version(log_to)
+    if model_version is None:
+        return None
+    return ScoresCache(cache_path, model_version)
+
+
 def call_classify_server(
     logger: Logger, image_or_zip_path: Path, bottom_crop: int = 31
 ) -> Tuple[Optional[MultiplesClassifierRsp], Optional[str]]:
@@ -129,35 +415,56 @@ def call_classify_server(
             response = requests.post(
                 url, files=file_dict, headers=headers, timeout=(10, 600)
             )
-            logger.debug(f"Response status: {response.status_code}")
-
-            if not response.ok:
-                error_msg = (
-                    f"Request failed: {response.status_code} - {response.reason}"
-                )
-                logger.error(error_msg)
-                return None, error_msg
-            try:
-                # Parse the JSON response
-                response_data = response.json()
-
-                # Create a SeparationResponse object from the JSON
-                classification_response = MultiplesClassifierRsp(**response_data)
-
-                # Log success
-                logger.info(
-                    f"Successfully parsed separation response for {image_or_zip_path}"
-                )
-                logger.info(f"Found {len(classification_response.scores)} predictions")
-
-                return classification_response, None
-
-            except Exception as e:
-                error_msg = f"Error parsing JSON response: {str(e)}"
-                logger.error(error_msg)
-                return None, error_msg
+            return classifier_response(logger, response, str(image_or_zip_path))
 
     except Exception as e:
         error_msg = f"Error sending request: {str(e)}"
         logger.error(error_msg)
         return None, error_msg
+
+
+def call_classify_server_with_images(
+    logger: Logger, image_list: ImageList, bottom_crop: int = 31
+) -> Tuple[Optional[MultiplesClassifierRsp], Optional[str]]:
+    """
+    Same as call_classify_server, for the images of the list, zipped while sent.
+    """
+    try:
+        url = f"{config.CLASSIFIER_SERVER}{BASE_URI}?bottom_crop={bottom_crop}"
+        logger.info("Request to multiples classifier service")
+        logger.debug(f"url: {url}")
+        response = post_zipped_images(logger, url, image_list, timeout=(10, 600))
+        return classifier_response(logger, response, f"{image_list.count()} images")
+    except Exception as e:
+        error_msg = f"Error sending request: {str(e)}"
+        logger.error(error_msg)
+        return None, error_msg
+
+
+def classifier_response(
+    logger: Logger, response: requests.Response, sent: str
+) -> Tuple[Optional[MultiplesClassifierRsp], Optional[str]]:
+    """Parse the classifier service response to what was sent"""
+    logger.debug(f"Response status: {response.status_code}")
+
+    if not response.ok:
+        error_msg = f"Request failed: {response.status_code} - {response.reason}"
+        logger.error(error_msg)
+        return None, error_msg
+    try:
+        # Parse the JSON response
+        response_data = response.json()
+
+        # Create a SeparationResponse object from the JSON
+        classification_response = MultiplesClassifierRsp(**response_data)
+
+        # Log success
+        logger.info(f"Successfully parsed separation response for {sent}")
+        logger.info(f"Found {len(classification_response.scores)} predictions")
+
+        return classification_response, None
+
+    except Exception as e:
+        error_msg = f"Error parsing JSON response: {str(e)}"
+        logger.error(error_msg)
+        return None, error_msg
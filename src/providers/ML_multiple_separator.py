@@ -1,8 +1,9 @@
 import os
 import random
+import time
 from logging import Logger
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Callable
 
 import cv2
 import requests
@@ -12,12 +13,22 @@ from ZooProcess_lib.img_tools import load_image, saveimage
 from config_rdr import config
 from helpers.logger import logger
 from providers.ImageList import ImageList
-from providers.server import ping_DeepAAS_server
+from providers.server import ping_DeepAAS_server, post_zipped_images
 
 BGR_RED_COLOR = (0, 0, 255)
 RGB_RED_COLOR = (255, 0, 0)
 
 BASE_URI = "v2/models/zooprocess_multiple_separator/predict/"
+# Wait before retrying a failed request, multiplied by the attempt number
+RETRY_DELAY_SEC = 5
+# Wait for the response to a request of images
+SEPARATOR_TIMEOUT_SEC = 7200  # TODO: Remove after ML fix
+# Optionally, wait per image instead, with a minimum, 0 for not doing so (configurable through env).
+# Requests are retried, so a stuck server blocks the job for about (retries + 1) times the wait.
+SEPARATOR_TIMEOUT_PER_IMAGE_SEC: int = int(
+    os.getenv("SEPARATOR_TIMEOUT_PER_IMAGE_SEC", "0")
+)
+SEPARATOR_MIN_TIMEOUT_SEC = 120
 
 
 def ping_separator_server(log_to: Logger):
@@ -73,6 +84,8 @@ def separate_each_image_from(
 def separate_all_images_from(
     logger: Logger,
     image_list: ImageList,
+    retries: int = 0,
+    checkpoint: Optional[Callable[[], None]] = None,
 ) -> Tuple[Optional[MultiplesSeparatorRsp], Optional[str]]:
     """
     Process multiple images using the separator service and parse the JSON responses.
@@ -80,26 +93,33 @@ def separate_all_images_from(
     Args:
         logger: Logger instance
         image_list: ImageList containing the images to process
+        retries: Number of times the request is sent again after a failure
+        checkpoint: Called before each retry, can raise to stop
 
     Returns:
         List of tuples, each containing:
         - SeparationResponse object parsed from the JSON response
         - Error message if any, None otherwise
     """
-    # Create a zip file of images from the ImageList
-    zip_path = image_list.zipped(logger)
-
-    # Get JSON response
-    separation_response, error = call_separate_server(zip_path)
+    sent = f"{image_list.count()} images"
+    # Get JSON response, the images zip being sent while built
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            if checkpoint is not None:
+                checkpoint()
+            logger.info(f"Retrying {sent}, attempt {attempt + 1}/{retries + 1}")
+            time.sleep(RETRY_DELAY_SEC * attempt)
+        separation_response, error = call_separate_server_with_images(image_list)
+        if separation_response:
+            break
 
     if not separation_response:
-        logger.error(f"Failed to process {zip_path}: {error}")
+        logger.error(f"Failed to process {sent}: {error}")
         return separation_response, error
 
-    logger.info(f"Successfully processed {zip_path}")
+    logger.info(f"Successfully processed {sent}")
     nb_predictions = len(separation_response.predictions)
     logger.info(f"Got {nb_predictions} predictions")
-    os.unlink(zip_path)
     return separation_response, error
 
 
@@ -191,40 +211,69 @@ def call_separate_server(
                 headers=headers,
                 timeout=(10, 7200),  # TODO: Remove after ML fix
             )
-            logger.info(f"Response status: {response.status_code}")
-
-            if not response.ok:
-                error_msg = (
-                    f"Request failed: {response.status_code} - {response.reason}"
-                )
-                logger.error(error_msg)
-                return None, error_msg
-            try:
-                # Parse the JSON response
-                response_data = response.json()
-
-                # Create a SeparationResponse object from the JSON
-                separation_response = MultiplesSeparatorRsp(**response_data)
-
-                # Log success
-                logger.info(
-                    f"Successfully parsed separation response for {image_or_zip_path}"
-                )
-                logger.info(f"Found {len(separation_response.predictions)} predictions")
-
-                return separation_response, None
-
-            except Exception as e:
-                error_msg = f"Error parsing JSON response: {str(e)}"
-                logger.error(error_msg)
-                return None, error_msg
+            return separator_response(response, str(image_or_zip_path))
+
+    except Exception as e:
+        error_msg = f"Error sending request: {str(e)}"
+        logger.error(error_msg)
+        return None, error_msg
 
+
+def call_separate_server_with_images(
+    image_list: ImageList, bottom_crop: int = 31
+) -> Tuple[Optional[MultiplesSeparatorRsp], Optional[str]]:
+    """
+    Same as call_separate_server, for the images of the list, zipped while sent.
+    """
+    try:
+        url = f"{config.SEPARATOR_SERVER}{BASE_URI}?bottom_crop={bottom_crop}"
+        logger.info("Request to separator service")
+        logger.debug(f"url: {url}")
+        read_timeout = SEPARATOR_TIMEOUT_SEC
+        if SEPARATOR_TIMEOUT_PER_IMAGE_SEC > 0:
+            read_timeout = max(
+                SEPARATOR_MIN_TIMEOUT_SEC,
+                SEPARATOR_TIMEOUT_PER_IMAGE_SEC * image_list.count(),
+            )
+        response = post_zipped_images(
+            logger, url, image_list, timeout=(10, read_timeout)
+        )
+        return separator_response(response, f"{image_list.count()} images")
     except Exception as e:
         error_msg = f"Error sending request: {str(e)}"
         logger.error(error_msg)
         return None, error_msg
 
 
+def separator_response(
+    response: requests.Response, sent: str
+) -> Tuple[Optional[MultiplesSeparatorRsp], Optional[str]]:
+    """Parse the separator service response to what was sent"""
+    logger.info(f"Response status: {response.status_code}")
+
+    if not response.ok:
+        error_msg = f"Request failed: {response.status_code} - {response.reason}"
+        logger.error(error_msg)
+        return None, error_msg
+    try:
+        # Parse the JSON response
+        response_data = response.json()
+
+        # Create a SeparationResponse object from the JSON
+        separation_response = MultiplesSeparatorRsp(**response_data)
+
+        # Log success
+        logger.info(f"Successfully parsed separation response for {sent}")
+        logger.info(f"Found {len(separation_response.predictions)} predictions")
+
+        return separation_response, None
+
+    except Exception as e:
+        error_msg = f"Error parsing JSON response: {str(e)}"
+        logger.error(error_msg)
+        return None, error_msg
+
+
 def do_separation_file_by_file(
     to_separate: Path,
 ) -> List[
@@ -1,8 +1,11 @@
+import uuid
 from logging import Logger
-from typing import Tuple, Optional, Dict
+from typing import Tuple, Optional, Dict, Iterator
 
 import requests
 
+from providers.ImageList import ImageList
+
 
 def ping_DeepAAS_server(
     log_to: Logger, url: str
@@ -49,3 +52,33 @@ def ping_DeepAAS_server(
         error_msg = f"Error sending ping request: {str(e)}"
         log_to.error(error_msg)
         return False, None, error_msg
+
+
+def post_zipped_images(
+    logger: Logger,
+    url: str,
+    image_list: ImageList,
+    timeout: Tuple[int, int],
+    force_RGB: bool = True,
+) -> requests.Response:
+    """
+    POST the images, zipped, as the 'images' field of a multipart form.
+    The zip is produced while the request is sent, so the server gets first bytes immediately
+    and nothing is written to disk.
+    """
+    boundary = uuid.uuid4().hex
+
+    def body() -> Iterator[bytes]:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="images"; filename="images.zip"\r\n'
+            f"Content-Type: application/zip\r\n\r\n"
+        ).encode()
+        yield from image_list.zip_chunks(logger, force_RGB)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    headers = {
+        "accept": "application/json",
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+    }
+    return requests.post(url, data=body(), headers=headers, timeout=timeout)
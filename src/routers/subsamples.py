@@ -52,7 +52,7 @@ from modern.jobs.FreshScanToVignettes import FreshScanToVignettes
 from modern.jobs.VerifiedSepToUpload import VerifiedSeparationToEcoTaxa
 from modern.jobs.VignettesToAutoSep import VignettesToAutoSeparated
 from modern.subsample import get_project_scans_metadata, add_subsample
-from modern.tasks import JobScheduler, Job
+from modern.tasks import JobScheduler, Job, JobPriorityEnum
 from modern.utils import job_to_task_rsp
 from .utils import validate_path_components
 
@@ -339,7 +339,8 @@ def process_subsample(
     project_hash: str,
     sample_hash: str,
     subsample_hash: str,
-    _user=Depends(get_current_user_from_credentials),
+    batch: bool = False,
+    user=Depends(get_current_user_from_credentials),
     ecotaxa_token: str = Depends(get_ecotaxa_token_from_credentials),
     db: Session = Depends(get_db),
 ) -> ProcessRsp:
@@ -350,7 +351,8 @@ def process_subsample(
         project_hash (str): The ID of the project.
         sample_hash (str): The hash of the sample.
         subsample_hash (str): The hash of the subsample to process.
-        _user: User from authentication.
+        batch (bool): Part of a bulk (re-)processing, which can wait for interactive requests.
+        user: User from authentication.
         db: Database dependency.
 
     Returns:
@@ -400,7 +402,9 @@ def process_subsample(
         with JobScheduler.jobs_lock:
             there_tasks = JobScheduler.find_jobs_like(to_launch, job_state)
             if len(there_tasks) == 0:
-                JobScheduler.submit(to_launch)
+                # Otherwise the job class knows if an operator waits for it
+                priority = JobPriorityEnum.Batch if batch else None
+                JobScheduler.submit(to_launch, priority=priority, owner=user.email)
                 ret = to_launch
             else:
                 ret = there_tasks[-1]
@@ -525,7 +529,7 @@ async def get_subsample_scan(
     else:
         real_files: List[Path] = list(
             filter(
-                lambda p: isinstance(p, Path) and p.name == img_name,  # type:ignore
+                lambda p: isinstance(p, Path) and p.name == img_name,  # type: ignore
                 subsample_files.values(),
             )
         )
@@ -1,5 +1,8 @@
-from fastapi import APIRouter, Depends
+from typing import Dict, AsyncIterator, List
+
+from fastapi import APIRouter, Depends, Request
 from sqlalchemy.orm import Session
+from starlette.responses import StreamingResponse
 
 from Models import TaskRsp
 from helpers.auth import get_current_user_from_credentials
@@ -7,8 +10,13 @@ from helpers.logger import logger
 from helpers.web import raise_500, raise_404
 from local_DB.db_dependencies import get_db
 from local_DB.models import User
-from modern.tasks import JobScheduler
+from modern.job_events import JobEvents, JobEventsSubscription
+from modern.tasks import JobScheduler, Job
 from modern.utils import job_to_task_rsp
+from routers.utils import validate_path_components
+
+# Delay after which a comment is sent on an idle event stream, so that proxies keep it open
+EVENTS_KEEP_ALIVE_SEC = 15
 
 # Create a router instance with prefix "/task"
 router = APIRouter(
@@ -17,6 +25,17 @@ router = APIRouter(
 )
 
 
+@router.get("/metrics")
+def get_tasks_metrics(
+    _user: User = Depends(get_current_user_from_credentials),
+) -> Dict[str, Dict[str, float]]:
+    """
+    Get scheduling metrics, i.e. how long jobs waited in queue before starting.
+    """
+    with JobScheduler.jobs_lock:
+        return {"queue_wait": JobScheduler.queue_wait.as_dict()}
+
+
 @router.get("/{task_id}")
 def get_task(
     task_id: str,
@@ -50,3 +69,123 @@ def get_task(
         # If task_id is not a valid integer, continue to default response
         raise_500(f"Invalid task ID format: {task_id}")
     assert False
+
+
+@router.delete("/{task_id}")
+def cancel_task(
+    task_id: str,
+    _user: User = Depends(get_current_user_from_credentials),
+) -> TaskRsp:
+    """
+    Cancel a task by ID.
+
+    A pending task is removed from the queue. A running one is stopped, its slot is given
+    to the next task, and its partial outputs are removed. A done task is left as is.
+
+    Args:
+        task_id (str): The ID of the task to cancel.
+
+    Returns:
+        TaskRsp: The task status after cancellation.
+    """
+    logger.info(f"Received request to cancel task with ID: {task_id}")
+    try:
+        job_id = int(task_id)
+    except (ValueError, TypeError):
+        raise_500(f"Invalid task ID format: {task_id}")
+        assert False
+    job = JobScheduler.cancel(job_id)
+    if job is None:
+        raise_404(f"{task_id} not found")
+    return job_to_task_rsp(job)
+
+
+def task_event(job: Job) -> str:
+    """Format the job status as a server-sent event."""
+    return f"event: task\ndata: {job_to_task_rsp(job).model_dump_json()}\n\n"
+
+
+async def stream_task_events(
+    request: Request,
+    subscription: JobEventsSubscription,
+    initial_jobs: List[Job],
+    stop_when_done: bool,
+) -> AsyncIterator[str]:
+    """
+    Emit current status of initial jobs, then each change, until the client goes away
+    or, if requested, the single watched job is done.
+    """
+    try:
+        for a_job in initial_jobs:
+            yield task_event(a_job)
+        if stop_when_done and all(a_job.is_done() for a_job in initial_jobs):
+            return
+        while not await request.is_disconnected():
+            changed_jobs = await subscription.next_changes(EVENTS_KEEP_ALIVE_SEC)
+            if len(changed_jobs) == 0:
+                yield ": keep-alive\n\n"
+                continue
+            for a_job in changed_jobs:
+                yield task_event(a_job)
+            if stop_when_done and all(a_job.is_done() for a_job in changed_jobs):
+                return
+    finally:
+        JobEvents.unsubscribe(subscription)
+
+
+def events_response(events: AsyncIterator[str]) -> StreamingResponse:
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events, headers=headers, media_type="text/event-stream")
+
+
+@router.get("/{task_id}/events")
+async def get_task_events(
+    task_id: str,
+    request: Request,
+    _user: User = Depends(get_current_user_from_credentials),
+) -> StreamingResponse:
+    """
+    Stream the status of a task, as server-sent events, until it's done.
+
+    Each event is named "task" and its data is the TaskRsp JSON, the first one
+    being the current status. Replaces polling of GET /task/{task_id}.
+    """
+    logger.info(f"Received request to stream task with ID: {task_id}")
+    try:
+        job_id = int(task_id)
+    except (ValueError, TypeError):
+        raise_500(f"Invalid task ID format: {task_id}")
+        assert False
+    # Subscribe before reading the status, so that no change is missed in between
+    subscription = JobEvents.subscribe(lambda a_job: a_job.job_id == job_id)
+    job = JobScheduler.get_job(job_id)
+    if job is None:
+        JobEvents.unsubscribe(subscription)
+        raise_404(f"{task_id} not found")
+        assert False
+    return events_response(stream_task_events(request, subscription, [job], True))
+
+
+@router.get("/project/{project_hash}/events")
+async def get_project_tasks_events(
+    project_hash: str,
+    request: Request,
+    _user: User = Depends(get_current_user_from_credentials),
+    db: Session = Depends(get_db),
+) -> StreamingResponse:
+    """
+    Stream the status of all tasks of a project, as server-sent events.
+
+    First events are the current status of the project's tasks known to this server run,
+    then each change of these or of new ones. The stream ends when the client disconnects.
+    """
+    logger.info(f"Received request to stream tasks of project: {project_hash}")
+    _, zoo_project, _, _ = validate_path_components(db, project_hash)
+    project_id = str(zoo_project.path)
+
+    def in_project(a_job: Job) -> bool:
+        return a_job.project_id() == project_id
+
+    subscription = JobEvents.subscribe(in_project)
+    jobs = JobScheduler.find_jobs(in_project)
+    return events_response(stream_task_events(request, subscription, jobs, False))
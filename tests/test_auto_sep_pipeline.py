@@ -0,0 +1,240 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import modern.jobs.VignettesToAutoSep
+from modern.jobs.VignettesToAutoSep import VignettesToAutoSeparated
+from modern.tasks import JobCancelledError
+from providers.ML_multiple_classifier import ScoresCache
+
+
+class FakeServers:
+    """Classifier and separator calls, with their order, scoring multiples every third image"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.classified = []
+        self.separated = []
+        self.shown = []
+        self.classifier_error_at = None
+        self.separator_error_at = None
+        self.classify_delay = 0.0
+        self.multiple_score = 0.9
+        self.separate_delays = {}
+        # Most separator requests sent and not used yet
+        self.max_outstanding = 0
+
+    def classify(self, logger, image_list, scores_cache, retries, checkpoint=None):
+        time.sleep(self.classify_delay)
+        with self.lock:
+            self.classified.append(image_list.get_images())
+            if len(self.classified) == self.classifier_error_at:
+                return None, "Classifier is down"
+        scores = {
+            a_name: self.multiple_score if int(a_name[4:7]) % 3 == 0 else 0.1
+            for a_name in image_list.get_images()
+        }
+        if scores_cache is not None:
+            for a_name, a_score in scores.items():
+                a_key = scores_cache.content_key(image_list.directory_path / a_name)
+                scores_cache.scores[a_key] = a_score
+            scores_cache.save()
+        return scores, None
+
+    def separate(self, logger, image_list, retries=0, checkpoint=None):
+        with self.lock:
+            self.separated.append(image_list.get_images())
+            rank = len(self.separated)
+            self.max_outstanding = max(
+                self.max_outstanding, len(self.separated) - len(self.shown)
+            )
+        time.sleep(self.separate_delays.get(rank, 0))
+        if rank == self.separator_error_at:
+            return None, "Separator is down"
+        return image_list.get_images(), None
+
+    def show(self, base_dir, separation_response, separated_dir):
+        self.shown.append(separation_response)
+        return []
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    module = modern.jobs.VignettesToAutoSep
+    ret = FakeServers()
+    monkeypatch.setattr(module, "classify_images_with_retries", ret.classify)
+    monkeypatch.setattr(module, "separate_all_images_from", ret.separate)
+    monkeypatch.setattr(module, "show_separations_in_images", ret.show)
+    monkeypatch.setattr(module, "classifier_scores_cache", lambda *args: None)
+    monkeypatch.setattr(module, "CLASSIFY_CHUNK_SIZE", 5)
+    monkeypatch.setattr(module, "SEPARATE_CHUNK_SIZE", 2)
+    monkeypatch.setattr(module, "SEPARATOR_IN_FLIGHT", 3)
+    return ret
+
+
+def auto_sep_job(tmp_path, nb_images: int) -> VignettesToAutoSeparated:
+    zoo_project = SimpleNamespace(
+        path=tmp_path / "project",
+        name="project",
+        zooscan_scan=SimpleNamespace(path=tmp_path / "project" / "Zooscan_scan"),
+        zooscan_config=None,
+    )
+    ret = VignettesToAutoSeparated(zoo_project, "sample", "sample_1")
+    ret.cut_dir.mkdir(parents=True, exist_ok=True)
+    for idx in range(nb_images):
+        Image.new("L", (4, 4), idx).save(ret.cut_dir / f"img_{idx:03}.png")
+    return ret
+
+
+def test_separations_are_used_in_sending_order(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 30)
+    # The first request is the slowest
+    servers.separate_delays = {1: 0.2}
+    job.run()
+
+    multiples = [f"img_{idx:03}.png" for idx in range(0, 30, 3)]
+    assert [a_name for a_chunk in servers.separated for a_name in a_chunk] == multiples
+    assert servers.shown == servers.separated
+    with open(job.scores_file) as f:
+        assert len(json.load(f)) == 30
+    assert job.modern_fs.SEP_generated_file_path.exists()
+    assert job.progress.stage == "separate"
+    assert job.progress.done == job.progress.total == len(multiples)
+
+
+@pytest.mark.parametrize("in_flight", [1, 3])
+def test_separator_window(tmp_path, servers, monkeypatch, in_flight):
+    monkeypatch.setattr(
+        modern.jobs.VignettesToAutoSep, "SEPARATOR_IN_FLIGHT", in_flight
+    )
+    job = auto_sep_job(tmp_path, 60)
+    servers.separate_delays = {rank: 0.02 for rank in range(1, 11)}
+    job.run()
+
+    assert len(servers.shown) == 10
+    assert servers.max_outstanding == in_flight
+
+
+def test_no_multiples(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 30)
+    servers.multiple_score = 0.2
+    job.run()
+
+    assert servers.separated == []
+    assert job.modern_fs.SEP_generated_file_path.exists()
+    assert job.progress.stage == "separate"
+    assert job.progress.done == job.progress.total == 0
+
+
+def test_classifier_failure_fails_the_job(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 30)
+    servers.classifier_error_at = 3
+    with pytest.raises(AssertionError, match="Classifier is down"):
+        job.run()
+
+    # Chunks scored before the failure are checkpointed
+    with open(job.scores_file) as f:
+        assert len(json.load(f)) == 10
+    assert not job.modern_fs.SEP_generated_file_path.exists()
+
+
+def test_resume_after_failure(tmp_path, servers, monkeypatch):
+    monkeypatch.setattr(
+        modern.jobs.VignettesToAutoSep,
+        "classifier_scores_cache",
+        lambda logger, path: ScoresCache(path, "1.0"),
+    )
+    job = auto_sep_job(tmp_path, 30)
+    servers.classifier_error_at = 3
+    with pytest.raises(AssertionError, match="Classifier is down"):
+        job.run()
+    # Cancelling keeps the checkpoint
+    job._cleanup_work()
+    assert not job.multiples_dir.exists()
+
+    servers.classifier_error_at = None
+    servers.classified.clear()
+    servers.shown.clear()
+    # Same images written again
+    job = auto_sep_job(tmp_path, 30)
+    job.run()
+
+    # Only images after the checkpoint are classified again
+    assert servers.classified == [
+        [f"img_{idx:03}.png" for idx in range(start, start + 5)]
+        for start in range(10, 30, 5)
+    ]
+    multiples = [f"img_{idx:03}.png" for idx in range(0, 30, 3)]
+    assert sorted(a_name for a_chunk in servers.shown for a_name in a_chunk) == (
+        multiples
+    )
+    with open(job.scores_file) as f:
+        assert list(json.load(f)) == [f"img_{idx:03}.png" for idx in range(30)]
+
+
+def test_resume_without_model_version(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 30)
+    servers.classifier_error_at = 3
+    with pytest.raises(AssertionError, match="Classifier is down"):
+        job.run()
+
+    servers.classifier_error_at = None
+    servers.classified.clear()
+    # Another job for the same subsample
+    job = auto_sep_job(tmp_path, 30)
+    job.run()
+
+    assert servers.classified == [
+        [f"img_{idx:03}.png" for idx in range(start, start + 5)]
+        for start in range(10, 30, 5)
+    ]
+    with open(job.scores_file) as f:
+        assert len(json.load(f)) == 30
+
+
+def test_separator_failure_stops_classifying(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 200)
+    servers.classify_delay = 0.02
+    servers.separator_error_at = 1
+    with pytest.raises(AssertionError, match="Separator is down"):
+        job.run()
+
+    # The classifier was stopped before the job returned
+    assert not any(
+        a_thread.name.endswith("classifier") for a_thread in threading.enumerate()
+    )
+    classified = len(servers.classified)
+    time.sleep(0.2)
+    assert len(servers.classified) == classified
+    assert len(servers.classified) < 200 / 5
+    assert not job.modern_fs.SEP_generated_file_path.exists()
+
+
+def test_cancel_during_separation(tmp_path, servers):
+    job = auto_sep_job(tmp_path, 30)
+    # The first request takes long
+    servers.separate_delays = {1: 5}
+    outcome = []
+
+    def run_job():
+        try:
+            job.run()
+        except JobCancelledError as e:
+            outcome.append(e)
+
+    runner = threading.Thread(target=run_job)
+    start = time.monotonic()
+    runner.start()
+    while len(servers.separated) == 0:
+        time.sleep(0.01)
+    job.cancel_token.cancel()
+    runner.join(timeout=4)
+
+    assert not runner.is_alive()
+    assert len(outcome) == 1
+    assert time.monotonic() - start < 4
+    assert not job.modern_fs.SEP_generated_file_path.exists()
@@ -0,0 +1,204 @@
+import json
+import logging
+
+from PIL import Image
+
+import providers.ML_multiple_classifier
+from providers.ImageList import ImageList
+from providers.ML_multiple_classifier import (
+    ScoresCache,
+    classify_all_images_from,
+    classify_images,
+    checkpointed_scores,
+    content_keys_path,
+    save_scores,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def test_only_unknown_images_are_sent(tmp_path, monkeypatch):
+    img_dir = tmp_path / "cuts"
+    img_dir.mkdir()
+    for i in range(3):
+        Image.new("L", (10 + i, 10), i).save(img_dir / f"img_{i}.png")
+    sent = []
+
+    def fake_server(_logger, image_list):
+        sent.append(list(image_list.get_images()))
+        image_list.size_by_name.update(
+            (a_name, image_list.size_of(a_name)) for a_name in image_list.get_images()
+        )
+        return {a_name: 0.5 for a_name in image_list.get_images()}, None
+
+    monkeypatch.setattr(
+        providers.ML_multiple_classifier, "classify_images_on_server", fake_server
+    )
+    cache_path = tmp_path / "scores.json"
+    scores, _ = classify_images(
+        logger, ImageList(img_dir, ["img_0.png"]), ScoresCache(cache_path, "1.0")
+    )
+    assert scores == {"img_0.png": 0.5}
+
+    # Same content under another name is known, cache is read back from file
+    (img_dir / "img_0.png").rename(img_dir / "renamed.png")
+    image_list = ImageList(img_dir)
+    scores, _ = classify_images(logger, image_list, ScoresCache(cache_path, "1.0"))
+    assert sent == [["img_0.png"], ["img_1.png", "img_2.png"]]
+    assert list(scores) == ["img_1.png", "img_2.png", "renamed.png"]
+    assert image_list.size_by_name == {
+        "img_1.png": 110,
+        "img_2.png": 120,
+        "renamed.png": 100,
+    }
+
+    # Another model version scores everything again
+    classify_images(logger, ImageList(img_dir), ScoresCache(cache_path, "2.0"))
+    assert sent[-1] == ["img_1.png", "img_2.png", "renamed.png"]
+
+
+def test_classification_resumes_from_checkpoint(tmp_path, monkeypatch):
+    img_dir = tmp_path / "cuts"
+    img_dir.mkdir()
+    for i in range(5):
+        Image.new("L", (10, 10), i).save(img_dir / f"img_{i}.png")
+    sent = []
+    failing = {"img_3.png"}
+
+    def fake_server(_logger, image_list):
+        names = list(image_list.get_images())
+        sent.append(names)
+        if failing.intersection(names):
+            return None, "Request failed: 502"
+        return {a_name: int(a_name[4]) / 10 for a_name in names}, None
+
+    monkeypatch.setattr(
+        providers.ML_multiple_classifier, "classify_images_on_server", fake_server
+    )
+    monkeypatch.setattr(providers.ML_multiple_classifier, "CLASSIFY_CHUNK_SIZE", 2)
+    monkeypatch.setattr(providers.ML_multiple_classifier, "CLASSIFY_RETRIES", 0)
+    scores_path = tmp_path / "score_per_image.json"
+    cache_path = tmp_path / "classifier_scores.json"
+    multiples, error = classify_all_images_from(
+        logger, img_dir, scores_path, 0.15, scores_cache=ScoresCache(cache_path, "1.0")
+    )
+    assert error == "Request failed: 502"
+    assert json.loads(scores_path.read_text()) == {"img_0.png": 0.0, "img_1.png": 0.1}
+
+    # Next call only sends the missing images, and images changed since the checkpoint
+    failing.clear()
+    sent.clear()
+    Image.new("L", (10, 10), 99).save(img_dir / "img_1.png")
+    done = []
+    multiples, error = classify_all_images_from(
+        logger,
+        img_dir,
+        scores_path,
+        0.15,
+        scores_cache=ScoresCache(cache_path, "1.0"),
+        progress=done.append,
+    )
+    assert error is None
+    assert sent == [["img_1.png", "img_2.png"], ["img_3.png", "img_4.png"]]
+    assert done == [1, 2, 2]
+    assert [a_multiple.name for a_multiple in multiples] == [
+        "img_2.png",
+        "img_3.png",
+        "img_4.png",
+    ]
+    assert list(json.loads(scores_path.read_text())) == [
+        f"img_{i}.png" for i in range(5)
+    ]
+
+
+def test_checkpoint_is_only_reused_for_known_contents(tmp_path):
+    img_dir = tmp_path / "cuts"
+    img_dir.mkdir()
+    for i in range(3):
+        Image.new("L", (10, 10), i).save(img_dir / f"img_{i}.png")
+    image_list = ImageList(img_dir)
+    scores_path = tmp_path / "score_per_image.json"
+    cache = ScoresCache(tmp_path / "classifier_scores.json", "1.0")
+    cache.scores = {
+        cache.content_key(img_dir / "img_0.png"): 0.5,
+        cache.content_key(img_dir / "img_1.png"): 0.2,
+    }
+    save_scores(scores_path, {"img_2.png": 0.1, "img_1.png": 0.9, "img_0.png": 0.5})
+    assert list(json.loads(scores_path.read_text())) == [
+        "img_0.png",
+        "img_1.png",
+        "img_2.png",
+    ]
+
+    # img_1 was scored by another model, img_2 is unknown
+    assert checkpointed_scores(scores_path, image_list, cache) == {"img_0.png": 0.5}
+    # Without a cache, the model is unknown, and the content of images when scored too
+    assert checkpointed_scores(scores_path, image_list, None, "run1") == {}
+    # Unreadable checkpoint
+    scores_path.write_text("{")
+    assert checkpointed_scores(scores_path, image_list, cache) == {}
+    scores_path.unlink()
+    assert checkpointed_scores(scores_path, image_list, cache) == {}
+
+
+def test_resume_without_model_version_is_for_same_run(tmp_path, monkeypatch):
+    img_dir = tmp_path / "cuts"
+    img_dir.mkdir()
+    for i in range(4):
+        Image.new("L", (10, 10), i).save(img_dir / f"img_{i}.png")
+    sent = []
+    failing = {"img_2.png"}
+
+    def fake_server(_logger, image_list):
+        names = list(image_list.get_images())
+        sent.append(names)
+        if failing.intersection(names):
+            return None, "Request failed: 502"
+        return {a_name: 0.5 for a_name in names}, None
+
+    monkeypatch.setattr(
+        providers.ML_multiple_classifier, "classify_images_on_server", fake_server
+    )
+    monkeypatch.setattr(providers.ML_multiple_classifier, "CLASSIFY_CHUNK_SIZE", 2)
+    monkeypatch.setattr(providers.ML_multiple_classifier, "CLASSIFY_RETRIES", 0)
+    scores_path = tmp_path / "score_per_image.json"
+    _, error = classify_all_images_from(
+        logger, img_dir, scores_path, 0.4, run_id="run1"
+    )
+    assert error is not None
+    assert list(json.loads(content_keys_path(scores_path).read_text())["keys"]) == [
+        "img_0.png",
+        "img_1.png",
+    ]
+
+    # Another run does not know which model scored them
+    image_list = ImageList(img_dir)
+    assert checkpointed_scores(scores_path, image_list, None, "run2") == {}
+    # The same one does, and images changed since are not reused
+    Image.new("L", (10, 10), 99).save(img_dir / "img_1.png")
+    failing.clear()
+    sent.clear()
+    _, error = classify_all_images_from(
+        logger, img_dir, scores_path, 0.4, run_id="run1"
+    )
+    assert error is None
+    assert sent == [["img_1.png", "img_2.png"], ["img_3.png"]]
+    assert len(json.loads(scores_path.read_text())) == 4
+
+    # Scores without keys don't leave stale ones
+    save_scores(scores_path, {"img_0.png": 0.5})
+    assert not content_keys_path(scores_path).exists()
+
+
+def test_scores_cache_drops_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(providers.ML_multiple_classifier, "CLASSIFIER_SCORES_CACHED", 2)
+    cache_path = tmp_path / "classifier_scores.json"
+    cache = ScoresCache(cache_path, "1.0")
+    cache.scores = {"k1": 0.1, "k2": 0.2}
+    assert cache.used("k1") == 0.1
+    cache.scores["k3"] = 0.3
+    cache.save()
+
+    assert ScoresCache(cache_path, "1.0").scores == {"k1": 0.1, "k3": 0.3}
+    # Nothing left behind by the writer
+    assert [a_path.name for a_path in tmp_path.iterdir()] == [cache_path.name]
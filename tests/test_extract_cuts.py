@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+import modern.jobs.VignettesToAutoSep
+from modern.jobs.VignettesToAutoSep import extract_cuts
+from modern.tasks import JobProgress
+from test_tiling import FakeROI
+
+
+class FakeExtractor:
+    """Writes the image under each ROI mask as a PNG named after the ROI position"""
+
+    def __init__(self):
+        self.current_dir = None
+
+    def extract_all_with_border_to_dir(self, image, resolution, rois, dest, scan_name):
+        # Some state kept between calls, which must not be shared by workers
+        self.current_dir = dest
+        for a_roi in rois:
+            height, width = a_roi.mask.shape
+            crop = image[a_roi.y : a_roi.y + height, a_roi.x : a_roi.x + width]
+            name = f"{scan_name}_{a_roi.x}_{a_roi.y}.png"
+            Image.fromarray(np.where(a_roi.mask, crop, 255).astype(np.uint8)).save(
+                self.current_dir / name
+            )
+
+
+def extract_with(tmp_path, monkeypatch, name, workers, image, rois):
+    monkeypatch.setattr(modern.jobs.VignettesToAutoSep, "EXTRACTION_WORKERS", workers)
+    monkeypatch.setattr(modern.jobs.VignettesToAutoSep, "EXTRACTION_SHARD_SIZE", 3)
+    thumbs_dir = tmp_path / name
+    thumbs_dir.mkdir()
+    progress = JobProgress(["extract"], lambda: None)
+    progress.start_stage("extract", len(rois))
+    processor = SimpleNamespace(extractor=FakeExtractor())
+    extract_cuts(processor, thumbs_dir, image, 2400, rois, "scan", progress)
+    assert progress.done == len(rois)
+    return {a_file.name: a_file.read_bytes() for a_file in thumbs_dir.iterdir()}
+
+
+def test_parallel_and_serial_extractions_are_identical(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    image = rng.integers(0, 256, (200, 200), dtype=np.uint8)
+    rois = [
+        FakeROI(x, y, (rng.random((8, 10)) > 0.3).astype(np.uint8))
+        for x, y in zip(rng.integers(0, 190, 20), rng.integers(0, 190, 20))
+    ]
+
+    serial = extract_with(tmp_path, monkeypatch, "serial", 1, image, rois)
+    parallel = extract_with(tmp_path, monkeypatch, "parallel", 4, image, rois)
+
+    assert len(serial) == len({(a_roi.x, a_roi.y) for a_roi in rois})
+    assert parallel == serial
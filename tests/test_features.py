@@ -0,0 +1,25 @@
+import numpy as np
+
+from modern.features import _link_or_save
+from modern.stage_cache import StageCache
+
+
+def test_image_in_given_file_is_not_written_again(tmp_path):
+    image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    cache = StageCache(tmp_path / "cache", "cfg")
+    cache.save("bg_removed", "k1", image, {})
+    stage_path = cache.file_of("bg_removed", "k1")
+    assert stage_path is not None and cache.file_of("bg_removed", "k2") is None
+
+    linked = tmp_path / "features_image.npy"
+    _link_or_save(image, linked, stage_path)
+    assert linked.stat().st_ino == stage_path.stat().st_ino
+
+    # Without a file from the caller, even a mapped image is written, it might have changed
+    mapped, _ = cache.load("bg_removed", "k1")
+    mapped[0, 0] = 255
+    saved = tmp_path / "features_image.1.npy"
+    _link_or_save(mapped, saved, None)
+    assert saved.stat().st_ino != stage_path.stat().st_ino
+    assert np.array_equal(np.load(saved), mapped)
+    assert np.load(stage_path)[0, 0] == 0
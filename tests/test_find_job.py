@@ -36,6 +36,7 @@ def clear_jobs():
     # Clear the jobs list before each test
     with JobScheduler.jobs_lock:
         JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
     yield
 
 
@@ -89,3 +90,19 @@ def test_find_job_different_class(clear_jobs):
 
     # Assert that no job is found
     assert len(found_job) == 0
+
+
+def test_find_job_of_subclass(clear_jobs):
+    class DerivedTestJob(FakeTestJob):
+        pass
+
+    derived = DerivedTestJob(param1="value1", param2="value2")
+    JobScheduler.submit(derived)
+
+    assert JobScheduler.find_jobs_like(
+        FakeTestJob("value1", "value2"), Job.will_do
+    ) == [derived]
+    assert (
+        JobScheduler.find_jobs_like(AnotherTestJob("value1", "value2"), Job.will_do)
+        == []
+    )
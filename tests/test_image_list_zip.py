@@ -0,0 +1,96 @@
+import io
+import os
+import logging
+import zipfile
+
+from PIL import Image
+
+import providers.ImageList
+from providers.ImageList import ImageList, png_header
+
+logger = logging.getLogger(__name__)
+
+
+def make_images(a_dir):
+    Image.new("L", (30, 20), 128).save(a_dir / "gray.png")
+    Image.new("RGB", (10, 40), (1, 2, 3)).save(a_dir / "rgb.png")
+
+
+def test_png_header(tmp_path):
+    make_images(tmp_path)
+    assert png_header(tmp_path / "gray.png") == (30, 20, 8, 0)
+    assert png_header(tmp_path / "rgb.png") == (10, 40, 8, 2)
+    (tmp_path / "not.png").write_bytes(b"GIF89a")
+    assert png_header(tmp_path / "not.png") is None
+
+
+def test_zip_chunks_same_as_zipped(tmp_path):
+    make_images(tmp_path)
+    image_list = ImageList(tmp_path)
+    zip_path = image_list.zipped(logger, zip_path=tmp_path / "images.zip")
+    streamed = ImageList(tmp_path)
+    zip_bytes = b"".join(streamed.zip_chunks(logger))
+
+    with zipfile.ZipFile(zip_path) as on_disk, zipfile.ZipFile(
+        io.BytesIO(zip_bytes)
+    ) as in_memory:
+        assert on_disk.namelist() == in_memory.namelist() == ["gray.png", "rgb.png"]
+        for a_name in on_disk.namelist():
+            assert on_disk.read(a_name) == in_memory.read(a_name)
+        with Image.open(io.BytesIO(in_memory.read("gray.png"))) as converted:
+            assert converted.mode == "RGB"
+    assert streamed.size_by_name == image_list.size_by_name == {
+        "gray.png": 600,
+        "rgb.png": 400,
+    }
+
+
+def test_parallel_conversion_keeps_order(tmp_path, monkeypatch):
+    for i in range(12):
+        Image.new("L", (5 + i, 5), i).save(tmp_path / f"img_{i:02}.png")
+    monkeypatch.setattr(providers.ImageList, "RGB_CONVERSION_WORKERS", 1)
+    serial = b"".join(ImageList(tmp_path).zip_chunks(logger))
+    monkeypatch.setattr(providers.ImageList, "RGB_CONVERSION_WORKERS", 3)
+    parallel = b"".join(ImageList(tmp_path).zip_chunks(logger))
+    assert parallel == serial
+
+
+def test_compression_option(tmp_path):
+    make_images(tmp_path)
+    zip_bytes = b"".join(
+        ImageList(tmp_path).zip_chunks(logger, compression=zipfile.ZIP_DEFLATED)
+    )
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as in_memory:
+        assert all(
+            an_info.compress_type == zipfile.ZIP_DEFLATED
+            for an_info in in_memory.infolist()
+        )
+    zip_bytes = b"".join(ImageList(tmp_path).zip_chunks(logger))
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as in_memory:
+        assert all(
+            an_info.compress_type == zipfile.ZIP_STORED
+            for an_info in in_memory.infolist()
+        )
+
+
+def test_rgb_cache_reused_until_image_changes(tmp_path):
+    img_dir, cache_dir = tmp_path / "cuts", tmp_path / "cuts_rgb"
+    img_dir.mkdir()
+    make_images(img_dir)
+    first = b"".join(ImageList(img_dir, rgb_cache_dir=cache_dir).zip_chunks(logger))
+    # Only the non-RGB image needed a conversion
+    assert sorted(p.name for p in cache_dir.iterdir()) == ["gray.png"]
+
+    # A tampered cache entry with the right mtime is trusted
+    cached = cache_dir / "gray.png"
+    stat = (img_dir / "gray.png").stat()
+    Image.new("RGB", (30, 20), (9, 9, 9)).save(cached)
+    os.utime(cached, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    second = b"".join(ImageList(img_dir, rgb_cache_dir=cache_dir).zip_chunks(logger))
+    assert second != first
+
+    # Once the source image is modified, the cache entry is replaced
+    os.utime(img_dir / "gray.png", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    third = b"".join(ImageList(img_dir, rgb_cache_dir=cache_dir).zip_chunks(logger))
+    assert third == first
+    assert cached.stat().st_mtime_ns == stat.st_mtime_ns + 10**9
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from modern.job_events import JobEvents
+from modern.tasks import Job, JobStateEnum
+
+
+class EventsTestJob(Job):
+    def __init__(self, job_id, project):
+        super().__init__((project,))
+        self.job_id = job_id
+        self.project = project
+
+    def project_id(self):
+        return self.project
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        pass
+
+
+def test_changes_are_filtered_and_coalesced():
+    async def scenario():
+        subscription = JobEvents.subscribe(lambda a_job: a_job.project_id() == "p1")
+        try:
+            watched = EventsTestJob(1, "p1")
+            other = EventsTestJob(2, "p2")
+
+            def change_jobs():
+                # From another thread, like the job runners
+                watched.state = JobStateEnum.Running
+                watched.last_log_line = "Segmenting"
+                other.state = JobStateEnum.Running
+
+            thread = threading.Thread(target=change_jobs)
+            thread.start()
+            thread.join()
+            changed = await subscription.next_changes(1)
+            assert changed == [watched]
+            assert changed[0].last_log_line == "Segmenting"
+            # Nothing more to report
+            assert await subscription.next_changes(0.05) == []
+        finally:
+            JobEvents.unsubscribe(subscription)
+
+    asyncio.run(scenario())
+    assert len(JobEvents.subscriptions) == 0
+
+
+def test_jobs_without_id_are_not_published():
+    async def scenario():
+        subscription = JobEvents.subscribe(lambda a_job: True)
+        try:
+            EventsTestJob(0, "p1").state = JobStateEnum.Running
+            assert await subscription.next_changes(0.05) == []
+        finally:
+            JobEvents.unsubscribe(subscription)
+
+    asyncio.run(scenario())
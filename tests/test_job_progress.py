@@ -0,0 +1,61 @@
+import time
+
+from modern.tasks import Job, JobProgress, JobStateEnum, eta_seconds
+
+
+class StagedTestJob(Job):
+    stages = ["convert", "segment", "extract", "classify"]
+
+    def __init__(self, param1):
+        super().__init__((param1,))
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        pass
+
+
+def test_percent_follows_stages():
+    job = StagedTestJob("value1")
+    assert job.progress.percent() == 0
+
+    job.progress.start_stage("segment")
+    assert job.progress.percent() == 25
+
+    job.progress.start_stage("extract", 10)
+    job.progress.advance(5)
+    assert job.progress.percent() == 62
+    assert "segment" in job.progress.durations
+
+
+def test_unknown_stage_has_no_percent():
+    progress = JobProgress(["a", "b"], lambda: None)
+    progress.start_stage("c", 2)
+    assert progress.percent() == 0
+
+
+def test_eta():
+    assert eta_seconds(time.time(), 0, 10) is None
+    # 5 units in ~10s, 5 remaining
+    eta = eta_seconds(time.time() - 10, 5, 10)
+    assert eta is not None and 9 < eta < 11
+
+
+def test_progress_changes_notify_and_travel_in_snapshot():
+    seen = []
+    Job.listeners.append(seen.append)
+    try:
+        job = StagedTestJob("value1")
+        job.progress.start_stage("extract", 100)
+        job.progress.advance(40)
+    finally:
+        Job.listeners.remove(seen.append)
+    assert len(seen) == 2
+
+    mirror = StagedTestJob("value1")
+    mirror.apply_snapshot(job.snapshot())
+    assert mirror.progress.stage == "extract"
+    assert mirror.progress.done == 40
+    assert mirror.progress.total == 100
+    assert mirror.state == JobStateEnum.Pending
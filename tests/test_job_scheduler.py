@@ -0,0 +1,358 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from modern.tasks import (
+    JobScheduler,
+    Job,
+    MAX_CONCURRENCY,
+    JobStateEnum,
+    ExecutionModeEnum,
+    ResourceClassEnum,
+    JobPriorityEnum,
+    InThreadExecutor,
+    SpawnedProcessExecutor,
+    executor_for,
+    execute_job,
+)
+
+
+class SleepingTestJob(Job):
+    def __init__(self, param1, release: threading.Event):
+        super().__init__((param1,))
+        self.release = release
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        self.release.wait(timeout=10)
+
+
+def wait_until(condition, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def running_scheduler():
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    JobScheduler.launch()
+    yield
+    JobScheduler.shutdown()
+
+
+def test_all_free_slots_filled_at_once(running_scheduler):
+    release = threading.Event()
+    jobs = [SleepingTestJob(i, release) for i in range(MAX_CONCURRENCY + 2)]
+    for a_job in jobs:
+        JobScheduler.submit(a_job)
+
+    # No polling interval, all slots are taken right away
+    assert wait_until(
+        lambda: len([j for j in jobs if j.state == "R"]) == MAX_CONCURRENCY, 1.0
+    )
+    assert len([j for j in jobs if j.state == "P"]) == 2
+
+    # Completion of runners starts the remaining jobs
+    release.set()
+    assert wait_until(lambda: all(j.is_done() for j in jobs))
+    assert JobScheduler.queue_wait.count >= len(jobs)
+
+
+class CPUTestJob(SleepingTestJob):
+    execution_mode = ExecutionModeEnum.Process
+
+
+def test_executor_choice(monkeypatch):
+    import modern.tasks
+
+    thread_job = SleepingTestJob(1, threading.Event())
+    cpu_job = CPUTestJob(1, threading.Event())
+    monkeypatch.setattr(modern.tasks, "USE_PROCESSES", True)
+    assert isinstance(executor_for(thread_job), InThreadExecutor)
+    assert isinstance(executor_for(cpu_job), SpawnedProcessExecutor)
+    # Processes can be disabled by configuration
+    monkeypatch.setattr(modern.tasks, "USE_PROCESSES", False)
+    assert isinstance(executor_for(cpu_job), InThreadExecutor)
+
+
+def test_snapshot_mirrors_remote_job():
+    remote = SleepingTestJob(1, threading.Event())
+    remote.state = JobStateEnum.Running
+    remote.last_log_line = "Segmenting"
+    local = SleepingTestJob(1, threading.Event())
+    seen = []
+    Job.listeners.append(seen.append)
+    try:
+        local.apply_snapshot(remote.snapshot())
+    finally:
+        Job.listeners.remove(seen.append)
+    assert local.state == JobStateEnum.Running
+    assert local.last_log_line == "Segmenting"
+    assert seen == [local]
+
+
+class HeavyTestJob(SleepingTestJob):
+    resource_class = ResourceClassEnum.CPUHeavy
+
+    def __init__(self, param1, release: threading.Event, memory_mb: int = 0):
+        super().__init__(param1, release)
+        self.memory_mb = memory_mb
+
+    def estimated_memory_mb(self):
+        return self.memory_mb
+
+
+def test_resource_class_slots(running_scheduler, monkeypatch):
+    import modern.tasks
+
+    monkeypatch.setitem(modern.tasks.RESOURCE_SLOTS, ResourceClassEnum.CPUHeavy, 1)
+    release = threading.Event()
+    heavy_jobs = [HeavyTestJob(i, release) for i in range(3)]
+    light_job = SleepingTestJob(99, release)
+    for a_job in heavy_jobs + [light_job]:
+        JobScheduler.submit(a_job)
+
+    # Only one heavy job at a time, but the light one is not blocked by them
+    assert wait_until(lambda: light_job.state == JobStateEnum.Running, 1.0)
+    assert [j.state for j in heavy_jobs] == ["R", "P", "P"]
+
+    release.set()
+    assert wait_until(lambda: all(j.is_done() for j in heavy_jobs))
+
+
+def test_memory_budget_holds_back_heavy_jobs(running_scheduler, monkeypatch):
+    import modern.tasks
+
+    monkeypatch.setattr(modern.tasks, "MEMORY_BUDGET_MB", 1000)
+    release = threading.Event()
+    big_job = HeavyTestJob(1, release, memory_mb=800)
+    other_big_job = HeavyTestJob(2, release, memory_mb=800)
+    small_job = HeavyTestJob(3, release, memory_mb=100)
+    for a_job in (big_job, other_big_job, small_job):
+        JobScheduler.submit(a_job)
+
+    assert wait_until(lambda: big_job.state == JobStateEnum.Running, 1.0)
+    time.sleep(0.1)
+    # Second big job does not fit, and the small one does not overtake it
+    assert other_big_job.state == JobStateEnum.Pending
+    assert small_job.state == JobStateEnum.Pending
+
+    release.set()
+    assert wait_until(
+        lambda: all(j.is_done() for j in (big_job, other_big_job, small_job))
+    )
+
+
+class CancellableTestJob(Job):
+    stages = ["first", "second"]
+
+    def __init__(self, param1, release: threading.Event):
+        super().__init__((param1,))
+        self.release = release
+        self.cleaned = False
+        self.reached_second = False
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        self.progress.start_stage("first")
+        self.release.wait(timeout=10)
+        self.progress.start_stage("second")
+        self.reached_second = True
+
+    def _cleanup_work(self):
+        self.cleaned = True
+
+
+def test_cancel_running_job_frees_slot_once_stopped(running_scheduler, monkeypatch):
+    import modern.tasks
+
+    monkeypatch.setitem(modern.tasks.RESOURCE_SLOTS, ResourceClassEnum.Other, 1)
+    release = threading.Event()
+    running = CancellableTestJob(1, release)
+    waiting = CancellableTestJob(2, release)
+    JobScheduler.submit(running)
+    JobScheduler.submit(waiting)
+    assert wait_until(lambda: running.state == JobStateEnum.Running, 1.0)
+
+    JobScheduler.cancel(running.job_id)
+    assert running.state == JobStateEnum.Error
+    assert running.last_log_line == modern.tasks.CANCELLED_MSG
+    # Cleanup waits for the job thread, which could still write outputs
+    assert not running.cleaned
+    # So does the slot, the thread still uses its resources
+    time.sleep(0.1)
+    assert waiting.state == JobStateEnum.Pending
+
+    release.set()
+    assert wait_until(lambda: waiting.is_done())
+    assert waiting.state == JobStateEnum.Finished
+    # Cancelled job stopped when entering next stage
+    assert not running.reached_second
+    assert running.state == JobStateEnum.Error
+    assert wait_until(lambda: running.cleaned)
+    assert running.last_log_line == modern.tasks.CANCELLED_MSG
+
+
+class GatedExecutor(InThreadExecutor):
+    """Lets the runner thread execute the job only when told to"""
+
+    def __init__(self):
+        self.go = threading.Event()
+
+    def execute(self, job):
+        self.go.wait(timeout=10)
+        super().execute(job)
+
+
+def test_cancel_before_runner_body(monkeypatch):
+    import modern.tasks
+
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    executor = GatedExecutor()
+    monkeypatch.setattr(modern.tasks, "executor_for", lambda a_job: executor)
+    job = CancellableTestJob(1, threading.Event())
+    JobScheduler.submit(job)
+    with JobScheduler.jobs_lock:
+        JobScheduler._start(job, 0)
+        (runner,) = [r for r in JobScheduler.active_runners if r.job is job]
+    assert job.state == JobStateEnum.Running
+
+    JobScheduler.cancel(job.job_id)
+    executor.go.set()
+    runner.join(timeout=5)
+
+    # The job did not run, and stays cancelled
+    assert job.progress.stage is None
+    assert job.state == JobStateEnum.Error
+    assert job.last_log_line == modern.tasks.CANCELLED_MSG
+    assert runner not in JobScheduler.active_runners
+    assert job.cleaned
+
+
+def test_late_snapshot_does_not_revive_cancelled_job():
+    import modern.tasks
+
+    remote = SleepingTestJob(1, threading.Event())
+    remote.state = JobStateEnum.Running
+    local = SleepingTestJob(1, threading.Event())
+    local.cancel_token.cancel()
+    local.last_log_line = modern.tasks.CANCELLED_MSG
+    local.state = JobStateEnum.Error
+
+    local.apply_snapshot(remote.snapshot())
+    assert local.state == JobStateEnum.Error
+    assert local.last_log_line == modern.tasks.CANCELLED_MSG
+
+
+def test_cancel_pending_and_unknown_jobs():
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    # No dispatcher, the job stays pending
+    job = CancellableTestJob(1, threading.Event())
+    JobScheduler.submit(job)
+    assert JobScheduler.cancel(job.job_id) is job
+    assert job.state == JobStateEnum.Error
+    assert not job.cleaned
+    assert JobScheduler.cancel(-5) is None
+
+
+def test_done_jobs_are_evicted(monkeypatch):
+    import modern.tasks
+
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    monkeypatch.setattr(modern.tasks, "RETENTION_COUNT", 2)
+    jobs = [SleepingTestJob(i, threading.Event()) for i in range(4)]
+    for a_job in jobs:
+        JobScheduler.submit(a_job)
+    old_done, done1, done2, pending = jobs
+    old_done.state = JobStateEnum.Finished
+    old_done.updated_at = datetime.now() - timedelta(days=30)
+    done1.state = JobStateEnum.Error
+    done2.state = JobStateEnum.Finished
+
+    with JobScheduler.jobs_lock:
+        JobScheduler._evict_done_jobs()
+
+    assert JobScheduler.get_job(old_done.job_id) is None
+    assert JobScheduler.get_job(done1.job_id) is done1
+    assert JobScheduler.get_job(pending.job_id) is pending
+    assert JobScheduler.find_jobs(Job.is_done) == [done1, done2]
+    assert JobScheduler.find_jobs_like(old_done, Job.is_done) == []
+
+    monkeypatch.setattr(modern.tasks, "RETENTION_COUNT", 0)
+    with JobScheduler.jobs_lock:
+        JobScheduler._evict_done_jobs()
+    assert JobScheduler.find_jobs(lambda a_job: True) == [pending]
+
+
+class LoggingTestJob(SleepingTestJob):
+    def prepare(self):
+        self.logger = self._setup_job_logger(self.log_file)
+
+    def run(self):
+        self.logger.info("Working")
+
+
+def test_job_logger_is_closed_when_done(tmp_path):
+    job = LoggingTestJob(1, threading.Event())
+    job.job_id = 424242
+    job.log_file = tmp_path / "job.log"
+    execute_job(job)
+
+    assert job.state == JobStateEnum.Finished
+    assert "Working" in job.log_file.read_text()
+    assert "job_424242" not in logging.Logger.manager.loggerDict
+
+
+def test_priority_and_fairness(running_scheduler, monkeypatch):
+    import modern.tasks
+
+    monkeypatch.setitem(modern.tasks.RESOURCE_SLOTS, ResourceClassEnum.Other, 1)
+    blocker_release = threading.Event()
+    release = threading.Event()
+    blocker = SleepingTestJob(0, blocker_release)
+    JobScheduler.submit(blocker, owner="bulk")
+    assert wait_until(lambda: blocker.state == JobStateEnum.Running, 1.0)
+
+    bulk = [SleepingTestJob(i, release) for i in range(1, 4)]
+    for a_job in bulk:
+        JobScheduler.submit(a_job, priority=JobPriorityEnum.Batch, owner="bulk")
+    other_batch = SleepingTestJob(10, release)
+    JobScheduler.submit(other_batch, priority=JobPriorityEnum.Batch, owner="other")
+    interactive = SleepingTestJob(20, release)
+    JobScheduler.submit(interactive, priority=JobPriorityEnum.Interactive, owner="bulk")
+
+    started = []
+    Job.listeners.append(
+        lambda a_job: a_job.state == JobStateEnum.Running
+        and a_job not in started
+        and started.append(a_job)
+    )
+    try:
+        blocker_release.set()
+        release.set()
+        assert wait_until(lambda: len(started) == 5)
+    finally:
+        Job.listeners.pop()
+    # Interactive first, then the other owner despite submitting after the bulk
+    assert started[0] is interactive
+    assert started[1] is other_batch
+    assert started[2:] == bulk
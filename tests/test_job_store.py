@@ -0,0 +1,258 @@
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from local_DB.job_store import JobStore
+from local_DB.models import Base, add_missing_columns
+from modern.tasks import (
+    JobScheduler,
+    Job,
+    JobStateEnum,
+    JobPriorityEnum,
+    CANCELLED_MSG,
+)
+from modern.utils import job_to_task_rsp
+
+
+class StorableTestJob(Job):
+    def __init__(self, param1, param2):
+        super().__init__((param1, param2))
+
+    @classmethod
+    def from_persisted(cls, params):
+        return cls(*params["params"])
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        pass
+
+
+@pytest.fixture
+def job_store():
+    temp_db_file = f"test_db_{uuid.uuid4()}.db"
+    engine = create_engine(f"sqlite:///{temp_db_file}")
+    Base.metadata.create_all(engine)
+    store = JobStore(sessionmaker(bind=engine))
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    JobScheduler.use_store(store)
+    yield store
+    JobScheduler.store = None
+    Job.listeners.remove(JobScheduler._persist)
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+    engine.dispose()
+    if os.path.exists(temp_db_file):
+        os.remove(temp_db_file)
+
+
+def test_submit_persists_job(job_store):
+    job = StorableTestJob("value1", "value2")
+    JobScheduler.submit(job)
+
+    row = job_store.get(job.job_id)
+    assert row is not None
+    assert row.job_class == "StorableTestJob"
+    assert row.params == {"params": ["value1", "value2"]}
+    assert row.state == JobStateEnum.Pending.value
+
+
+def test_state_changes_are_persisted(job_store):
+    job = StorableTestJob("value1", "value2")
+    JobScheduler.submit(job)
+    job.last_log_line = "Doing things"
+    job.state = JobStateEnum.Finished
+
+    row = job_store.get(job.job_id)
+    assert row.state == JobStateEnum.Finished.value
+    assert row.last_log_line == "Doing things"
+
+
+def test_restore_requeues_pending_and_interrupts_running(job_store):
+    now = datetime.now()
+    job_store.save(
+        1001, "StorableTestJob", "k", {"params": ["a", "b"]}, "P", now, now, None
+    )
+    job_store.save(
+        1002, "StorableTestJob", "k", {"params": ["c", "d"]}, "R", now, now, "Busy"
+    )
+    job_store.save(1003, "UnknownJob", "k", {"params": []}, "P", now, now, None)
+
+    JobScheduler.restore_from_store()
+
+    requeued = JobScheduler.get_job(1001)
+    assert requeued is not None
+    assert requeued.state == JobStateEnum.Pending
+    assert requeued.params == ("a", "b")
+    assert job_store.get(1002).state == JobStateEnum.Error.value
+    assert job_store.get(1003).state == JobStateEnum.Error.value
+
+
+def test_get_job_from_previous_run(job_store):
+    now = datetime.now()
+    job_store.save(
+        2001, "StorableTestJob", "k", {"params": ["a", "b"]}, "F", now, now, "Done"
+    )
+
+    job = JobScheduler.get_job(2001)
+    assert job is not None
+    assert job.state == JobStateEnum.Finished
+    assert job.last_log_line == "Done"
+
+
+def test_new_ids_continue_stored_sequence(job_store):
+    now = datetime.now()
+    job_store.save(
+        5000, "StorableTestJob", "k", {"params": ["a", "b"]}, "F", now, now, None
+    )
+    JobScheduler.use_store(job_store)
+
+    assert JobScheduler.get_new_id() > 5000
+
+
+def test_only_state_changes_are_written(job_store, monkeypatch):
+    written = []
+    save_all = job_store.save_all
+    monkeypatch.setattr(
+        job_store, "save_all", lambda rows: written.extend(rows) or save_all(rows)
+    )
+    job = StorableTestJob("value1", "value2")
+    JobScheduler.submit(job)
+    job.progress.advance(3)
+    job.last_log_line = "Doing things"
+    job.state = JobStateEnum.Running
+    job.last_log_line = "Doing more things"
+
+    assert [a_row["state"] for a_row in written] == ["P", "R"]
+    assert job_store.get(job.job_id).last_log_line == "Doing things"
+    # Done jobs keep their last words
+    job.state = JobStateEnum.Error
+    job.last_log_line = "Failed"
+    assert job_store.get(job.job_id).last_log_line == "Failed"
+
+
+def test_cancelled_job_keeps_its_stored_status(job_store, tmp_path):
+    job = StorableTestJob("value1", "value2")
+    job.job_id = JobScheduler.get_new_id()
+    job.logger = job._setup_job_logger(tmp_path / "job.log")
+    JobScheduler.submit(job)
+    job.state = JobStateEnum.Running
+    job.logger.info("Doing things")
+
+    JobScheduler.cancel(job.job_id)
+    # The job thread, stopping meanwhile
+    job.logger.info(CANCELLED_MSG + ", stopped with: an error")
+    job.progress.advance(3)
+    job._close_job_logger()
+
+    assert job.last_log_line == CANCELLED_MSG
+    row = job_store.get(job.job_id)
+    assert row.state == JobStateEnum.Error.value
+    assert row.last_log_line == CANCELLED_MSG
+
+
+def test_find_jobs_like_reads_the_store(job_store):
+    task = StorableTestJob("value1", "value2")
+    now = datetime.now()
+    job_store.save(
+        7001,
+        "StorableTestJob",
+        task.params_key(),
+        task.persisted_params(),
+        "E",
+        now,
+        now,
+        "Failed",
+    )
+    job_store.save(
+        7002, "StorableTestJob", "k", {"params": ["a", "b"]}, "E", now, now, "Failed"
+    )
+    in_memory = StorableTestJob("value1", "value2")
+    JobScheduler.submit(in_memory)
+    in_memory.state = JobStateEnum.Error
+
+    found = JobScheduler.find_jobs_like(task, Job.is_in_error)
+    assert {a_job.job_id for a_job in found} == {7001, in_memory.job_id}
+    assert in_memory in found
+    assert JobScheduler.find_jobs_like(task, Job.will_do) == []
+
+
+def test_owner_and_priority_survive_restart(job_store):
+    job = StorableTestJob("value1", "value2")
+    JobScheduler.submit(job, priority=JobPriorityEnum.Batch, owner="someone")
+    with JobScheduler.jobs_lock:
+        JobScheduler._jobs.clear()
+        JobScheduler._jobs_by_key.clear()
+
+    JobScheduler.restore_from_store()
+
+    requeued = JobScheduler.get_job(job.job_id)
+    assert requeued is not job
+    assert requeued.owner == "someone"
+    assert requeued.priority == JobPriorityEnum.Batch
+
+
+def test_missing_columns_are_added(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE jobs (id INTEGER PRIMARY KEY, job_class VARCHAR NOT NULL,"
+                " params_key VARCHAR NOT NULL, params JSON NOT NULL,"
+                " state VARCHAR(1) NOT NULL, created_at DATETIME NOT NULL,"
+                " updated_at DATETIME NOT NULL, last_log_line VARCHAR)"
+            )
+        )
+    Base.metadata.create_all(engine)
+
+    add_missing_columns(engine)
+
+    columns = {a_col["name"] for a_col in inspect(engine).get_columns("jobs")}
+    assert {"owner", "priority"} <= columns
+    indexed = {
+        a_col
+        for an_idx in inspect(engine).get_indexes("jobs")
+        for a_col in an_idx["column_names"]
+    }
+    assert {"params_key", "state"} <= indexed
+    engine.dispose()
+
+
+def test_cancel_job_only_in_store(job_store):
+    now = datetime.now()
+    job_store.save(
+        3001, "UnknownJob", "k", {"params": []}, "P", now, now, "Could not be re-queued"
+    )
+    job_store.save(
+        3002, "StorableTestJob", "k", {"params": ["a", "b"]}, "F", now, now, "Done"
+    )
+
+    JobScheduler.cancel(3001)
+    assert job_store.get(3001).state == JobStateEnum.Error.value
+    assert job_store.get(3001).last_log_line == CANCELLED_MSG
+    done = JobScheduler.cancel(3002)
+    assert done is not None and done.state == JobStateEnum.Finished
+    assert JobScheduler.cancel(3003) is None
+
+
+def test_get_job_which_cannot_be_recreated(job_store):
+    now = datetime.now()
+    job_store.save(
+        6001, "UnknownJob", "k", {"params": ["a"]}, "F", now, now, "Uploaded"
+    )
+
+    job = JobScheduler.get_job(6001)
+    assert job is not None
+    assert job.job_id == 6001
+    assert job.state == JobStateEnum.Finished
+    assert job.last_log_line == "Uploaded"
+    assert job.exec_name() == "UnknownJob"
+    assert job_to_task_rsp(job).status == "Finished"
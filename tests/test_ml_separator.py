@@ -0,0 +1,52 @@
+import pytest
+from PIL import Image
+
+import providers.ML_multiple_separator
+from modern.tasks import JobCancelledError
+from providers.ImageList import ImageList
+from providers.ML_multiple_separator import separate_all_images_from
+
+
+@pytest.fixture
+def image_list(tmp_path):
+    for idx in range(12):
+        Image.new("L", (4, 4)).save(tmp_path / f"img_{idx:03}.png")
+    return ImageList(tmp_path)
+
+
+def test_timeout_follows_request_size_if_configured(image_list, monkeypatch):
+    module = providers.ML_multiple_separator
+    timeouts = []
+
+    def post(logger, url, images, timeout):
+        timeouts.append(timeout)
+        raise ConnectionError("No server")
+
+    monkeypatch.setattr(module, "post_zipped_images", post)
+    monkeypatch.setattr(module, "RETRY_DELAY_SEC", 0)
+    response, error = separate_all_images_from(module.logger, image_list, retries=1)
+
+    assert response is None and "No server" in error
+    assert timeouts == [(10, 7200)] * 2
+
+    monkeypatch.setattr(module, "SEPARATOR_TIMEOUT_PER_IMAGE_SEC", 60)
+    timeouts.clear()
+    separate_all_images_from(module.logger, image_list, retries=0)
+    assert timeouts == [(10, 12 * 60)]
+
+
+def test_cancel_between_retries(image_list, monkeypatch):
+    module = providers.ML_multiple_separator
+    calls = []
+    monkeypatch.setattr(
+        module,
+        "call_separate_server_with_images",
+        lambda images: calls.append(images) or (None, "Server is down"),
+    )
+
+    def cancelled():
+        raise JobCancelledError("Cancelled")
+
+    with pytest.raises(JobCancelledError):
+        separate_all_images_from(module.logger, image_list, 2, cancelled)
+    assert len(calls) == 1
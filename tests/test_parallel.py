@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+from modern.parallel import map_concurrently
+
+
+def test_results_in_order_and_progress():
+    done = []
+    ret = map_concurrently(
+        lambda x: time.sleep(0.01 * (5 - x)) or x * 2,
+        list(range(5)),
+        workers=3,
+        on_done=done.append,
+    )
+    assert ret == [0, 2, 4, 6, 8]
+    assert sorted(done) == list(range(5))
+
+
+def test_memory_budget_limits_concurrency():
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def work(_):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    map_concurrently(work, list(range(6)), workers=6)
+    assert max_running[0] > 2
+    max_running[0] = 0
+    # Each call takes 400MB out of 1000MB
+    map_concurrently(work, list(range(6)), 6, lambda _: 400, 1000)
+    assert max_running[0] == 2
+
+
+def test_exception_is_raised():
+    def work(x):
+        if x == 2:
+            raise ValueError("bad item")
+        return x
+
+    with pytest.raises(ValueError):
+        map_concurrently(work, list(range(4)), workers=2)
+    with pytest.raises(ValueError):
+        map_concurrently(work, list(range(4)), workers=1)
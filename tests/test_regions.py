@@ -0,0 +1,76 @@
+import numpy as np
+
+import modern.regions
+from modern.regions import (
+    rois_touched_by_separators,
+    resegment_regions,
+    roi_box,
+    boxes_to_resegment,
+)
+from test_tiling import FakeROI, FakeSegmenter, as_tuples, scan_like
+
+
+def test_rois_touched_by_separators():
+    rois = [
+        FakeROI(10, 10, np.ones((5, 5), dtype=np.uint8)),
+        FakeROI(30, 10, np.ones((5, 8), dtype=np.uint8)),
+        FakeROI(10, 40, np.ones((3, 3), dtype=np.uint8)),
+    ]
+    sep_image = np.zeros((50, 50), dtype=np.uint8)
+    assert rois_touched_by_separators(rois, sep_image) == []
+
+    # Inside the second box, right at its bottom-right corner
+    sep_image[14, 37] = 255
+    # Just outside the third box
+    sep_image[43, 10] = 255
+    assert rois_touched_by_separators(rois, sep_image) == [1]
+
+
+def test_resegment_regions_gives_same_objects():
+    objects = np.zeros((200, 200), dtype=bool)
+    # Two objects joined by a bridge, with a small one in between, and a neighbour
+    objects[20:40, 20:40] = True
+    objects[20:40, 60:80] = True
+    objects[30, 40:60] = True
+    objects[22:25, 50:53] = True
+    objects[45:60, 30:50] = True
+    # Far away
+    objects[150:170, 150:170] = True
+    image = scan_like(objects)
+    segmenter = FakeSegmenter()
+    first_rois, _ = segmenter.find_ROIs_in_cropped_image(image, 2400)
+
+    sep_image = np.zeros_like(image)
+    sep_image[30, 50] = 255
+    separated = image.copy()
+    separated[sep_image != 0] = 255
+    touched = rois_touched_by_separators(first_rois, sep_image)
+    assert len(touched) == 1  # Only the bridged objects
+
+    rois, new_rois, stats = resegment_regions(
+        segmenter, separated, 2400, first_rois, touched
+    )
+    whole, _ = segmenter.find_ROIs_in_cropped_image(separated, 2400)
+    assert as_tuples(rois) == as_tuples(whole)
+    assert len(new_rois) == 3
+    assert len(stats) == 1
+    # Untouched ROIs are the same objects
+    assert sum(1 for a_roi in rois if a_roi in first_rois) == 2
+    assert all(roi_box(a_roi) != (150, 150, 170, 170) for a_roi in new_rois)
+
+
+def test_separators_outside_boxes_need_full_segmentation(monkeypatch):
+    boxes = [(10, 10, 15, 15), (10, 30, 15, 38)]
+    sep_image = np.zeros((50, 50), dtype=np.uint8)
+    monkeypatch.setattr(modern.regions, "RESEGMENT_REGIONS", False)
+    assert boxes_to_resegment(boxes, sep_image) == []
+
+    # Outside every box, it can still change the full scan segmentation
+    sep_image[43, 10] = 255
+    assert boxes_to_resegment(boxes, sep_image) is None
+
+    # Opted in, only the boxes with separators are segmented again
+    monkeypatch.setattr(modern.regions, "RESEGMENT_REGIONS", True)
+    assert boxes_to_resegment(boxes, sep_image) == []
+    sep_image[12, 33] = 255
+    assert boxes_to_resegment(boxes, sep_image) == [1]
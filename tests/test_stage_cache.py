@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+from modern.stage_cache import (
+    StageCache,
+    file_fingerprint,
+    compact,
+    CombinedBackgroundCache,
+)
+
+
+def test_fingerprint_follows_content_and_mtime(tmp_path):
+    a_file = tmp_path / "scan.tif"
+    a_file.write_bytes(b"0123456789")
+    first = file_fingerprint(a_file)
+    assert file_fingerprint(a_file) == first
+
+    stat = a_file.stat()
+    os.utime(a_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    touched = file_fingerprint(a_file)
+    assert touched != first
+
+    a_file.write_bytes(b"0123456780")
+    os.utime(a_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert file_fingerprint(a_file) != touched
+
+
+def test_fingerprint_of_big_file_samples_content(tmp_path, monkeypatch):
+    import modern.stage_cache
+
+    monkeypatch.setattr(modern.stage_cache, "FINGERPRINT_SAMPLES", 3)
+    monkeypatch.setattr(modern.stage_cache, "FINGERPRINT_SAMPLE_SIZE", 4)
+    a_file = tmp_path / "scan.tif"
+    a_file.write_bytes(bytes(range(100)))
+    first = file_fingerprint(a_file)
+    assert file_fingerprint(a_file) == first
+
+    # Same size and modification time, but written again
+    stat = a_file.stat()
+    a_file.write_bytes(bytes(reversed(range(100))))
+    os.utime(a_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert file_fingerprint(a_file) != first
+
+
+def test_save_and_load(tmp_path):
+    an_input = tmp_path / "bg.tif"
+    an_input.write_bytes(b"background")
+    cache = StageCache(tmp_path / "cache", "config1")
+    key = cache.key_for([an_input])
+    assert cache.load("combined_bg", key) is None
+
+    image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    cache.save("combined_bg", key, image, {"resolution": 2400})
+    loaded = cache.load("combined_bg", key)
+    assert loaded is not None
+    loaded_image, meta = loaded
+    assert np.array_equal(loaded_image, image)
+    assert meta["resolution"] == 2400
+
+    # Changes to the loaded image do not reach the cache
+    loaded_image[0, 0] = 255
+    assert cache.load("combined_bg", key)[0][0, 0] == 0
+
+
+def test_other_config_or_inputs_miss(tmp_path):
+    an_input = tmp_path / "bg.tif"
+    an_input.write_bytes(b"background")
+    cache = StageCache(tmp_path / "cache", "config1")
+    key = cache.key_for([an_input])
+    cache.save("combined_bg", key, np.zeros((2, 2), dtype=np.uint8), {})
+
+    other_config = StageCache(tmp_path / "cache", "config2")
+    assert other_config.load("combined_bg", other_config.key_for([an_input])) is None
+    other_input = tmp_path / "bg2.tif"
+    other_input.write_bytes(b"background")
+    assert cache.load("combined_bg", cache.key_for([other_input])) is None
+
+
+def test_compact_only_when_lossless():
+    small_values = np.array([[0, 12], [255, 3]], dtype=np.float64)
+    assert compact(small_values).dtype == np.uint8
+    assert compact(np.array([0.5, 2.0])).dtype == np.float64
+    assert compact(np.array([0, 256], dtype=np.uint16)).dtype == np.uint16
+
+
+def test_combined_background_cache(tmp_path, monkeypatch):
+    import modern.stage_cache
+
+    monkeypatch.setattr(modern.stage_cache, "BG_CACHE_IN_MEMORY", 1)
+    monkeypatch.setattr(modern.stage_cache, "BG_CACHE_ON_DISK", 2)
+    cache = CombinedBackgroundCache(tmp_path)
+    bg1 = np.full((3, 3), 200, dtype=np.float32)
+    cache.put("day1", bg1, 2400)
+    # Compact on disk
+    assert np.load(tmp_path / "day1.npy").dtype == np.uint8
+
+    image, resolution = cache.get("day1")
+    assert image.base is bg1 and resolution == 2400
+    assert not image.flags.writeable
+    assert bg1.flags.writeable
+
+    cache.put("day2", np.zeros((3, 3), dtype=np.uint8), 2400)
+    # Evicted from memory, read back from disk with its original type
+    image, _ = cache.get("day1")
+    assert image.base is not bg1
+    assert image.dtype == np.float32 and np.array_equal(image, bg1)
+
+    cache.put("day3", np.zeros((3, 3), dtype=np.uint8), 2400)
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+    assert CombinedBackgroundCache.for_dir(tmp_path) is CombinedBackgroundCache.for_dir(
+        tmp_path
+    )
+
+
+def put_background(cache_dir, image):
+    CombinedBackgroundCache.for_dir(cache_dir).put("day1", image, 2400)
+
+
+def get_background(cache_dir, results):
+    image, resolution = CombinedBackgroundCache.for_dir(cache_dir).get("day1")
+    results.put((image.copy(), resolution))
+
+
+def test_combined_background_shared_by_job_processes(tmp_path):
+    # Each job process has its own in-memory entries, only the disk ones are shared
+    context = multiprocessing.get_context("spawn")
+    bg = np.arange(9, dtype=np.float32).reshape((3, 3)) * 10
+    computing = context.Process(target=put_background, args=(tmp_path, bg))
+    computing.start()
+    computing.join()
+    results = context.Queue()
+    reusing = context.Process(target=get_background, args=(tmp_path, results))
+    reusing.start()
+    image, resolution = results.get(timeout=30)
+    reusing.join()
+
+    assert computing.exitcode == reusing.exitcode == 0
+    assert image.dtype == np.float32 and np.array_equal(image, bg)
+    assert resolution == 2400
+
+
+def test_save_and_load_object(tmp_path):
+    cache = StageCache(tmp_path / "cache", "cfg")
+    assert cache.load_object("rois", "k1") is None
+
+    cache.save_object("rois", "k1", [(1, 2), (3, 4)])
+    assert cache.load_object("rois", "k1") == [(1, 2), (3, 4)]
+    assert cache.load_object("rois", "k2") is None
@@ -0,0 +1,153 @@
+from typing import List
+
+import numpy as np
+
+import modern.tiling
+from modern.tiling import find_ROIs_in_strips, find_ROIs
+
+
+class FakeROI:
+    def __init__(self, x: int, y: int, mask: np.ndarray):
+        self.x = x
+        self.y = y
+        self.mask = mask
+
+
+# Width of the band cleared along the image edges by full image segmentation
+EDGE_BAND = 3
+
+
+class FakeSegmenter:
+    """Connected components of pixels darker than the threshold, 4-connectivity"""
+
+    threshold = 128
+
+    def __init__(self):
+        self.max_rows = 0
+
+    def find_ROIs_in_cropped_image(self, image: np.ndarray, resolution: int):
+        self.max_rows = max(self.max_rows, image.shape[0])
+        image = image < self.threshold
+        seen = np.zeros(image.shape, dtype=bool)
+        rois: List[FakeROI] = []
+        for y, x in zip(*np.nonzero(image)):
+            if seen[y, x]:
+                continue
+            pixels = []
+            todo = [(y, x)]
+            seen[y, x] = True
+            while todo:
+                py, px = todo.pop()
+                pixels.append((py, px))
+                for ny, nx in ((py + 1, px), (py - 1, px), (py, px + 1), (py, px - 1)):
+                    if (
+                        0 <= ny < image.shape[0]
+                        and 0 <= nx < image.shape[1]
+                        and image[ny, nx]
+                        and not seen[ny, nx]
+                    ):
+                        seen[ny, nx] = True
+                        todo.append((ny, nx))
+            ys = [p[0] for p in pixels]
+            xs = [p[1] for p in pixels]
+            top, left = min(ys), min(xs)
+            mask = np.zeros((max(ys) - top + 1, max(xs) - left + 1), dtype=np.uint8)
+            for py, px in pixels:
+                mask[py - top, px - left] = 1
+            rois.append(FakeROI(int(left), int(top), mask))
+        return rois, {"count": len(rois)}
+
+    def find_ROIs_in_image(self, image: np.ndarray, resolution: int):
+        """Full image processing clears the edges, then segments"""
+        cleared = image.copy()
+        cleared[:EDGE_BAND] = 255
+        cleared[-EDGE_BAND:] = 255
+        cleared[:, :EDGE_BAND] = 255
+        cleared[:, -EDGE_BAND:] = 255
+        return self.find_ROIs_in_cropped_image(cleared, resolution)
+
+
+class EdgeDroppingSegmenter(FakeSegmenter):
+    """Full image processing drops objects touching the image edges"""
+
+    def find_ROIs_in_image(self, image: np.ndarray, resolution: int):
+        rois, _ = self.find_ROIs_in_cropped_image(image, resolution)
+        height, width = image.shape
+        rois = [
+            r
+            for r in rois
+            if r.x > 0
+            and r.y > 0
+            and r.x + r.mask.shape[1] < width
+            and r.y + r.mask.shape[0] < height
+        ]
+        return rois, {"count": len(rois)}
+
+
+def as_tuples(rois):
+    return sorted((r.x, r.y, r.mask.tobytes(), r.mask.shape) for r in rois)
+
+
+def scan_like(objects: np.ndarray) -> np.ndarray:
+    """Dark objects on a white background"""
+    return np.where(objects, 10, 240).astype(np.uint8)
+
+
+def sparse_objects(rng, height: int, width: int, count: int) -> np.ndarray:
+    """Small rectangles at random places"""
+    ret = np.zeros((height, width), dtype=bool)
+    for _ in range(count):
+        y, x = rng.integers(0, height - 1), rng.integers(0, width - 1)
+        h, w = rng.integers(1, 8), rng.integers(1, 8)
+        ret[y : y + h, x : x + w] = True
+    return ret
+
+
+def test_strips_give_same_objects(monkeypatch):
+    monkeypatch.setattr(modern.tiling, "STRIP_MARGIN_ROWS", 4)
+    rng = np.random.default_rng(42)
+    objects = sparse_objects(rng, 200, 60, 40)
+    # A tall object crossing several strips
+    objects[30:150, 10] = True
+    image = scan_like(objects)
+
+    whole, _ = FakeSegmenter().find_ROIs_in_image(image, 2400)
+    segmenter = FakeSegmenter()
+    in_strips, stats = find_ROIs_in_strips(segmenter, image, 2400, 20)
+
+    assert as_tuples(in_strips) == as_tuples(whole)
+    assert len(stats) == 10
+    # Only the strip with the tall object had to grow
+    assert segmenter.max_rows < image.shape[0]
+
+
+def test_find_ROIs_by_strips_or_not(monkeypatch):
+    rng = np.random.default_rng(7)
+    image = scan_like(sparse_objects(rng, 300, 40, 60))
+    monkeypatch.setattr(modern.tiling, "SEGMENT_STRIP_ROWS", 0)
+    whole, _ = find_ROIs(FakeSegmenter(), image, 2400)
+
+    monkeypatch.setattr(modern.tiling, "SEGMENT_STRIP_ROWS", 50)
+    monkeypatch.setattr(modern.tiling, "STRIP_MARGIN_ROWS", 8)
+    in_strips, stats = find_ROIs(FakeSegmenter(), image, 2400)
+
+    assert as_tuples(in_strips) == as_tuples(whole)
+    assert len(stats) == 6
+
+
+def test_objects_dropped_at_cuts_are_not_lost(monkeypatch):
+    monkeypatch.setattr(modern.tiling, "STRIP_MARGIN_ROWS", 4)
+    objects = np.zeros((200, 60), dtype=bool)
+    # Crossing the bottom cut of the first strip, and reaching the next core
+    objects[18:30, 20:25] = True
+    # Between two cuts, touching each
+    objects[39:61, 30:33] = True
+    # Inside a strip
+    objects[100:105, 40:45] = True
+    image = scan_like(objects)
+
+    whole, _ = EdgeDroppingSegmenter().find_ROIs_in_image(image, 2400)
+    in_strips, _ = find_ROIs_in_strips(EdgeDroppingSegmenter(), image, 2400, 20)
+
+    assert len(whole) == 3
+    assert as_tuples(in_strips) == as_tuples(whole)
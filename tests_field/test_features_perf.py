@@ -0,0 +1,71 @@
+import logging
+import os
+import time
+from logging import getLogger
+from pathlib import Path
+
+os.environ["APP_ENV"] = "dev"
+from ZooProcess_lib.Processor import Processor
+from ZooProcess_lib.ZooscanFolder import ZooscanDrive
+from modern.filesystem import ModernScanFileSystem
+from modern.jobs.VignettesToAutoSep import (
+    get_scan_and_backgrounds,
+    convert_scan_and_backgrounds,
+    persisted_subsample_params,
+    scan_caches,
+)
+from modern.tasks import JobProgress
+from modern.tiling import find_ROIs
+import modern.features
+from modern.features import compute_features
+
+DRIVE = Path("/mnt/zooscan_pool/zooscan/remote/complex/piqv/plankton/zooscan_lov")
+PROJECT = "Zooscan_apero_tha_bioness_sn033"
+SAMPLE = "apero2023_tha_bioness_006_st20_n_n7"
+SUBSAMPLE = "apero2023_tha_bioness_006_st20_n_n7_d1_2_sur_2"
+WORKERS = 4
+
+logger = getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def test_parallel_features_same_and_faster(monkeypatch):
+    """
+    Benchmark of features computation on a dense real scan, serial vs. in worker processes.
+    """
+    zoo_project = ZooscanDrive(DRIVE).get_project_folder(PROJECT)
+    modern_fs = ModernScanFileSystem(zoo_project, SAMPLE, SUBSAMPLE)
+    processor = Processor.from_legacy_config(
+        zoo_project.zooscan_config.read(),
+        zoo_project.zooscan_config.read_lut(),
+    )
+    progress = JobProgress(["convert", "bg-remove", "features"], lambda: None)
+    raw_scan, bg_scans = get_scan_and_backgrounds(logger, zoo_project, SUBSAMPLE)
+    resolution, image = convert_scan_and_backgrounds(
+        logger,
+        processor,
+        raw_scan,
+        bg_scans,
+        progress,
+        scan_caches(zoo_project, modern_fs),
+    )
+    rois, _ = find_ROIs(processor.segmenter, image, resolution)
+    params = persisted_subsample_params(zoo_project, SAMPLE, SUBSAMPLE)
+
+    timings = {}
+    results = {}
+    for workers in (0, WORKERS):
+        monkeypatch.setattr(modern.features, "FEATURES_WORKERS", workers)
+        progress.start_stage("features", len(rois))
+        start = time.perf_counter()
+        results[workers] = compute_features(
+            processor, params, modern_fs.cache_dir, image, resolution, rois, progress
+        )
+        timings[workers] = time.perf_counter() - start
+        assert progress.done == len(rois)
+    print(
+        f"{len(rois)} ROIs, serial: {timings[0]:.1f}s, {WORKERS} workers: {timings[WORKERS]:.1f}s"
+    )
+    # Compared as text, as NaN features are not equal to themselves
+    assert repr(results[WORKERS]) == repr(results[0])
+    assert timings[WORKERS] < timings[0]